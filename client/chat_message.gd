@@ -1,5 +1,7 @@
 extends PanelContainer
 
+signal cancel_requested
+
 
 func setup(prompt: Prompt, image: Image):
 	var my_prompt := prompt.duplicate()
@@ -19,8 +21,13 @@ func set_progress(progress: String, bar: float):
 	%ProgressLabel.text = progress
 	%PromptContainer.queue_sort()
 
+func set_partial(text: PackedStringArray):
+	%Response.text = "\n".join(text)
+	%PromptContainer.queue_sort()
+
 func set_result(result: PackedStringArray):
 	%Progress.hide()
+	%CancelButton.hide()
 	if not result.is_empty():
 		%Response.text = "\n".join(result)
 	else:
@@ -28,9 +35,14 @@ func set_result(result: PackedStringArray):
 	%PromptContainer.queue_sort()
 
 func set_fail(reason: String):
+	%CancelButton.hide()
 	%ProgressBar.value = 1.0
 	var fill: StyleBoxFlat = %ProgressBar.get_theme_stylebox("fill")
 	fill.bg_color = Color.INDIAN_RED
 	%ProgressBar.add_theme_stylebox_override("fill", fill)
 	%ProgressLabel.text = reason
 	%PromptContainer.queue_sort()
+
+func _on_cancel_button_pressed():
+	%CancelButton.disabled = true
+	cancel_requested.emit()
@@ -2,6 +2,7 @@ extends PanelContainer
 
 
 var _PROGRESS_BAR_MAP = {}
+const _UPLOAD_JPEG_QUALITY := 0.9
 
 const ChatMessage_Scene := preload("res://chat_message.tscn")
 @onready var WSClient: WebSocketClient = $WebSocketClient
@@ -10,6 +11,11 @@ var _submission_id := 0
 var _id_msg_map := {}
 var _queue_pos_map := {}
 var _queue_len := -1
+# Follow-up questions about the same image continue one session, so the server only processes the new prompt.
+var _session_count := 0
+var _session_image: Image = null
+# Id of the session's last question while its answer is pending, -1 otherwise.
+var _session_request := -1
 
 
 func _ready():
@@ -22,43 +28,69 @@ func _on_server_packet(event: String, data: Dictionary):
 		"progress":
 			var progress = data["progress"]
 			_set_progress(data["id"], progress, _PROGRESS_BAR_MAP.get(progress, 0))
+		"partial":
+			_id_msg_map[int(data["id"])].set_partial(data["text"])
 		"result":
+			if int(data["id"]) == _session_request:
+				_session_request = -1
 			_id_msg_map[int(data["id"])].set_result(data["result"])
 		"queue_len":
 			_queue_len = data["len"]
 			_update_queue_info()
-		"queue_pos":
-			var id = data["id"]
-			_queue_pos_map[id] = data["pos"]
-			_update_queue_info(id)
+		"queue_positions":
+			for entry in data["positions"]:
+				var id := int(entry[0])
+				_queue_pos_map[id] = int(entry[1])
+				_update_queue_info(id)
+		"cancelled":
+			var id := int(data["id"])
+			if id == _session_request:
+				_session_request = -1
+			_id_msg_map[id].set_fail("CANCELLED")
 		"submit_fail":
 			Utils.push_notification(Notification.ERROR, "Submission failed!")
 			var id = data.get("id")
+			if id is int and id == _session_request:
+				# Starts over rather than asking a session that may have missed a turn.
+				_session_image = null
+				_session_request = -1
 			if id is int and _id_msg_map.has(id):
-				_id_msg_map[id].set_fail(data.get("cause", "Unknown error"))
+				var cause: String = data.get("cause", "Unknown error")
+				if data.has("retry_after"):
+					cause += " Retry in %ds." % int(data["retry_after"])
+				_id_msg_map[id].set_fail(cause)
 		_:
 			Utils.push_notification(Notification.ERROR, "Unknown event type: " + event)
 			printerr("Unknown event type: " + event)
 
-func _on_send_panel_submit(prompt: Prompt, image: Image, image_size: Vector2i, args: Dictionary):
-	WSClient.send("submit", {
+func _on_send_panel_submit(prompt: Prompt, image: Image, _image_size: Vector2i, args: Dictionary, stream: bool, follow_up: bool):
+	# Every question starts a new session, unless it's a follow-up about the same image sent after the last answer.
+	if not follow_up or image != _session_image or _session_request != -1:
+		_session_count += 1
+		_session_image = image
+	_session_request = self._submission_id
+	WSClient.send_binary("submit", {
 		"id": self._submission_id,
 		"prompt": prompt.construct_prompt(),
-		"image": Marshalls.raw_to_base64(image.get_data()),
-		"image_width": image_size.x,
-		"image_height": image_size.y,
-		"args": args
-	})
+		"format": "jpeg",
+		"stream": stream,
+		"args": args,
+		"session_id": str(_session_count)
+	}, image.save_jpg_to_buffer(_UPLOAD_JPEG_QUALITY))
 	
 	var msg := ChatMessage_Scene.instantiate()
 	msg.setup(prompt, image)
 	%ChatMessageContainer.add_child(msg)
 	msg.set_progress("WAITING_FOR_SERVER_RESPONSE", 0.0)
+	msg.cancel_requested.connect(_on_cancel_requested.bind(self._submission_id))
 	self._id_msg_map[self._submission_id] = msg
 	self._queue_pos_map[self._submission_id] = _queue_len
 	
 	self._submission_id += 1
 
+func _on_cancel_requested(id: int):
+	WSClient.send("cancel", {"id": id})
+
 func _set_progress(id: int, progress: String, bar: float):
 	_id_msg_map[id].set_progress(progress, bar)
 
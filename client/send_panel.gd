@@ -1,7 +1,7 @@
 extends HBoxContainer
 
 
-signal submit(prompt: String, image: PackedByteArray, image_size: Vector2i, args: Dictionary)
+signal submit(prompt: String, image: PackedByteArray, image_size: Vector2i, args: Dictionary, stream: bool, follow_up: bool)
 
 
 func _on_button_pressed():
@@ -17,6 +17,9 @@ func _on_button_pressed():
 			"temperature": 1.5,
 			"top_p": 0.95,
 			"min_length":10,
-			#"max_length": 100
-		}
+			#"max_length": 100,
+			#"model": "opt6.7b",
+		},
+		%Stream.button_pressed,
+		%FollowUp.button_pressed
 	)
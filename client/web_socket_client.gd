@@ -24,6 +24,22 @@ func send(event: String, data: Dictionary):
 		Utils.push_notification(Notification.ERROR, "Failed to send packet: " + error_string(err))
 	data_sent.emit()
 
+## Sends a binary frame: [u32 header length][JSON header][payload], see server/protocol.py
+func send_binary(event: String, data: Dictionary, payload: PackedByteArray):
+	var header := JSON.stringify({
+		"event": event,
+		"data": data
+	}).to_utf8_buffer()
+	var packet := PackedByteArray()
+	packet.resize(4)
+	packet.encode_u32(0, header.size())
+	packet.append_array(header)
+	packet.append_array(payload)
+	var err := _conn.send(packet, WebSocketPeer.WRITE_MODE_BINARY)
+	if err != OK:
+		Utils.push_notification(Notification.ERROR, "Failed to send packet: " + error_string(err))
+	data_sent.emit()
+
 func _ready():
 	_conn.outbound_buffer_size = 1024*1024*10
 	
@@ -0,0 +1,125 @@
+"""
+Admission control: submissions are rejected early, before their image is decoded, when the server can't take them
+in reasonable time. Rejections carry a retry_after hint (seconds) when waiting would help.
+"""
+import math
+import typing
+
+import config
+import metrics
+
+
+# Keyword arguments of Model.generate() clients can give, and their types.
+GENERATE_ARGS = {
+    "use_nucleus_sampling": bool,
+    "num_beams": int,
+    "max_length": int,
+    "min_length": int,
+    "top_p": float,
+    "repetition_penalty": float,
+    "length_penalty": float,
+    "num_captions": int,
+    "temperature": float,
+    "speculative": bool,
+}
+
+
+# Values of the float generate arguments that decode, besides being finite. Others make sampling or the
+# beam scores fail in the worker, after the work waited in the queue.
+_FLOAT_ARG_RANGES = {
+    "temperature": (lambda v: v > 0, "greater than 0"),
+    "top_p": (lambda v: 0 < v <= 1, "greater than 0 and at most 1"),
+    "repetition_penalty": (lambda v: v > 0, "greater than 0"),
+}
+
+
+class Rejection(typing.NamedTuple):
+    cause: str
+    # Seconds after which the same submission would probably be accepted, None if it never would.
+    retry_after: float | None = None
+
+    def extra_data(self) -> dict:
+        return {} if self.retry_after is None else {"retry_after": math.ceil(self.retry_after)}
+
+
+def check_image_size(width: int, height: int) -> Rejection | None:
+    if width <= 0 or height <= 0:
+        return Rejection("Empty image.")
+    if config.MAX_IMAGE_PIXELS is not None and width * height > config.MAX_IMAGE_PIXELS:
+        metrics.REJECTED.inc(reason="image_too_large")
+        return Rejection(f"Image too large: {width}x{height}, at most {config.MAX_IMAGE_PIXELS} pixels.")
+    return None
+
+
+def check_args(args: dict) -> Rejection | None:
+    """
+    Checks the generate arguments of a work against the keyword arguments of Model.generate() (GENERATE_ARGS),
+    their ranges and config.GENERATE_ARG_LIMITS, invalid ones would only fail in the worker.
+    Valid arguments lose a speculative that has no effect (false, when sampling or without config.DRAFT_MODEL),
+    the batch engine doesn't take works with one.
+    """
+    for key, value in args.items():
+        arg_type = GENERATE_ARGS.get(key)
+        if arg_type is None:
+            metrics.REJECTED.inc(reason="invalid_args")
+            return Rejection(f"Unknown argument {key}, one of: model, {', '.join(GENERATE_ARGS)}.")
+        if type(value) is not arg_type and not (arg_type is float and type(value) is int):
+            metrics.REJECTED.inc(reason="invalid_args")
+            return Rejection(f"Invalid {key}, a {arg_type.__name__}.")
+        if arg_type is float:
+            in_range, description = _FLOAT_ARG_RANGES.get(key, (lambda v: True, "a finite number"))
+            if not math.isfinite(value) or not in_range(value):
+                metrics.REJECTED.inc(reason="invalid_args")
+                return Rejection(f"Invalid {key}, {description}.")
+    for key, limit in config.GENERATE_ARG_LIMITS.items():
+        if key in args and (type(args[key]) is not int or not 1 <= args[key] <= limit):
+            metrics.REJECTED.inc(reason="invalid_args")
+            return Rejection(f"Invalid {key}, an integer from 1 to {limit}.")
+    if "min_length" in args and not 0 <= args["min_length"] <= args.get("max_length", 30):
+        metrics.REJECTED.inc(reason="invalid_args")
+        return Rejection("Invalid min_length, from 0 to max_length.")
+    if not args.get("speculative", True) or args.get("use_nucleus_sampling", False) or config.DRAFT_MODEL is None:
+        args.pop("speculative", None)
+    return None
+
+
+def check_stream(model: str, args: dict, batching: bool) -> Rejection | None:
+    """
+    Checks that a streaming work would get partial texts: only the batch engine produces them (workers batching,
+    an OPT variant, not speculative), and it streams no beams, only greedy or sampled captions.
+    Greedy unless sampling, num_beams defaults to 1 when streaming.
+    """
+    if not batching or config.MODELS[model][0] != "blip2_opt" or args.get("speculative", False):
+        metrics.REJECTED.inc(reason="invalid_args")
+        return Rejection("Streaming needs an OPT model with batching workers, and no speculative decoding.")
+    if not args.get("use_nucleus_sampling", False) and args.get("num_beams", 1) != 1:
+        metrics.REJECTED.inc(reason="invalid_args")
+        return Rejection("Beam search can't stream, use num_beams 1 or use_nucleus_sampling.")
+    return None
+
+
+def check_load(queue_len: int, client_works: int, estimated_wait: float | None) -> Rejection | None:
+    """
+    Checks the queue depth, the client's unfinished works and the estimated wait of a new work
+    (see WorkerPool.estimated_wait(), None when there is no estimate yet).
+    """
+    if config.MAX_CLIENT_WORKS is not None and client_works >= config.MAX_CLIENT_WORKS:
+        metrics.REJECTED.inc(reason="client_limit")
+        return Rejection(f"Too many unfinished requests, at most {config.MAX_CLIENT_WORKS}.")
+
+    if config.MAX_QUEUE_DEPTH is not None and queue_len >= config.MAX_QUEUE_DEPTH:
+        metrics.REJECTED.inc(reason="queue_full")
+        retry_after = config.DEFAULT_RETRY_AFTER
+        if estimated_wait is not None and queue_len > 0:
+            # Until enough works are dispatched to make room, at the current pace.
+            retry_after = estimated_wait / queue_len * (queue_len - config.MAX_QUEUE_DEPTH + 1)
+        return Rejection("The queue is full.", retry_after)
+
+    if config.MAX_ESTIMATED_WAIT is not None and estimated_wait is not None \
+            and estimated_wait > config.MAX_ESTIMATED_WAIT:
+        metrics.REJECTED.inc(reason="wait_too_long")
+        return Rejection(
+            f"Estimated wait too long: {estimated_wait:.0f}s, at most {config.MAX_ESTIMATED_WAIT:.0f}s.",
+            estimated_wait - config.MAX_ESTIMATED_WAIT
+        )
+    return None
@@ -0,0 +1,456 @@
+import contextlib
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+# Keyword arguments of Model.generate that the batch engine knows how to decode with.
+GENERATE_ARGS = frozenset((
+    "use_nucleus_sampling",
+    "num_beams",
+    "max_length",
+    "min_length",
+    "top_p",
+    "repetition_penalty",
+    "length_penalty",
+    "num_captions",
+    "temperature",
+))
+
+
+def _to_legacy_cache(past):
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    return past
+
+
+def _pad_left(past, mask, n: int):
+    past = [(F.pad(k, (0, 0, n, 0)), F.pad(v, (0, 0, n, 0))) for k, v in past]
+    return past, F.pad(mask, (n, 0))
+
+
+def _select_rows(past, mask, index: list[int]):
+    """
+    Keeps the given rows of the batch, and drops the columns that are padding for all of them.
+    """
+    if index != list(range(mask.shape[0])):
+        index_t = torch.tensor(index, device=mask.device)
+        past = [(k.index_select(0, index_t), v.index_select(0, index_t)) for k, v in past]
+        mask = mask.index_select(0, index_t)
+    first = int(mask.any(dim=0).nonzero()[0])
+    if first > 0:
+        past = [(k[:, :, first:], v[:, :, first:]) for k, v in past]
+        mask = mask[:, first:]
+    return list(past), mask
+
+
+class _Row:
+    __slots__ = ("index", "tokens", "score")
+
+    def __init__(self, index: int, tokens: list[int], score: float = 0.0):
+        self.index = index
+        self.tokens = tokens
+        self.score = score
+
+
+class _Request:
+    def __init__(self, key, prompt_ids: list[int], args: dict):
+        self.key = key
+        self.prompt_ids = prompt_ids
+
+        self.sample = bool(args.get("use_nucleus_sampling", False))
+        self.num_beams = 1 if self.sample else int(args.get("num_beams", 5))
+        self.max_length = int(args.get("max_length", 30))
+        self.min_length = int(args.get("min_length", 1))
+        self.top_p = float(args.get("top_p", 0.9))
+        self.temperature = float(args.get("temperature", 1))
+        self.repetition_penalty = float(args.get("repetition_penalty", 1.0))
+        self.length_penalty = float(args.get("length_penalty", 1.0))
+        self.num_captions = int(args.get("num_captions", 1))
+
+        n = BatchEngine.rows_needed(args)
+        # Only the first beam is live at the start, otherwise every beam would pick the same token.
+        self.rows = [_Row(i, [], 0.0 if i == 0 else -math.inf) for i in range(n)]
+        self.finished: list[tuple[float, list[int]]] = []
+        self.steps = 0
+        self.done = False
+
+    def _process(self, scores: torch.Tensor, eos_token_id: int):
+        if self.repetition_penalty != 1.0:
+            for i, row in enumerate(self.rows):
+                seen = torch.tensor(self.prompt_ids + row.tokens, device=scores.device).unique()
+                score = scores[i, seen]
+                scores[i, seen] = torch.where(
+                    score < 0, score * self.repetition_penalty, score / self.repetition_penalty
+                )
+        # Unlike transformers' min_length, this only counts the generated tokens.
+        if self.steps < self.min_length:
+            scores[:, eos_token_id] = -math.inf
+        return scores
+
+    def advance(self, logits: torch.Tensor, eos_token_id: int) -> tuple[list[int], list[int]]:
+        """
+        Consumes the logits of this request's rows.
+        Returns the local indices of the rows the surviving sequences continue from and their next tokens.
+        """
+        if self.num_beams > 1:
+            parents, tokens = self._advance_beams(logits, eos_token_id)
+        else:
+            parents, tokens = self._advance_rows(logits, eos_token_id)
+        self.steps += 1
+        self.done = not parents
+        return parents, tokens
+
+    def _advance_rows(self, logits, eos_token_id):
+        logits = self._process(logits, eos_token_id)
+        if self.sample:
+            logits = logits / self.temperature
+            sorted_logits, sorted_idx = logits.sort(dim=-1, descending=True)
+            probs = sorted_logits.softmax(dim=-1)
+            remove = probs.cumsum(dim=-1) - probs > self.top_p
+            sorted_logits[remove] = -math.inf
+            logits = torch.full_like(logits, -math.inf).scatter(-1, sorted_idx, sorted_logits)
+            next_tokens = torch.multinomial(logits.softmax(dim=-1), 1).squeeze(-1)
+        else:
+            next_tokens = logits.argmax(dim=-1)
+
+        parents, tokens, rows = [], [], []
+        for i, (row, token) in enumerate(zip(self.rows, next_tokens.tolist())):
+            row.tokens.append(token)
+            if token == eos_token_id or len(row.tokens) >= self.max_length:
+                self.finished.append((row.index, row.tokens))
+            else:
+                parents.append(i)
+                tokens.append(token)
+                rows.append(row)
+        self.rows = rows
+        return parents, tokens
+
+    def _add_hypothesis(self, tokens: list[int], score: float):
+        length = len(self.prompt_ids) + len(tokens)
+        self.finished.append((score / length ** self.length_penalty, tokens))
+        self.finished.sort(key=lambda h: h[0], reverse=True)
+        del self.finished[self.num_beams:]
+
+    def _advance_beams(self, logits, eos_token_id):
+        num_beams = self.num_beams
+        scores = self._process(logits.log_softmax(dim=-1), eos_token_id)
+        scores = scores + torch.tensor([r.score for r in self.rows], device=scores.device)[:, None]
+        vocab_size = scores.shape[-1]
+        top_scores, top_idx = scores.view(-1).topk(2 * num_beams)
+
+        parents, tokens, rows = [], [], []
+        for rank, (score, idx) in enumerate(zip(top_scores.tolist(), top_idx.tolist())):
+            beam, token = divmod(idx, vocab_size)
+            if token == eos_token_id:
+                if rank < num_beams:
+                    self._add_hypothesis(self.rows[beam].tokens + [token], score)
+            else:
+                parents.append(beam)
+                tokens.append(token)
+                rows.append(_Row(len(rows), self.rows[beam].tokens + [token], score))
+            if len(rows) == num_beams:
+                break
+        self.rows = rows
+
+        if self.steps + 1 >= self.max_length:
+            for row in rows:
+                self._add_hypothesis(row.tokens, row.score)
+            return [], []
+        if len(self.finished) >= num_beams:
+            cur_length = len(self.prompt_ids) + self.steps + 1
+            best_possible = rows[0].score / cur_length ** self.length_penalty
+            if self.finished[-1][0] >= best_possible:
+                return [], []
+        return parents, tokens
+
+    def partial_tokens(self) -> list[list[int]]:
+        if self.num_beams > 1:
+            return [self.rows[0].tokens] if self.rows else []
+        rows = self.finished + [(r.index, r.tokens) for r in self.rows]
+        return [tokens for _, tokens in sorted(rows, key=lambda h: h[0])]
+
+    def results(self) -> list[list[int]]:
+        if self.num_beams > 1:
+            return [tokens for _, tokens in self.finished[:self.num_captions]]
+        return [tokens for _, tokens in sorted(self.finished, key=lambda h: h[0])]
+
+
+class BatchEngine:
+    """
+    Iteration-level batching for the OPT decode stage.
+
+    Every request is prefilled on its own and then merged into one shared decode batch
+    (left padded, so the attention mask takes care of the different lengths).
+    Requests join and leave the batch between two decode steps,
+    rows of finished sequences are dropped right away.
+    """
+
+    def __init__(self, opt_model, tokenizer, eos_token_id: int, max_batch_size: int = 16,
+                 autocast=contextlib.nullcontext):
+        self.opt_model = opt_model
+        self.tokenizer = tokenizer
+        self.eos_token_id = eos_token_id
+        self.max_batch_size = max_batch_size
+        self._autocast = autocast
+
+        self._requests: list[_Request] = []
+        # Tokens decoded so far, one per row and step.
+        self.decoded_tokens = 0
+        # Keys and exceptions of the requests that failed in the last step().
+        self.failed: list[tuple[object, Exception]] = []
+        self._past = None
+        self._mask = None
+        self._next_tokens = None
+
+    @staticmethod
+    def rows_needed(args: dict) -> int:
+        if args.get("use_nucleus_sampling", False):
+            return int(args.get("num_captions", 1))
+        return int(args.get("num_beams", 5))
+
+    def supports(self, args: dict) -> bool:
+        return set(args) <= GENERATE_ARGS and self.rows_needed(args) <= self.max_batch_size
+
+    @property
+    def num_rows(self) -> int:
+        return sum(len(r.rows) for r in self._requests)
+
+    @property
+    def idle(self) -> bool:
+        return not self._requests
+
+    def can_admit(self, args: dict) -> bool:
+        return self.num_rows + self.rows_needed(args) <= self.max_batch_size
+
+    def _embed(self, input_ids):
+        return self.opt_model.get_input_embeddings()(input_ids)
+
+    @torch.no_grad()
+    def add(self, key, query_embeds: torch.Tensor | None, input_ids: torch.Tensor, args: dict, past=None):
+        """
+        Prefills a request and merges it into the decode batch.
+        query_embeds are the projected Q-Former outputs of one image, input_ids the tokenized prompt (batch size 1).
+        The last prompt token is left out of the prefill, it's fed by the next decode step.
+        With past (key/value pairs of batch size 1, like the ones returned), input_ids continue that sequence
+        instead and query_embeds must be None.
+        Returns the past key values of the prefilled prefix, the sequence up to the last prompt token.
+        """
+        device = past[0][0].device if query_embeds is None else query_embeds.device
+        input_ids = input_ids.to(device)
+        request = _Request(key, input_ids[0].tolist(), args)
+
+        with self._autocast():
+            inputs_embeds = self._embed(input_ids[:, :-1])
+            if query_embeds is not None:
+                inputs_embeds = torch.cat([query_embeds, inputs_embeds.to(query_embeds.dtype)], dim=1)
+            past_length = 0 if past is None else past[0][0].shape[2]
+            mask = torch.ones((1, past_length + inputs_embeds.shape[1]), dtype=torch.long, device=device)
+            outputs = self.opt_model(
+                inputs_embeds=inputs_embeds,
+                attention_mask=mask,
+                past_key_values=None if past is None else tuple(past),
+                use_cache=True,
+                return_dict=True,
+            )
+        prefix = list(_to_legacy_cache(outputs.past_key_values))
+
+        n = len(request.rows)
+        past = [(k.expand(n, -1, -1, -1), v.expand(n, -1, -1, -1)) for k, v in prefix]
+        mask = mask.expand(n, -1)
+        next_tokens = input_ids[0, -1:].expand(n)
+
+        # Merged aside and swapped in at the end, a failure leaves the batch as it was.
+        if self._past is None:
+            merged_past = [(k.contiguous(), v.contiguous()) for k, v in past]
+            merged_mask = mask.contiguous()
+            merged_next_tokens = next_tokens.contiguous()
+        else:
+            merged_past, merged_mask = self._past, self._mask
+            diff = mask.shape[1] - merged_mask.shape[1]
+            if diff > 0:
+                merged_past, merged_mask = _pad_left(merged_past, merged_mask, diff)
+            elif diff < 0:
+                past, mask = _pad_left(past, mask, -diff)
+            merged_past = [(torch.cat([k0, k1]), torch.cat([v0, v1])) for (k0, v0), (k1, v1) in zip(merged_past, past)]
+            merged_mask = torch.cat([merged_mask, mask])
+            merged_next_tokens = torch.cat([self._next_tokens, next_tokens])
+        self._past, self._mask, self._next_tokens = merged_past, merged_mask, merged_next_tokens
+        self._requests.append(request)
+        return prefix
+
+    @torch.no_grad()
+    def step(self) -> list[tuple[object, list[list[int]]]]:
+        """
+        Runs one decode step for every row in the batch.
+        Returns the keys and output tokens of the requests that finished in this step, see decode().
+        The requests whose own step raised (e.g. sampling from invalid probabilities) leave the batch,
+        with their exception, in failed.
+        """
+        self.failed = []
+        if not self._requests:
+            return []
+
+        device = self._mask.device
+        mask = torch.cat([self._mask, self._mask.new_ones((self._mask.shape[0], 1))], dim=1)
+        with self._autocast():
+            outputs = self.opt_model(
+                inputs_embeds=self._embed(self._next_tokens[:, None]),
+                attention_mask=mask,
+                past_key_values=tuple(self._past),
+                use_cache=True,
+                return_dict=True,
+            )
+        logits = outputs.logits[:, -1, :].float()
+        past = _to_legacy_cache(outputs.past_key_values)
+
+        index, next_tokens, finished = [], [], []
+        offset = 0
+        failed = set()
+        for request in self._requests:
+            n = len(request.rows)
+            try:
+                parents, tokens = request.advance(logits[offset:offset + n], self.eos_token_id)
+            except Exception as e:
+                # The others go on without its rows.
+                self.failed.append((request.key, e))
+                failed.add(request.key)
+                offset += n
+                continue
+            index.extend(offset + p for p in parents)
+            next_tokens.extend(tokens)
+            offset += n
+            if request.done:
+                finished.append(request)
+        self._requests = [r for r in self._requests if not r.done and r.key not in failed]
+        self.decoded_tokens += offset
+
+        if not index:
+            self._past = self._mask = self._next_tokens = None
+        else:
+            self._past, self._mask = _select_rows(past, mask, index)
+            self._next_tokens = torch.tensor(next_tokens, dtype=torch.long, device=device)
+
+        return [(r.key, r.results()) for r in finished]
+
+    def cancel(self, key) -> int | None:
+        """
+        Drops a request from the batch.
+        Returns the number of tokens (rows times steps) it could still have decoded, None if it isn't in the batch.
+        """
+        offset = 0
+        for i, request in enumerate(self._requests):
+            if request.key == key:
+                break
+            offset += len(request.rows)
+        else:
+            return None
+
+        n = len(request.rows)
+        del self._requests[i]
+        index = [j for j in range(self._mask.shape[0]) if not offset <= j < offset + n]
+        if not index:
+            self._past = self._mask = self._next_tokens = None
+        else:
+            self._past, self._mask = _select_rows(self._past, self._mask, index)
+            self._next_tokens = self._next_tokens[torch.tensor(index, device=self._mask.device)]
+        return n * (request.max_length - request.steps)
+
+    def partial(self, key) -> list[str]:
+        """
+        Decodes what has been generated so far for a request that is still in the batch.
+        """
+        request = next(r for r in self._requests if r.key == key)
+        return self.decode(request.partial_tokens())
+
+    def decode(self, sequences: list[list[int]]) -> list[str]:
+        """
+        Output texts of the tokens returned by step().
+        """
+        output_text = self.tokenizer.batch_decode(sequences, skip_special_tokens=True)
+        return [text.strip() for text in output_text]
+
+
+if __name__ == '__main__':
+    # Self check on CPU with a tiny randomly initialized OPT: greedy requests joining
+    # the batch at different steps must decode exactly like transformers' generate().
+    from transformers import OPTConfig, OPTForCausalLM
+
+    class _Tokenizer:
+        @staticmethod
+        def batch_decode(sequences, skip_special_tokens=True):
+            return [" ".join(map(str, s)) for s in sequences]
+
+    torch.manual_seed(0)
+    opt_config = OPTConfig(
+        vocab_size=64, hidden_size=32, num_hidden_layers=2, ffn_dim=64, num_attention_heads=4,
+        max_position_embeddings=128, word_embed_proj_dim=32,
+    )
+    opt = OPTForCausalLM(opt_config).eval()
+    eos = 2
+    engine = BatchEngine(opt, _Tokenizer(), eos, max_batch_size=8)
+
+    requests = []
+    for i in range(5):
+        query = torch.randn(1, 4, 32)
+        ids = torch.randint(3, 64, (1, 2 + i))
+        requests.append((i, query, ids, {"num_beams": 1, "max_length": 6 + i}))
+
+    expected = {}
+    for key, query, ids, args in requests:
+        embeds = torch.cat([query, opt.get_input_embeddings()(ids)], dim=1)
+        out = opt.generate(
+            inputs_embeds=embeds, attention_mask=torch.ones(embeds.shape[:2], dtype=torch.long),
+            do_sample=False, num_beams=1, max_new_tokens=args["max_length"], min_length=0,
+            eos_token_id=eos, pad_token_id=1,
+        )
+        # With only inputs_embeds given, generate() returns just the new tokens.
+        tokens = out[0].tolist()
+        if eos in tokens:
+            tokens = tokens[:tokens.index(eos) + 1]
+        expected[key] = _Tokenizer.batch_decode([tokens])
+
+    results = {}
+    pending = list(requests)
+    while pending or not engine.idle:
+        if pending:
+            key, query, ids, args = pending.pop(0)
+            engine.add(key, query, ids, dict(args, min_length=0))
+        for key, sequences in engine.step():
+            results[key] = engine.decode(sequences)
+
+    assert results == expected, (results, expected)
+
+    # A follow-up continuing from the returned prefix must decode like the whole sequence prefilled at once.
+    query, first, follow_up = torch.randn(1, 4, 32), torch.randint(3, 64, (1, 3)), torch.randint(3, 64, (1, 2))
+    args = {"num_beams": 1, "max_length": 5, "min_length": 0}
+    prefix = engine.add("first", query, first, args)
+    engine.add("whole", query, torch.cat([first, follow_up], dim=1), args)
+    engine.add("follow-up", None, torch.cat([first[:, -1:], follow_up], dim=1), args, past=prefix)
+    while not engine.idle:
+        for key, sequences in engine.step():
+            results[key] = engine.decode(sequences)
+    assert results["whole"] == results["follow-up"], results
+
+    # Cancelling a request leaves the others decoding as if it had never been there.
+    engine.add("kept", query, first, args)
+    engine.add("cancelled", torch.randn(1, 4, 32), torch.randint(3, 64, (1, 6)), dict(args, num_beams=3))
+    engine.step()
+    assert engine.cancel("cancelled") == 3 * (args["max_length"] - 1)
+    while not engine.idle:
+        for key, sequences in engine.step():
+            results[key] = engine.decode(sequences)
+    assert results["kept"] == results["first"], results
+
+    # A request failing to sample leaves the batch alone, the others decode as if it had never been there.
+    engine.add("kept", query, first, args)
+    engine.add("failing", torch.randn(1, 4, 32), torch.randint(3, 64, (1, 6)),
+               dict(args, use_nucleus_sampling=True, temperature=0.0))
+    while not engine.idle:
+        for key, sequences in engine.step():
+            results[key] = engine.decode(sequences)
+        results.update(engine.failed)
+    assert isinstance(results["failing"], RuntimeError), results
+    assert results["kept"] == results["first"], results
+    print("OK", results)
@@ -0,0 +1,104 @@
+"""
+Accuracy vs speed of the CPU inference options (see model_api.optimize_for_cpu()), to pick config.CPU_QUANTIZE
+and config.CPU_BF16 for a deployment. Runs the samples through fp32, then int8, then int8 + bf16 (when supported),
+and compares the captions of each variant with the fp32 ones.
+
+    python bench_cpu.py [--samples ../img_prompt] [--limit 5] [--threads 8] [--args '{"num_beams": 1}']
+                        [--model opt2.7b]
+
+Every sample directory has a prompt.txt and an img.jpg.
+"""
+import argparse
+import difflib
+import json
+import os
+import statistics
+import time
+
+from PIL import Image
+import torch
+
+import config
+import model_api
+
+
+def load_samples(path: str, limit: int) -> list[tuple[str, Image.Image]]:
+    samples = []
+    for name in sorted(os.listdir(path))[:limit]:
+        with open(os.path.join(path, name, "prompt.txt")) as f:
+            prompt = f.read().strip()
+        samples.append((prompt, Image.open(os.path.join(path, name, "img.jpg")).convert("RGB")))
+    return samples
+
+
+def run(model: model_api.Model, samples, args: dict) -> tuple[list[list[str]], list[float]]:
+    outputs, times = [], []
+    for prompt, image in samples:
+        start = time.perf_counter()
+        generator = model.generate(prompt, image, **args)
+        while True:
+            try:
+                next(generator)
+            except StopIteration as si:
+                outputs.append(si.value)
+                break
+        times.append(time.perf_counter() - start)
+    return outputs, times
+
+
+def similarity(a: list[str], b: list[str]) -> float:
+    """
+    Mean word level similarity of two lists of captions, 1 when they're the same.
+    """
+    return statistics.mean(
+        difflib.SequenceMatcher(None, x.split(), y.split()).ratio() for x, y in zip(a, b)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", default="../img_prompt")
+    parser.add_argument("--limit", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--args", type=json.loads, default={}, help="Generate arguments, as JSON.")
+    parser.add_argument("--model", default=config.DEFAULT_MODEL, choices=config.MODELS)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    samples = load_samples(args.samples, args.limit)
+    weights = model_api.load_weights(args.model, float32=True)
+    model = model_api.MODEL_CLASSES[config.MODELS[args.model][0]](
+        weights.main, weights.vis_proc, weights.txt_proc, torch.device("cpu"), name=args.model
+    )
+
+    # Each variant adds to the previous one, the model is optimized in place.
+    variants = [("fp32", False, False), ("int8", True, False)]
+    if model_api.cpu_supports_bf16():
+        variants.append(("int8 + bf16", False, True))
+    else:
+        print("This CPU doesn't support bf16, skipping it.")
+
+    # Warm up, the first run allocates and initializes a lot.
+    run(model, samples[:1], args.args)
+
+    reference = None
+    reference_time = None
+    print(f"{len(samples)} samples, {args.threads} threads, args {args.args}")
+    print(f"{'variant':<12} {'mean':>9} {'p50':>9} {'speedup':>8} {'exact':>6} {'similarity':>10}")
+    for name, quantize, bf16 in variants:
+        model_api.optimize_for_cpu(model, quantize, bf16)
+        if quantize or bf16:
+            run(model, samples[:1], args.args)
+        outputs, times = run(model, samples, args.args)
+        if reference is None:
+            reference, reference_time = outputs, statistics.mean(times)
+        exact = sum(o == r for o, r in zip(outputs, reference)) / len(samples)
+        sim = statistics.mean(similarity(o, r) for o, r in zip(outputs, reference))
+        print(f"{name:<12} {statistics.mean(times):8.2f}s {statistics.median(times):8.2f}s "
+              f"{reference_time / statistics.mean(times):7.2f}x {exact:6.0%} {sim:10.3f}")
+        for (prompt, _), texts in zip(samples, outputs):
+            print(f"    {prompt!r}: {texts}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Dispatch latency of the WorkerPool, event driven vs polling, with DummyModel workers.
+Works are submitted one at a time, so the numbers are the per work dispatch and messaging overhead.
+
+    python bench_dispatch.py [--workers 2] [--works 200] [--poll-interval 0.01] [--step-delay 0]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+os.environ["BTLP2_DEBUGGING"] = "1"
+
+from PIL import Image
+
+import worker
+
+
+def percentile(values, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def bench(poll_interval: float | None, args) -> dict:
+    first_progress = {}
+    results = {}
+
+    async def on_queue_update(_):
+        pass
+
+    async def on_progress(_, work, __):
+        first_progress.setdefault(work.uid, time.perf_counter())
+
+    async def on_result(_, work, __):
+        results[work.uid].set_result(time.perf_counter())
+
+    pool = worker.WorkerPool(on_queue_update, on_progress, on_result, devices=["cpu"] * args.workers,
+                             min_workers_per_device=1, max_workers_per_device=1)
+    runner = asyncio.create_task(pool.run(poll_interval))
+    try:
+        while any(w.busy for w in pool.workers):
+            await asyncio.sleep(0.1)
+
+        image = Image.new("RGB", (8, 8))
+        to_progress, to_result = [], []
+        for i in range(args.works):
+            work = worker.Work(None, i, "benchmark", image, {})
+            results[work.uid] = asyncio.get_running_loop().create_future()
+            start = time.perf_counter()
+            await pool.submit(work)
+            end = await results[work.uid]
+            to_progress.append(first_progress[work.uid] - start)
+            to_result.append(end - start)
+    finally:
+        runner.cancel()
+        pool.close()
+
+    return {"first progress": to_progress, "result": to_result}
+
+
+def report(name: str, stats: dict):
+    for metric, values in stats.items():
+        ms = [v * 1000 for v in values]
+        print(f"{name:<14} {metric:<15} "
+              f"mean {statistics.mean(ms):7.2f} ms  "
+              f"p50 {percentile(ms, 50):7.2f} ms  "
+              f"p99 {percentile(ms, 99):7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--works", type=int, default=200)
+    parser.add_argument("--poll-interval", type=float, default=0.01)
+    parser.add_argument("--step-delay", type=float, default=0.0, help="Delay of each DummyModel progress step.")
+    args = parser.parse_args()
+    os.environ["BTLP2_DUMMY_STEP_DELAY"] = str(args.step_delay)
+
+    report("event driven", asyncio.run(bench(None, args)))
+    report(f"poll {args.poll_interval * 1000:g} ms", asyncio.run(bench(args.poll_interval, args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Event loop lag while large uploads are ingested, decoding them on the event loop (like the server used to)
+vs on the ingest thread pool (see ingest.py).
+
+A probe sleeps PROBE_INTERVAL over and over on the loop and records how late it wakes up, the delay every other
+client would see on its progress and results meanwhile. Uploads arrive --concurrency at a time.
+
+    python bench_ingest.py [--uploads 64] [--concurrency 8] [--image-size 4000x3000] [--format jpeg] [--threads 4]
+"""
+import argparse
+import asyncio
+import io
+import random
+import statistics
+import time
+
+from PIL import Image
+
+import config
+import ingest
+
+
+PROBE_INTERVAL = 0.005
+
+
+def percentile(values, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def make_upload(width: int, height: int, image_format: str) -> bytes:
+    # Noise compresses badly, like photos rather than flat test images.
+    image = Image.frombytes("RGB", (width, height), random.randbytes(width * height * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format={"jpeg": "JPEG", "png": "PNG", "webp": "WEBP"}[image_format])
+    return buffer.getvalue()
+
+
+async def probe(lags: list[float], stop: asyncio.Event):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(time.perf_counter() - start - PROBE_INTERVAL)
+
+
+async def bench(pool: ingest.Ingest | None, upload: bytes, args) -> dict:
+    lags = []
+    stop = asyncio.Event()
+    prober = asyncio.create_task(probe(lags, stop))
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def ingest_one():
+        async with semaphore:
+            payload = memoryview(upload)
+            if pool is None:
+                ingest.ingest_frame(payload, args.format, None, None)
+                # Lets the others in, like awaiting the next message would.
+                await asyncio.sleep(0)
+            else:
+                await pool.run(ingest.ingest_frame, payload, args.format, None, None)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(ingest_one() for _ in range(args.uploads)))
+    duration = time.perf_counter() - start
+    stop.set()
+    await prober
+
+    ms = [lag * 1000 for lag in lags]
+    return {
+        "uploads/s": args.uploads / duration,
+        "lag mean": statistics.mean(ms),
+        "lag p50": percentile(ms, 50),
+        "lag p99": percentile(ms, 99),
+        "lag max": max(ms),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--image-size", default="4000x3000")
+    parser.add_argument("--format", default="jpeg", choices=("jpeg", "png", "webp"))
+    parser.add_argument("--threads", type=int, default=config.INGEST_THREADS)
+    args = parser.parse_args()
+
+    width, height = map(int, args.image_size.lower().split("x"))
+    upload = make_upload(width, height, args.format)
+    print(f"{args.uploads} uploads of {width}x{height} {args.format} ({len(upload) / 1024 ** 2:.1f} MiB), "
+          f"{args.concurrency} at a time")
+
+    pool = ingest.Ingest(args.threads, config.INGEST_MAX_PENDING)
+    for name, p in (("event loop", None), (f"{args.threads} threads", pool)):
+        r = asyncio.run(bench(p, upload, args))
+        print(f"{name:<12} {r['uploads/s']:7.2f} uploads/s  lag mean {r['lag mean']:8.2f} ms  "
+              f"p50 {r['lag p50']:8.2f} ms  p99 {r['lag p99']:8.2f} ms  max {r['lag max']:8.2f} ms")
+    pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Logging overhead of the worker processes: every process writing to the console and the log file itself
+(like the server used to) vs sending its records to the listener of logs.py, as text, as JSON and sampled.
+
+--processes processes log the records of --works works each like workers do (start, 3 progress steps, result).
+Reports the time the logging calls take in the processes, per record, and the time until everything is written.
+The console output goes to os.devnull, the file to a temporary directory.
+
+    python bench_logging.py [--processes 8] [--works 2000]
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import config
+import logs
+
+
+SETUPS = ("direct", "listener", "listener json", "listener sampled")
+
+
+def _configure_direct(path: str):
+    # What every process did before logs.py.
+    root = logging.getLogger()
+    formatter = logging.Formatter(logs.TEXT_FORMAT)
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(formatter)
+    console.addFilter(lambda record: record.levelno <= logging.INFO)
+    root.addHandler(console)
+    console_err = logging.StreamHandler(sys.stderr)
+    console_err.setFormatter(formatter)
+    console_err.setLevel(logging.WARNING)
+    root.addHandler(console_err)
+    file = logging.FileHandler(path)
+    file.setFormatter(formatter)
+    root.addHandler(file)
+    root.setLevel(logging.INFO)
+
+
+def _emit(index: int, works: int, setup: str, path: str, conn, results):
+    sys.stdout = sys.stderr = open(os.devnull, "w")
+    if conn is None:
+        _configure_direct(path)
+    else:
+        logs.configure_process(conn, sampling=config.LOG_SAMPLING if setup == "listener sampled" else {})
+    logger = logging.getLogger(f"Worker {index}")
+
+    elapsed = 0.0
+    for i in range(works):
+        uid = index * works + i
+        start = time.perf_counter()
+        logger.info(f"Starting generation {uid}: model opt2.7b, prompt 'Question: What is this? Answer:', "
+                    f"image size (224, 224), args {{}}, idle gap 0.1 ms", extra={"stage": "start", "uid": uid})
+        for step in range(3):
+            logger.info(f"Generation {uid} progress: {step + 1}", extra={"stage": "progress", "uid": uid})
+        logger.info(f"Generation {uid} completed: ['a dog on a beach']", extra={"stage": "result", "uid": uid})
+        elapsed += time.perf_counter() - start
+    results.put(elapsed / (works * 5))
+
+
+def run(setup: str, processes: int, works: int, directory: str) -> dict:
+    path = os.path.join(directory, setup.replace(" ", "_") + ".log")
+    listener = None
+    if setup != "direct":
+        devnull = open(os.devnull, "w")
+        listener = logs.Listener(path, setup == "listener json", devnull, devnull)
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    procs = []
+    for i in range(processes):
+        conn = listener.connect() if listener is not None else None
+        procs.append(context.Process(target=_emit, args=(i, works, setup, path, conn, results)))
+        procs[-1].start()
+        if conn is not None:
+            # Only the process holds it now, the listener sees its end when it exits.
+            conn.close()
+    per_record = [results.get() for _ in procs]
+    # Until the processes exited (they flush their records then) and everything is written.
+    start = time.perf_counter()
+    for proc in procs:
+        proc.join()
+    if listener is not None:
+        listener.close()
+    drain = time.perf_counter() - start
+    with open(path, encoding="utf-8") as f:
+        lines = sum(1 for _ in f)
+    return {"per_record": statistics.mean(per_record), "drain": drain, "lines": lines}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--works", type=int, default=2000, help="Works logged by every process.")
+    args = parser.parse_args()
+
+    print(f"{args.processes} processes, {args.works * 5} records each")
+    print(f"{'setup':<18} {'per record':>11} {'drain':>8} {'lines':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        for setup in SETUPS:
+            r = run(setup, args.processes, args.works, directory)
+            print(f"{setup:<18} {r['per_record'] * 1e6:8.1f} us {r['drain']:7.2f}s {r['lines']:8d}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Speedup and acceptance rate of speculative decoding (see speculative.py) on CPU, with small OPT checkpoints:
+the model decodes the samples greedily with transformers, then with the draft proposing --draft-tokens tokens at a time,
+with the query embeddings projected to the draft (see speculative.fit_projection()) and with a draft that only sees
+the prompt.
+Beam search is timed too, it's what requests get by default.
+
+Text-only OPTs have no Q-Former, the model's embeddings of a description of the image stand in for the projected
+query embeddings, which live in the same space.
+
+    python bench_speculative.py [--model facebook/opt-350m] [--draft facebook/opt-125m] [--draft-tokens 2 4 6]
+                                [--max-length 30] [--beams 5] [--threads 8]
+"""
+import argparse
+import statistics
+import time
+
+import torch
+from transformers import AutoTokenizer, OPTForCausalLM
+
+import speculative
+
+
+# (description of the image, prompt)
+SAMPLES = [
+    ("A brown dog catching a red frisbee in a park on a sunny day.", "Question: What is the dog doing? Answer:"),
+    ("Two children building a sandcastle on a beach, waves in the background.", "Question: Where are they? Answer:"),
+    ("A plate with a slice of pizza, a fork and a glass of water on a wooden table.", "a photo of"),
+    ("A man riding a bicycle down a city street next to a yellow taxi.", "Question: What is he riding? Answer:"),
+    ("A cat sleeping on a windowsill next to a potted plant.", "a picture of"),
+    ("A snowy mountain with skiers going down a slope under a blue sky.", "Question: What season is it? Answer:"),
+]
+
+
+class _PromptOnlyDraft(speculative.Draft):
+    """
+    A draft that doesn't see the image, what the projection is measured against.
+    """
+
+    def embed(self, query_embeds, input_ids):
+        return super().embed(None, input_ids)
+
+
+def embed_samples(model, tokenizer) -> list[tuple[torch.Tensor, torch.Tensor]]:
+    embed = model.get_input_embeddings()
+    samples = []
+    for description, prompt in SAMPLES:
+        with torch.no_grad():
+            query_embeds = embed(tokenizer(description, return_tensors="pt", add_special_tokens=False).input_ids)
+        samples.append((query_embeds, tokenizer(prompt, return_tensors="pt").input_ids))
+    return samples
+
+
+def generate(model, query_embeds, input_ids, max_length: int, num_beams: int) -> list[int]:
+    inputs_embeds = torch.cat([query_embeds, model.get_input_embeddings()(input_ids)], dim=1)
+    with torch.no_grad():
+        out = model.generate(
+            inputs_embeds=inputs_embeds, attention_mask=torch.ones(inputs_embeds.shape[:2], dtype=torch.long),
+            do_sample=False, num_beams=num_beams, max_new_tokens=max_length, min_length=1,
+            eos_token_id=model.config.eos_token_id, pad_token_id=model.config.pad_token_id,
+        )
+    # With only inputs_embeds given, generate() returns just the new tokens.
+    tokens = out[0].tolist()
+    if model.config.eos_token_id in tokens:
+        tokens = tokens[:tokens.index(model.config.eos_token_id) + 1]
+    return tokens
+
+
+def timed(func, samples) -> tuple[list, list[float]]:
+    outputs, times = [], []
+    for query_embeds, input_ids in samples:
+        start = time.perf_counter()
+        outputs.append(func(query_embeds, input_ids))
+        times.append(time.perf_counter() - start)
+    return outputs, times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="facebook/opt-350m")
+    parser.add_argument("--draft", default="facebook/opt-125m")
+    parser.add_argument("--draft-tokens", type=int, nargs="+", default=[2, 4, 6])
+    parser.add_argument("--max-length", type=int, default=30)
+    parser.add_argument("--beams", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = OPTForCausalLM.from_pretrained(args.model, torch_dtype=torch.float32).eval()
+    draft_model = OPTForCausalLM.from_pretrained(args.draft, torch_dtype=torch.float32).eval()
+    samples = embed_samples(model, tokenizer)
+
+    started_at = time.perf_counter()
+    projection = speculative.fit_projection(
+        model.get_input_embeddings().weight, draft_model.get_input_embeddings().weight
+    )
+    print(f"{args.model} with draft {args.draft}, {len(samples)} samples, {args.threads} threads, "
+          f"projection fitted in {time.perf_counter() - started_at:.2f}s")
+
+    # Warm up, the first run allocates and initializes a lot.
+    generate(model, *samples[0], args.max_length, 1)
+
+    reference, times = timed(lambda q, i: generate(model, q, i, args.max_length, 1), samples)
+    reference_time = statistics.mean(times)
+    print(f"{'decoding':<28} {'mean':>9} {'tokens/s':>9} {'speedup':>8} {'accepted':>9} {'exact':>6}")
+
+    def report(name: str, outputs, times, acceptance: str = ""):
+        tokens = sum(len(o) for o in outputs)
+        exact = sum(o == r for o, r in zip(outputs, reference)) / len(samples)
+        print(f"{name:<28} {statistics.mean(times):8.3f}s {tokens / sum(times):9.1f} "
+              f"{reference_time / statistics.mean(times):7.2f}x {acceptance:>9} {exact:6.0%}")
+
+    report("greedy", reference, times)
+    if args.beams > 1:
+        report(f"beam search ({args.beams})",
+               *timed(lambda q, i: generate(model, q, i, args.max_length, args.beams), samples))
+
+    for k in args.draft_tokens:
+        for name, draft in (("projected", speculative.Draft(draft_model, projection)),
+                            ("prompt only", _PromptOnlyDraft(draft_model))):
+            def run(query_embeds, input_ids):
+                return speculative.generate(model, draft, query_embeds, input_ids, model.config.eos_token_id,
+                                            args.max_length, 1, num_draft_tokens=k)
+
+            outputs, times = timed(run, samples)
+            proposed, accepted = draft.drain_counts()
+            report(f"speculative k={k} {name}", outputs, times, f"{accepted / max(proposed, 1):.0%}")
+    for (description, prompt), tokens in zip(SAMPLES, reference):
+        print(f"    {prompt!r}: {tokenizer.decode(tokens, skip_special_tokens=True).strip()!r}")
+
+
+if __name__ == '__main__':
+    main()
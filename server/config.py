@@ -1,10 +1,175 @@
+import logging
+
 from torch import device
 
 
+# Devices of the local workers. Every device runs between MIN_WORKERS_PER_DEVICE and MAX_WORKERS_PER_DEVICE
+# worker processes, fewer on CUDA devices whose memory budget doesn't fit that many.
 WORKERS = (
     *(f"cuda:{i}" for i in range(0, 9)),
     # "cpu",
 )
+MIN_WORKERS_PER_DEVICE = 1
+MAX_WORKERS_PER_DEVICE = 4
+# Fraction of a CUDA device's memory its workers may take, and memory one worker takes (default variant weights,
+# decode batches, caches), in bytes. CPU workers use the shared weights in place, MAX_WORKERS_PER_DEVICE bounds them.
+DEVICE_MEMORY_BUDGET = 0.9
+WORKER_DEVICE_MEMORY = 16 * 1024 ** 3
+# The pool starts a worker when works are queued and their estimated wait (see WorkerPool.estimated_wait())
+# exceeds SCALE_UP_WAIT seconds, one at a time, on the device with the most room. It retires a worker idle for
+# SCALE_DOWN_IDLE seconds when nothing is queued. At most one change every SCALE_INTERVAL seconds.
+SCALE_UP_WAIT = 5.0
+SCALE_DOWN_IDLE = 60.0
+SCALE_INTERVAL = 10.0
+# Crashed workers are restarted after WORKER_RESTART_DELAY seconds, doubled for every crash of a worker that didn't
+# finish loading, up to WORKER_MAX_RESTART_DELAY. Their works are requeued, works that were running when their
+# worker crashed MAX_WORK_CRASHES times fail instead.
+WORKER_RESTART_DELAY = 1.0
+WORKER_MAX_RESTART_DELAY = 60.0
+MAX_WORK_CRASHES = 2
+
+# Model variants clients can pick with the "model" argument of their submissions, by name:
+# (LAVIS model name, model type). The model name is one of model_api.MODEL_CLASSES.
+MODELS = {
+    "opt2.7b": ("blip2_opt", "pretrain_opt2.7b"),
+    "opt6.7b": ("blip2_opt", "pretrain_opt6.7b"),
+    "flant5xl": ("blip2_t5", "pretrain_flant5xl"),
+    "flant5xxl": ("blip2_t5", "pretrain_flant5xxl"),
+}
+# The variant of the submissions without a "model", loaded by every worker on start.
+# Workers load the others the first time they get one of their works (see model_api.ModelRegistry).
+DEFAULT_MODEL = "opt2.7b"
+# Fraction of a CUDA device's memory the weights of the resident variants take at most, split evenly between the
+# workers it can hold. Loading another variant offloads the least recently used idle ones of the worker to CPU RAM,
+# from where they're copied back quickly. None never evicts.
+MODEL_DEVICE_MEMORY = 0.6
+# CPU RAM taken by the offloaded variants of a worker (besides the shared weights), in bytes.
+# The least recently used ones beyond that are dropped and loaded from disk again when needed.
+MODEL_HOST_MEMORY = 32 * 1024 ** 3
+
+# Decode requests of a worker together in one batch (see batching.BatchEngine).
+BATCHING = True
+# Maximum number of rows (beams or sampled captions) in a worker's decode batch.
+MAX_BATCH_SIZE = 16
+# Maximum number of works handed to one worker at a time when batching.
+MAX_CONCURRENT_WORKS = 8
+
+# Memory limit (in bytes) of each worker's image embedding cache, 0 disables it.
+EMBEDDING_CACHE_BYTES = 256 * 1024 ** 2
+
+# Seconds between two WorkerPool updates, None dispatches as soon as a worker pipe is readable.
+DISPATCH_POLL_INTERVAL = None
+
+# Hand images to workers through shared memory slots instead of pickling them through the pipe.
+SHARED_MEMORY_IMAGES = True
+
+# Minimum seconds between two partial texts sent for a streaming work.
+STREAM_INTERVAL = 0.1
+
+# Queue length and position notifications are batched and sent at most this often (seconds).
+QUEUE_NOTIFY_INTERVAL = 0.2
+
+# Work queue policy, one of scheduling.SCHEDULERS:
+# "fifo", "drr" (fair between clients, weighted by estimated cost) or "sjf" (shortest job first).
+SCHEDULER = "drr"
+
+# Works handed to a worker ahead of time, on top of the ones it runs, when no worker has room to start them.
+# They're loaded and preprocessed on a background thread while the model is busy.
+WORKER_QUEUE_DEPTH = 2
+
+# Load the default variant once in the main process and share its weights with the workers through shared memory.
+# CPU workers use them in place, other workers only copy them to their device.
+SHARED_WEIGHTS = True
+
+# Logging (see logs.py): every process sends its records to a thread of the main process, which writes them in batches
+# to stdout, stderr and LOG_PATH (None writes no file), as text lines or as JSON objects with LOG_JSON.
+LOG_PATH = "latest.log"
+LOG_LEVEL = logging.INFO
+LOG_JSON = False
+# Fraction of the works whose records of a stage are kept, by stage: "submit" and "dispatch" in the server,
+# "start", "progress" and "result" in the workers. The other stages and the records of no stage are all kept.
+LOG_SAMPLING = {"submit": 0.1, "dispatch": 0.1, "progress": 0.1}
+
+# Seconds between two metrics reports of a worker (stage timings, tokens, busy time).
+METRICS_INTERVAL = 1.0
+# Address of the Prometheus endpoint (http://host:port/metrics), a port of None disables it.
+# The same metrics are available to WebSocket clients with the "stats" event.
+METRICS_HOST = "localhost"
+METRICS_PORT = 9101
+
+# Append a JSON line per submitted work (time, client, image hash and size, args) to this file,
+# to replay the traffic with load_test.py. None disables it.
+TRACE_PATH = None
+
+# Results of deterministic (beam search or greedy) works are cached by image, prompt and args:
+# at most this many results, for at most RESULT_CACHE_TTL seconds. 0 disables the cache.
+# Identical works submitted while one is queued or running share it either way.
+RESULT_CACHE_SIZE = 4096
+RESULT_CACHE_TTL = 3600.0
+
+# Address remote worker agents (worker_agent.py) connect to, a port of None disables remote workers.
+REMOTE_WORKERS_HOST = "localhost"
+REMOTE_WORKERS_PORT = 9102
+# Secret agents have to register with (worker_agent.py --token), None accepts any agent.
+REMOTE_WORKERS_TOKEN = None
+# Encoding of the images sent to remote workers: "png" (lossless), "webp" or "jpeg".
+REMOTE_IMAGE_FORMAT = "png"
+# Seconds between two heartbeats, and without any message after which the other side counts as lost.
+REMOTE_HEARTBEAT_INTERVAL = 2.0
+REMOTE_HEARTBEAT_TIMEOUT = 10.0
+# Seconds an agent waits before reconnecting to a lost dispatcher.
+REMOTE_RECONNECT_DELAY = 2.0
+
+# Speculative decoding, for works with "speculative": true in their args: a small OPT sharing the tokenizer of the
+# OPT variants proposes DRAFT_TOKENS tokens at a time, which the model verifies in one pass (see speculative.py).
+# Greedy output, beams are ignored. The draft is loaded by a worker's first such work, on top of MODEL_DEVICE_MEMORY.
+# They decode outside the batch engine, which runs a step of its batch between two of their rounds.
+# None disables it, the works then decode as usual. Compare with bench_speculative.py.
+DRAFT_MODEL = "facebook/opt-125m"
+DRAFT_TOKENS = 4
+
+# CPU workers: int8 dynamic quantization of the OPT decoder and Q-Former linear layers,
+# and a bfloat16 vision encoder on CPUs that support it. Compare with bench_cpu.py.
+# The quantized layers are private to each worker (prepacked for the CPU), so with SHARED_WEIGHTS every CPU worker
+# would hold its own copy of them next to the shared weights. Off by default then.
+CPU_QUANTIZE = not SHARED_WEIGHTS
+CPU_BF16 = True
+# Torch threads of each CPU worker, None splits the cores evenly between the most CPU workers WORKERS can run.
+CPU_THREADS = None
+
+# Multi-turn sessions: every batching worker keeps the decoder state (past key values) of the image and the
+# earlier turns of its sessions, so a follow-up only prefills its new tokens. Up to SESSION_CACHE_BYTES of
+# key/value tensors per worker, least recently used first out, and sessions idle for SESSION_IDLE_TIMEOUT seconds
+# are dropped. A follow-up landing on a worker without its state prefills the whole conversation again.
+SESSION_CACHE_BYTES = 1024 ** 3
+SESSION_IDLE_TIMEOUT = 600.0
+
+# Admission control (see admission.py), None disables a limit.
+# Works waiting in the pool queue, and unfinished works (queued or running) of one client.
+MAX_QUEUE_DEPTH = 256
+MAX_CLIENT_WORKS = 16
+# Largest image accepted, in pixels (width times height). Checked before decoding it.
+MAX_IMAGE_PIXELS = 4096 * 4096
+# Largest values accepted of the generate arguments the cost of a work grows with (see scheduling.estimate_cost()).
+GENERATE_ARG_LIMITS = {"max_length": 256, "num_beams": 10, "num_captions": 10}
+# Submissions are rejected when they would wait longer than this (seconds), estimated from the recent service
+# times of the workers. Rejections hint how long to wait before retrying, DEFAULT_RETRY_AFTER when there is no estimate.
+MAX_ESTIMATED_WAIT = 120.0
+DEFAULT_RETRY_AFTER = 10.0
+# Queued works keep their images PNG compressed (lossless) once the decoded images of the queue
+# take more than this many bytes.
+QUEUED_IMAGES_MEMORY = 512 * 1024 ** 2
+
+# Threads decoding, validating, resizing and hashing the uploaded images off the event loop (see ingest.py),
+# and images being ingested or waiting for a thread at most. Submissions beyond that wait, holding up their connection.
+INGEST_THREADS = 4
+INGEST_MAX_PENDING = 16
+# Uploaded images are resized to this square size, the input resolution of the model's vision processor
+# (224 for the BLIP-2 OPT models), which resizes to it the same way first. None keeps them as they are.
+INGEST_IMAGE_SIZE = 224
 
-MODEL_NAME = "blip2_opt"
-MODEL_TYPE = "pretrain_opt2.7b"
+# Messages queued per client beyond which the oldest progress and queue updates are dropped (see outbound.py),
+# results and errors are always kept.
+OUTBOX_SIZE = 64
+# Negotiate permessage-deflate with clients that support it: smaller messages, for some CPU on the event loop.
+WEBSOCKET_COMPRESSION = True
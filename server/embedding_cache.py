@@ -0,0 +1,69 @@
+import collections
+
+import torch
+
+
+class EmbeddingCache:
+    """
+    LRU cache of projected image embeddings (the language model input of the Q-Former output),
+    keyed by cache_key() of the variant and image hash.
+    The memory limit is counted in tensor bytes, so it applies to whichever device the tensors live on.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: collections.OrderedDict[str, torch.Tensor] = collections.OrderedDict()
+        self._bytes = 0
+        self._added = []
+        self._evicted = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: str):
+        return key in self._entries
+
+    @property
+    def bytes(self) -> int:
+        return self._bytes
+
+    def get(self, key: str) -> torch.Tensor | None:
+        embeds = self._entries.get(key)
+        if embeds is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return embeds
+
+    def put(self, key: str, embeds: torch.Tensor):
+        size = embeds.element_size() * embeds.nelement()
+        if key in self._entries or size > self.max_bytes:
+            return
+
+        while self._bytes + size > self.max_bytes:
+            old_key, old = self._entries.popitem(last=False)
+            self._bytes -= old.element_size() * old.nelement()
+            self._evicted.append(old_key)
+
+        self._entries[key] = embeds
+        self._bytes += size
+        self._added.append(key)
+
+    def drain_changes(self) -> tuple[list[str], list[str]]:
+        """
+        Returns the keys added and evicted since the last call, so another process can mirror the contents.
+        """
+        added, evicted = self._added, self._evicted
+        self._added, self._evicted = [], []
+        return added, evicted
+
+
+def cache_key(model: str, image_hash: str) -> str:
+    """
+    Key of an image's embeddings, which depend on the model variant (see config.MODELS) as well.
+    """
+    return f"{model}/{image_hash}"
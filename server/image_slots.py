@@ -0,0 +1,92 @@
+import typing
+from multiprocessing.shared_memory import SharedMemory
+
+from PIL import Image
+
+
+MIN_SLOT_BYTES = 1024 ** 2
+
+
+class ImageHandle(typing.NamedTuple):
+    slot: int
+    name: str
+    mode: str
+    size: tuple[int, int]
+    nbytes: int
+
+
+class ImageSlotPool:
+    """
+    A fixed number of shared memory slots owned by the main process, each holding the pixels of one image.
+    Images are written once into a free slot and only the small ImageHandle goes through the worker pipe.
+    A slot is reallocated when an image doesn't fit in it.
+    """
+
+    def __init__(self, num_slots: int):
+        self._slots: list[SharedMemory | None] = [None] * num_slots
+        self._free = list(range(num_slots))
+
+    @property
+    def free_slots(self) -> int:
+        return len(self._free)
+
+    def put(self, image: Image.Image) -> ImageHandle | None:
+        """
+        Returns None when all slots are in use.
+        """
+        if not self._free:
+            return None
+
+        data = image.tobytes()
+        slot = self._free.pop()
+        shm = self._slots[slot]
+        if shm is None or shm.size < len(data):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            shm = SharedMemory(create=True, size=max(len(data), MIN_SLOT_BYTES))
+            self._slots[slot] = shm
+        shm.buf[:len(data)] = data
+        return ImageHandle(slot, shm.name, image.mode, image.size, len(data))
+
+    def release(self, handle: ImageHandle):
+        self._free.append(handle.slot)
+
+    def close(self):
+        for shm in self._slots:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self._slots = [None] * len(self._slots)
+        self._free = list(range(len(self._slots)))
+
+
+def _attach(name: str) -> SharedMemory:
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the segment with the resource tracker again. Spawned workers
+        # share the main process' tracker, so that's a no-op, but unregistering here would also drop the
+        # main process' registration, and its unlink later fails in the tracker.
+        return SharedMemory(name=name)
+
+
+class ImageSlotReader:
+    """
+    Worker side of an ImageSlotPool, keeps the slots it has seen attached.
+    """
+
+    def __init__(self):
+        self._attached: dict[int, SharedMemory] = {}
+
+    def load(self, handle: ImageHandle) -> Image.Image:
+        shm = self._attached.get(handle.slot)
+        if shm is None or shm.name != handle.name:
+            if shm is not None:
+                shm.close()
+            shm = _attach(handle.name)
+            self._attached[handle.slot] = shm
+
+        # frombytes copies the pixels, so the slot can be reused as soon as this returns.
+        with shm.buf[:handle.nbytes] as view:
+            return Image.frombytes(handle.mode, handle.size, view)
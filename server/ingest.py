@@ -0,0 +1,112 @@
+"""
+Ingest stage of the submissions: decodes, validates, resizes and hashes their images on a thread pool,
+so large uploads don't stall the event loop. Pillow and hashlib release the GIL while they work on the pixels.
+"""
+import asyncio
+import base64
+import binascii
+import concurrent.futures
+import time
+import typing
+
+import PIL
+from PIL import Image
+
+import admission
+import config
+import metrics
+import protocol
+import utils
+
+
+# Pillow refuses to open images declaring more than twice as many pixels (DecompressionBombError),
+# before _check_size() sees them.
+Image.MAX_IMAGE_PIXELS = config.MAX_IMAGE_PIXELS
+
+
+class IngestError(Exception):
+    def __init__(self, cause: str, extra_data: dict = None):
+        self.cause = cause
+        self.extra_data = extra_data or {}
+
+
+class Ingested(typing.NamedTuple):
+    image: Image.Image
+    image_hash: str
+
+
+def _check_size(width: int, height: int):
+    rejection = admission.check_image_size(width, height)
+    if rejection is not None:
+        raise IngestError(rejection.cause, rejection.extra_data())
+
+
+def _finish(image: Image.Image) -> Ingested:
+    image = image.convert("RGB")
+    size = config.INGEST_IMAGE_SIZE
+    if size is not None and image.size != (size, size):
+        # What the model's vision processor does first, doing it here only shrinks what the server holds.
+        image = image.resize((size, size), Image.Resampling.BICUBIC)
+    return Ingested(image, utils.image_hash(image))
+
+
+def ingest_base64(data: str, width: int, height: int) -> Ingested:
+    """
+    An image sent as base64 RGBA pixels in a text message.
+    """
+    _check_size(width, height)
+    try:
+        image = Image.frombytes("RGBA", (width, height), base64.b64decode(data, validate=True))
+        return _finish(image)
+    except (binascii.Error, ValueError, PIL.UnidentifiedImageError) as e:
+        raise IngestError(f"Failed to load image: {e}")
+
+
+def ingest_frame(payload: memoryview, image_format: str, width: int | None, height: int | None) -> Ingested:
+    """
+    An image sent as the payload of a binary frame, see protocol.py.
+    """
+    try:
+        pil_format = protocol.IMAGE_FORMATS[image_format]
+        if pil_format is None:
+            if type(width) is not int or type(height) is not int:
+                raise ValueError("Raw images need an integer image_width and image_height.")
+            _check_size(width, height)
+            image = Image.frombuffer("RGB", (width, height), payload, "raw", "RGB", 0, 1)
+        else:
+            # Only reads the header, the pixels are decoded by convert().
+            image = Image.open(protocol.MemoryViewReader(payload), formats=(pil_format,))
+            _check_size(*image.size)
+        return _finish(image)
+    except (ValueError, OSError, PIL.UnidentifiedImageError, Image.DecompressionBombError) as e:
+        raise IngestError(f"Failed to load image: {e}")
+
+
+def _timed(func, *args) -> Ingested:
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        metrics.INGEST.observe(time.perf_counter() - start)
+
+
+class Ingest:
+    """
+    Runs ingest_base64() and ingest_frame() on max_workers threads.
+    At most max_pending images are ingested or waiting for a thread, further submissions wait for their turn.
+    As a connection's messages are handled one at a time, its reader waits meanwhile.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix="Ingest")
+        self._pending = asyncio.Semaphore(max_pending)
+
+    async def run(self, func, *args) -> Ingested:
+        """
+        Raises IngestError if the image is invalid or rejected.
+        """
+        async with self._pending:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, _timed, func, *args)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,318 @@
+"""
+Headless load generator for server.py: simulates concurrent WebSocket clients and reports throughput,
+end-to-end latency and time to first progress.
+
+Start a server first, with DummyModel workers:
+    BTLP2_DEBUGGING=1 python server.py
+or with CPU workers (WORKERS = ("cpu",) in config.py).
+
+Synthetic load, every client keeps --concurrency requests in flight:
+    python load_test.py [--clients 8] [--requests 20] [--concurrency 1] [--image-size 224x224 ...]
+                        [--format jpeg] [--args '{"num_beams": 1}'] [--stream] [--model opt2.7b ...]
+Replay of a trace recorded by the server (config.TRACE_PATH), with its arrival times:
+    python load_test.py --replay trace.jsonl [--speed 2]
+
+--output writes the result of every request as a JSON line, to compare runs.
+"""
+import argparse
+import asyncio
+import base64
+import collections
+import io
+import itertools
+import json
+import random
+import statistics
+import time
+import typing
+
+from PIL import Image
+import websockets
+
+import protocol
+import request_trace
+
+
+PROMPTS = (
+    "Question: What is in this picture? Answer:",
+    "Question: What color is the sky? Answer:",
+    "Describe the image in detail.",
+    "a photo of",
+)
+
+
+class Request(typing.NamedTuple):
+    client: int
+    # Seconds after the start of the run to send it at, None sends it as soon as the client has room.
+    at: float | None
+    prompt: str
+    image_size: tuple[int, int]
+    # Requests with the same image seed send the same image.
+    image_seed: int
+    args: dict
+    stream: bool
+
+
+class Result:
+    def __init__(self, request: Request, request_id: int):
+        self.request = request
+        self.request_id = request_id
+        self.sent: float | None = None
+        self.first_progress: float | None = None
+        self.first_partial: float | None = None
+        self.done: float | None = None
+        self.failed: str | None = None
+
+    def to_json(self) -> dict:
+        return {
+            "client": self.request.client,
+            "id": self.request_id,
+            "at": self.request.at,
+            "args": self.request.args,
+            "sent": self.sent,
+            "first_progress": self.first_progress,
+            "first_partial": self.first_partial,
+            "done": self.done,
+            "failed": self.failed,
+        }
+
+
+class _Images:
+    """
+    Encodes every distinct image once, before the run, so encoding doesn't slow down the clients.
+    """
+
+    def __init__(self, image_format: str):
+        self.image_format = image_format
+        self._encoded = {}
+
+    def prepare(self, requests: list[Request]):
+        for r in requests:
+            key = (r.image_size, r.image_seed)
+            if key not in self._encoded:
+                self._encoded[key] = self._encode(self._image(r.image_size, r.image_seed))
+
+    @staticmethod
+    def _image(size: tuple[int, int], seed: int) -> Image.Image:
+        return Image.frombytes("RGB", size, random.Random(seed).randbytes(size[0] * size[1] * 3))
+
+    def _encode(self, image: Image.Image):
+        if self.image_format == "base64":
+            return base64.b64encode(image.convert("RGBA").tobytes()).decode()
+        if self.image_format == "rgb":
+            return image.tobytes()
+        buffer = io.BytesIO()
+        image.save(buffer, format=protocol.IMAGE_FORMATS[self.image_format])
+        return buffer.getvalue()
+
+    def submit_message(self, request: Request, request_id: int) -> str | bytes:
+        encoded = self._encoded[(request.image_size, request.image_seed)]
+        data = {"id": request_id, "prompt": request.prompt, "args": request.args, "stream": request.stream}
+        if self.image_format in ("base64", "rgb"):
+            data["image_width"], data["image_height"] = request.image_size
+        if self.image_format == "base64":
+            data["image"] = encoded
+            return json.dumps({"event": "submit", "data": data})
+        data["format"] = self.image_format
+        return protocol.build_frame({"event": "submit", "data": data}, encoded)
+
+
+async def _run_client(url: str, requests: list[Request], concurrency: int, images: _Images, start: float,
+                      results: list[Result]):
+    request_ids = itertools.count()
+    in_flight: dict[int, tuple[Result, asyncio.Future]] = {}
+    slots = asyncio.Semaphore(concurrency)
+
+    async with websockets.connect(url, max_size=None) as conn:
+        async def receive():
+            try:
+                async for raw in conn:
+                    handle(json.loads(raw))
+            except websockets.ConnectionClosed:
+                pass
+            for result, future in in_flight.values():
+                result.failed = "Connection closed."
+                future.set_result(None)
+            in_flight.clear()
+
+        def handle(msg: dict):
+            data = msg.get("data", {})
+            entry = in_flight.get(data.get("id"))
+            if entry is None:
+                return
+            result, future = entry
+            now = time.perf_counter() - start
+            event = msg.get("event")
+            if event == "progress" and result.first_progress is None:
+                result.first_progress = now
+            elif event == "partial" and result.first_partial is None:
+                result.first_partial = now
+            elif event in ("result", "submit_fail"):
+                result.done = now
+                if event == "submit_fail":
+                    result.failed = data.get("cause", "")
+                del in_flight[result.request_id]
+                future.set_result(None)
+
+        async def send(request: Request):
+            result = Result(request, next(request_ids))
+            results.append(result)
+            future = asyncio.get_running_loop().create_future()
+            in_flight[result.request_id] = (result, future)
+            message = images.submit_message(request, result.request_id)
+            result.sent = time.perf_counter() - start
+            try:
+                await conn.send(message)
+            except websockets.ConnectionClosed:
+                if in_flight.pop(result.request_id, None) is not None:
+                    result.failed = "Connection closed."
+                    future.set_result(None)
+            await future
+
+        async def send_when_due(request: Request):
+            try:
+                await send(request)
+            finally:
+                slots.release()
+
+        receiver = asyncio.create_task(receive())
+        try:
+            tasks = []
+            for request in requests:
+                if request.at is not None:
+                    await asyncio.sleep(request.at - (time.perf_counter() - start))
+                    tasks.append(asyncio.create_task(send(request)))
+                else:
+                    await slots.acquire()
+                    tasks.append(asyncio.create_task(send_when_due(request)))
+            await asyncio.gather(*tasks)
+        finally:
+            receiver.cancel()
+
+
+async def run(url: str, requests: list[Request], concurrency: int, images: _Images) -> tuple[list[Result], float]:
+    by_client: dict[int, list[Request]] = {}
+    for r in requests:
+        by_client.setdefault(r.client, []).append(r)
+
+    results = []
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        _run_client(url, client_requests, concurrency, images, start, results)
+        for client_requests in by_client.values()
+    ))
+    return results, time.perf_counter() - start
+
+
+def synthetic_requests(args) -> list[Request]:
+    rng = random.Random(args.seed)
+    requests = []
+    for client in range(args.clients):
+        for _ in range(args.requests):
+            # Images repeat with probability --repeat-images, to exercise the embedding cache.
+            if requests and rng.random() < args.repeat_images:
+                earlier = rng.choice(requests)
+                image_size, image_seed = earlier.image_size, earlier.image_seed
+            else:
+                image_size, image_seed = rng.choice(args.image_size), len(requests)
+            request_args = args.args
+            if args.model:
+                request_args = {**args.args, "model": rng.choice(args.model)}
+            requests.append(Request(
+                client, None, rng.choice(PROMPTS), image_size, image_seed, request_args, args.stream
+            ))
+    return requests
+
+
+def trace_requests(path: str, speed: float) -> list[Request]:
+    records = request_trace.load_trace(path)
+    if not records:
+        return []
+    first = min(r["time"] for r in records)
+    seeds = {}
+    requests = []
+    for r in sorted(records, key=lambda r: r["time"]):
+        requests.append(Request(
+            r["client"],
+            (r["time"] - first) / speed,
+            "x" * r.get("prompt_length", 10),
+            tuple(r["image_size"]),
+            seeds.setdefault(r["image_hash"], len(seeds)),
+            {**r["args"], "model": r["model"]} if "model" in r else r["args"],
+            r.get("stream", False),
+        ))
+    return requests
+
+
+def percentile(values, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(results: list[Result], duration: float):
+    completed = [r for r in results if r.done is not None and r.failed is None]
+    failed = [r for r in results if r.failed is not None]
+    print(f"{len(completed)} completed, {len(failed)} failed in {duration:.2f}s: "
+          f"{len(completed) / duration:.2f} requests/s")
+    for name, values in (
+        ("end to end", [r.done - r.sent for r in completed]),
+        ("first progress", [r.first_progress - r.sent for r in completed if r.first_progress is not None]),
+        ("first partial", [r.first_partial - r.sent for r in completed if r.first_partial is not None]),
+    ):
+        if not values:
+            continue
+        ms = [v * 1000 for v in values]
+        print(f"{name:<15} "
+              f"mean {statistics.mean(ms):9.2f} ms  "
+              f"p50 {percentile(ms, 50):9.2f} ms  "
+              f"p99 {percentile(ms, 99):9.2f} ms")
+    for cause, count in collections.Counter(r.failed for r in failed).most_common():
+        print(f"failed {count}x: {cause}")
+
+
+def _image_size(value: str) -> tuple[int, int]:
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="ws://localhost:8001")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=20, help="Requests per client.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Requests in flight per client.")
+    parser.add_argument("--image-size", type=_image_size, action="append",
+                        help="WIDTHxHEIGHT, given several times sizes are picked at random. Default 640x480.")
+    parser.add_argument("--repeat-images", type=float, default=0.0,
+                        help="Probability of a request reusing an earlier image.")
+    parser.add_argument("--format", choices=(*protocol.IMAGE_FORMATS, "base64"), default="jpeg",
+                        help="Image encoding, base64 uses the JSON submit message.")
+    parser.add_argument("--args", type=json.loads, default={}, help="Generate arguments, as JSON.")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--model", action="append",
+                        help="Model variant (see config.MODELS), given several times variants are picked at random.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replay", help="Trace recorded by the server to replay instead of the synthetic load.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed factor.")
+    parser.add_argument("--output", help="File to write the per request results to, as JSON lines.")
+    args = parser.parse_args()
+    args.image_size = args.image_size or [(640, 480)]
+
+    if args.replay:
+        requests = trace_requests(args.replay, args.speed)
+    else:
+        requests = synthetic_requests(args)
+
+    images = _Images(args.format)
+    images.prepare(requests)
+    results, duration = asyncio.run(run(args.url, requests, args.concurrency, images))
+    report(results, duration)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            for r in results:
+                f.write(json.dumps(r.to_json()) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""
+Logging of the server and of its worker processes through one writer.
+
+Logging calls only put the record in a queue of their process, a thread of the process sends the queued records
+through a pipe to the listener (see start() and connect()), a thread of the main process which writes them in batches:
+INFO to stdout, WARNING and above to stderr, all of them to config.LOG_PATH. Records of a work's stages can be sampled
+(see config.LOG_SAMPLING), as text lines or JSON objects (config.LOG_JSON).
+
+Log the stage of a record and its work's uid with extra={"stage": ..., "uid": ...}, they're JSON fields as well.
+Compare the setups with bench_logging.py.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import multiprocessing.connection
+import pickle
+import queue
+import random
+import sys
+import threading
+
+import config
+
+
+TEXT_FORMAT = "%(asctime)s [%(name)s %(levelname)s] %(message)s"
+# Records sent or written at once at most.
+BATCH_SIZE = 256
+# Seconds the listener waits on the pipes before picking up the ones connected meanwhile.
+_WAIT_TIMEOUT = 0.5
+
+# Attributes of every record, the others were given with extra.
+_RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps the records of a stage with the probability given by rates, all of a work's or none of them.
+    """
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(getattr(record, "stage", None), 1.0)
+        if rate >= 1.0:
+            return True
+        uid = getattr(record, "uid", None)
+        if uid is None:
+            return random.random() < rate
+        # Multiplicative hash, the same in every process.
+        return (uid * 2654435761 & 0xFFFFFFFF) / 2 ** 32 < rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((k, v) for k, v in record.__dict__.items() if k not in _RECORD_ATTRIBUTES)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class Listener:
+    """
+    Writes the records every connected process sends, in batches from a thread.
+    """
+
+    def __init__(self, path: str | None = config.LOG_PATH, json_format: bool = config.LOG_JSON,
+                 stdout=sys.stdout, stderr=sys.stderr):
+        self._formatter = JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT)
+        self._stdout = stdout
+        self._stderr = stderr
+        self._file = open(path, "a", encoding="utf-8") if path is not None else None
+        self._readers = []
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="Log listener", daemon=True)
+        self._thread.start()
+
+    def connect(self) -> multiprocessing.connection.Connection:
+        """
+        A pipe to send records through (see configure_process()), for this process or another one.
+        """
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        self._readers.append(reader)
+        return writer
+
+    def _run(self):
+        while True:
+            closing = self._closing.is_set()
+            if self._readers:
+                ready = multiprocessing.connection.wait(list(self._readers), _WAIT_TIMEOUT)
+            elif closing:
+                return
+            else:
+                ready = []
+                self._closing.wait(_WAIT_TIMEOUT)
+            if closing and not ready:
+                return
+            records = []
+            for reader in ready:
+                try:
+                    while reader.poll() and len(records) < BATCH_SIZE:
+                        batch = reader.recv()
+                        if batch is None:
+                            raise EOFError
+                        records += batch
+                except (EOFError, OSError):
+                    # The process is gone or done.
+                    self._readers.remove(reader)
+                    reader.close()
+            if records:
+                self._write(records)
+
+    def _write(self, records: list[logging.LogRecord]):
+        out, err = [], []
+        for record in records:
+            (err if record.levelno >= logging.WARNING else out).append(self._formatter.format(record))
+        for stream, lines in ((self._stdout, out), (self._stderr, err)):
+            if lines:
+                stream.write("\n".join(lines) + "\n")
+                stream.flush()
+        if self._file is not None:
+            self._file.write("\n".join(out + err) + "\n")
+            self._file.flush()
+
+    def close(self):
+        """
+        Writes what the connected processes send until they're quiet.
+        """
+        self._closing.set()
+        self._thread.join()
+        if self._file is not None:
+            self._file.close()
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Like QueueHandler.prepare() without copying the record, nothing else handles it.
+        record.msg = self.format(record)
+        record.message = record.msg
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+
+def _picklable(record: logging.LogRecord) -> logging.LogRecord:
+    for k, v in list(record.__dict__.items()):
+        if k not in _RECORD_ATTRIBUTES and not isinstance(v, (str, int, float, bool, type(None))):
+            setattr(record, k, repr(v))
+    return record
+
+
+class _Sender:
+    """
+    Thread sending the records of a process to the listener.
+    """
+
+    def __init__(self, conn: multiprocessing.connection.Connection):
+        self.queue = queue.SimpleQueue()
+        self._conn = conn
+        self._thread = threading.Thread(target=self._run, name="Log sender", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < BATCH_SIZE and not self.queue.empty():
+                records.append(self.queue.get_nowait())
+            done = None in records
+            records = [r for r in records if r is not None]
+            try:
+                if records:
+                    try:
+                        self._conn.send(records)
+                    except (TypeError, AttributeError, pickle.PicklingError):
+                        # Extra attributes of library records may not pickle, they're sent as text then.
+                        self._conn.send([_picklable(r) for r in records])
+                if done:
+                    self._conn.send(None)
+                    self._conn.close()
+                    return
+            except OSError:
+                return
+
+    def close(self):
+        self.queue.put(None)
+        self._thread.join()
+
+
+_listener: Listener | None = None
+
+
+def configure_process(conn: multiprocessing.connection.Connection, level=config.LOG_LEVEL,
+                      sampling: dict[str, float] = config.LOG_SAMPLING):
+    """
+    Routes the records of this process to the listener through conn (see Listener.connect()),
+    sampled by stage (see SamplingFilter).
+    """
+    sender = _Sender(conn)
+    handler = _QueueHandler(sender.queue)
+    handler.addFilter(SamplingFilter(sampling))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+    # Sends what's left when the process exits normally.
+    atexit.register(sender.close)
+
+
+def start(path: str | None = config.LOG_PATH, json_format: bool = config.LOG_JSON):
+    """
+    Starts the listener in this (main) process and routes this process's records to it.
+    """
+    global _listener
+    _listener = Listener(path, json_format)
+    # Before the sender's, so it closes last.
+    atexit.register(_listener.close)
+    configure_process(_listener.connect())
+
+
+def connect() -> multiprocessing.connection.Connection:
+    """
+    A pipe to the listener for a child process to pass to configure_process(), which the parent closes once the child
+    started. Starts the listener if needed, without routing this process's records to it then.
+    """
+    global _listener
+    if _listener is None:
+        _listener = Listener()
+        atexit.register(_listener.close)
+    return _listener.connect()
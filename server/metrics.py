@@ -0,0 +1,266 @@
+"""
+Process local metrics in the Prometheus text format.
+
+Workers don't touch these: they collect their timings locally and send them in MsgType.METRICS
+messages, which the main process applies here (see record_worker_report()).
+"""
+import asyncio
+import bisect
+import collections
+import logging
+import time
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    items = key + extra
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{name}{labels} {value:g}" for name, labels, value in self._samples()]
+        return "\n".join(lines)
+
+    def snapshot(self) -> dict:
+        return {_format_labels(key): value for key, value in self._values.items()}
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = _label_key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self):
+        for key, value in self._values.items():
+            yield self.name, _format_labels(key), value
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[_label_key(labels)] = value
+
+    def _samples(self):
+        for key, value in self._values.items():
+            yield self.name, _format_labels(key), value
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "sum", "count")
+
+    def __init__(self, num_buckets: int):
+        self.buckets = [0] * num_buckets
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.bucket_bounds = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        h = self._values.get(key)
+        if h is None:
+            h = self._values[key] = _HistogramValue(len(self.bucket_bounds))
+        i = bisect.bisect_left(self.bucket_bounds, value)
+        if i < len(h.buckets):
+            h.buckets[i] += 1
+        h.sum += value
+        h.count += 1
+
+    def _samples(self):
+        for key, h in self._values.items():
+            cumulative = 0
+            for bound, n in zip(self.bucket_bounds, h.buckets):
+                cumulative += n
+                yield f"{self.name}_bucket", _format_labels(key, (("le", f"{bound:g}"),)), cumulative
+            yield f"{self.name}_bucket", _format_labels(key, (("le", "+Inf"),)), h.count
+            yield f"{self.name}_sum", _format_labels(key), h.sum
+            yield f"{self.name}_count", _format_labels(key), h.count
+
+    def quantile(self, q: float, **labels) -> float | None:
+        """
+        Upper bound of the bucket the q-quantile falls in, inf past the last bucket.
+        """
+        h = self._values.get(_label_key(labels))
+        if h is None or h.count == 0:
+            return None
+        target = q * h.count
+        cumulative = 0
+        for bound, n in zip(self.bucket_bounds, h.buckets):
+            cumulative += n
+            if cumulative >= target:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> dict:
+        snapshot = {}
+        for key, h in self._values.items():
+            snapshot[_format_labels(key)] = {"count": h.count, "sum": h.sum}
+            for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+                value = self.quantile(q, **dict(key))
+                # JSON has no infinity.
+                snapshot[_format_labels(key)][name] = None if value == float("inf") else value
+        return snapshot
+
+
+class TimeSeries:
+    """
+    Maximum of a value per interval seconds, over the last maxlen intervals.
+    """
+
+    def __init__(self, interval: float = 1.0, maxlen: int = 600):
+        self.interval = interval
+        self._points = collections.deque(maxlen=maxlen)
+
+    def record(self, value: float):
+        t = time.time() // self.interval * self.interval
+        if self._points and self._points[-1][0] == t:
+            self._points[-1][1] = max(self._points[-1][1], value)
+        else:
+            self._points.append([t, value])
+
+    def snapshot(self) -> list:
+        return [list(p) for p in self._points]
+
+
+REGISTRY: list[_Metric] = []
+
+QUEUE_WAIT = Histogram("btlp2_queue_wait_seconds", "Time works spend in the pool queue before being dispatched.")
+INGEST = Histogram("btlp2_ingest_seconds", "Time to decode, validate, resize and hash an uploaded image.")
+QUEUE_DEPTH = Gauge("btlp2_queue_depth", "Number of works in the pool queue.")
+PIPE_TRANSFER = Histogram("btlp2_pipe_transfer_seconds", "Time from dispatching a work to its worker picking it up.")
+STAGE = Histogram("btlp2_stage_seconds", "Duration of the generation stages, by stage.")
+IDLE_GAP = Histogram(
+    "btlp2_idle_gap_seconds", "Time a worker's model sat idle while the work it starts next was waiting there."
+)
+TOKENS = Counter("btlp2_generated_tokens_total", "Tokens decoded by the batch engine, by worker.")
+TOKENS_PER_SECOND = Gauge("btlp2_tokens_per_second", "Decoded tokens per second over the last report, by worker.")
+BUSY = Counter("btlp2_worker_busy_seconds_total", "Time workers spent computing, by worker.")
+BUSY_RATIO = Gauge("btlp2_worker_busy_ratio", "Busy fraction of the last report interval, by worker.")
+RESULT_CACHE_HITS = Counter("btlp2_result_cache_hits_total", "Works answered from the result cache.")
+COALESCED = Counter("btlp2_coalesced_works_total", "Works attached to an identical queued or running work.")
+CANCELLED = Counter(
+    "btlp2_cancelled_works_total",
+    "Cancelled works, by where they were: queue, worker (waiting there), running, or shared (attached to another work)."
+)
+OUTBOUND_DROPPED = Counter(
+    "btlp2_outbound_dropped_total", "Messages to clients dropped as superseded or for a slow client, by event."
+)
+REJECTED = Counter(
+    "btlp2_rejected_works_total",
+    "Submissions rejected by admission control, by reason: invalid_args, image_too_large, client_limit, queue_full "
+    "or wait_too_long."
+)
+ESTIMATED_WAIT = Gauge("btlp2_estimated_wait_seconds", "Estimated queue wait of a new work, as of the last submission.")
+COMPRESSED_IMAGES = Counter("btlp2_compressed_queued_images_total", "Images of queued works kept compressed.")
+RECLAIMED_SECONDS = Counter(
+    "btlp2_reclaimed_compute_seconds_total",
+    "Estimated compute time the cancelled running works would still have taken, by worker."
+)
+WORKERS = Gauge("btlp2_local_workers", "Local worker processes, starting ones included, by device.")
+WORK_FAILURES = Counter("btlp2_failed_works_total", "Works whose generation raised in their worker, by worker.")
+WORKER_CRASHES = Counter("btlp2_worker_crashes_total", "Local worker processes that exited unexpectedly, by device.")
+SCALING = Counter("btlp2_worker_scaling_total", "Local workers started or retired by the pool, by direction: up or down.")
+DRAFT_TOKENS = Counter(
+    "btlp2_draft_tokens_total", "Tokens proposed by the speculative decoding drafts, by outcome: accepted or rejected."
+)
+
+QUEUE_DEPTH_HISTORY = TimeSeries()
+
+
+def set_queue_depth(depth: int):
+    QUEUE_DEPTH.set(depth)
+    QUEUE_DEPTH_HISTORY.record(depth)
+
+
+def record_worker_report(worker: str, report: dict):
+    for stage, seconds in report["stages"]:
+        STAGE.observe(seconds, stage=stage)
+    for seconds in report["pipe_transfer"]:
+        PIPE_TRANSFER.observe(seconds)
+    for seconds in report["idle_gaps"]:
+        IDLE_GAP.observe(seconds)
+    TOKENS.inc(report["tokens"], worker=worker)
+    BUSY.inc(report["busy"], worker=worker)
+    proposed, accepted = report["draft"]
+    if proposed > 0:
+        DRAFT_TOKENS.inc(accepted, outcome="accepted")
+        DRAFT_TOKENS.inc(proposed - accepted, outcome="rejected")
+    if report["interval"] > 0:
+        TOKENS_PER_SECOND.set(report["tokens"] / report["interval"], worker=worker)
+        BUSY_RATIO.set(report["busy"] / report["interval"], worker=worker)
+
+
+def render() -> str:
+    return "\n".join(m.render() for m in REGISTRY) + "\n"
+
+
+def snapshot() -> dict:
+    """
+    All metrics as JSON-able dicts, plus the queue depth history.
+    """
+    return {
+        **{m.name: m.snapshot() for m in REGISTRY},
+        "btlp2_queue_depth_history": QUEUE_DEPTH_HISTORY.snapshot(),
+    }
+
+
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1] == "/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError as e:
+        logging.debug(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int):
+    """
+    Serves render() at http://host:port/metrics for Prometheus.
+    """
+    server = await asyncio.start_server(_handle_http, host, port)
+    logging.info(f"Serving metrics at http://{host}:{port}/metrics")
+    return server
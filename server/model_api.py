@@ -1,18 +1,80 @@
-import enum
+import collections
+import itertools
+import logging
+import os
+import time
+import typing
 
-from PIL import Image
 import torch
-from lavis.models import load_model_and_preprocess
+# Registers the reductions that pickle shared memory tensors as handles when spawning workers.
+import torch.multiprocessing
+from lavis.common.registry import registry
+from lavis.models import load_preprocess
+from omegaconf import OmegaConf
+from transformers import OPTForCausalLM, StoppingCriteria, StoppingCriteriaList
 
+import batching
 import config
+from embedding_cache import EmbeddingCache, cache_key
+from speculative import Draft, fit_projection, generate as generate_speculatively
+
+
+class Preprocessed(typing.NamedTuple):
+    """
+    Output of Model.preprocess(), the device tensors of one work.
+    """
+    image: torch.Tensor | None
+    input_ids: torch.Tensor
+    # Recorded after the copies to the device when they were made on a side CUDA stream.
+    ready: typing.Any = None
+
+
+class _StopWhen(StoppingCriteria):
+    """
+    Stops generating once should_stop(number of tokens generated so far) returns True.
+    """
+
+    def __init__(self, should_stop, prompt_length: int):
+        self._should_stop = should_stop
+        self._prompt_length = prompt_length
+
+    def __call__(self, input_ids: torch.LongTensor, scores, **kwargs):
+        stop = self._should_stop(input_ids.shape[1] - self._prompt_length)
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
 
 
 class Model:
-    def __init__(self, main, vis_proc, txt_proc, device):
+    """
+    A BLIP-2 OPT model (LAVIS blip2_opt).
+    """
+    # Attribute of the LAVIS model holding the language model.
+    LANGUAGE_MODEL = "opt_model"
+
+    def __init__(self, main, vis_proc, txt_proc, device, embedding_cache: EmbeddingCache = None,
+                 name: str = config.DEFAULT_MODEL):
         self.main = main
         self.vis_proc = vis_proc
         self.txt_proc = txt_proc
         self.device = device
+        self.embedding_cache = embedding_cache
+        # The variant in config.MODELS, the embedding cache can be shared between variants.
+        self.name = name
+        # Set when the vision encoder weights were converted, see optimize_for_cpu().
+        self.vision_dtype: torch.dtype | None = None
+        # Draft model of the speculative decoding, see ModelRegistry.
+        self.draft: Draft | None = None
+
+    @property
+    def tokenizer(self):
+        return self.main.opt_tokenizer
+
+    def _project(self, query_output: torch.Tensor) -> torch.Tensor:
+        return self.main.opt_proj(query_output)
+
+    def _cache_key(self, image_hash: str | None) -> str | None:
+        if image_hash is None or self.embedding_cache is None:
+            return None
+        return cache_key(self.name, image_hash)
 
     # def generate(
     #         self,
@@ -99,10 +161,112 @@ class Model:
     #         output_text = [text.strip() for text in output_text]
     #         return output_text
     
+    def preprocess(self, prompt: str, raw_image, image_hash: str = None, stream=None) -> Preprocessed:
+        """
+        The CPU side of prepare(): runs the vision processor and the tokenizer and copies the tensors to the device.
+        On CUDA the tensors are pinned and copied asynchronously on the given stream,
+        so this can run for the next work while the model is busy.
+        The image is skipped if its embeddings are cached.
+        """
+        image = None
+        key = self._cache_key(image_hash)
+        if key is None or key not in self.embedding_cache:
+            image = self.vis_proc(raw_image).unsqueeze(0)
+        input_ids = self.tokenizer([prompt], return_tensors="pt").input_ids
+
+        if self.device.type != "cuda":
+            return Preprocessed(None if image is None else image.to(self.device), input_ids.to(self.device))
+
+        with torch.cuda.stream(stream):
+            if image is not None:
+                image = image.pin_memory().to(self.device, non_blocking=True)
+            input_ids = input_ids.pin_memory().to(self.device, non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record()
+        return Preprocessed(image, input_ids, ready)
+
+    def encode_image(self, raw_image, image: torch.Tensor = None):
+        """
+        Runs the vision encoder and the Q-Former, yields progress like generate().
+        image is the preprocessed image if there is one already.
+        Returns:
+            query_embeds: The projected query embeddings of the image, with batch size 1.
+        """
+        yield "0"
+        if image is None:
+            image = self.vis_proc(raw_image).unsqueeze(0).to(self.device)
+        yield "1"
+
+        with self.main.maybe_autocast(), torch.no_grad():
+            if self.vision_dtype is not None:
+                image_embeds = self.main.visual_encoder(image.to(self.vision_dtype)).float()
+            else:
+                image_embeds = self.main.visual_encoder(image)
+            image_embeds = self.main.ln_vision(image_embeds)
+            yield "2"
+            image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(
+                image.device
+            )
+            yield "3"
+            query_tokens = self.main.query_tokens.expand(image_embeds.shape[0], -1, -1)
+            yield "4"
+            query_output = self.main.Qformer.bert(
+                query_embeds=query_tokens,
+                encoder_hidden_states=image_embeds,
+                encoder_attention_mask=image_atts,
+                return_dict=True,
+            )
+            yield "5"
+
+            inputs_opt = self._project(query_output.last_hidden_state)
+            return inputs_opt
+
+    def prepare(self, prompt: str, raw_image, image_hash: str = None, preprocessed: Preprocessed = None):
+        """
+        Encodes the image (or takes it from the embedding cache) and tokenizes the prompt,
+        unless that was done already by preprocess().
+        Yields progress like generate().
+        Returns:
+            (query_embeds, input_ids): The projected query embeddings and the prompt tokens, both with batch size 1.
+        """
+        image = None
+        if preprocessed is not None:
+            if preprocessed.ready is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_event(preprocessed.ready)
+                # Allocated on the prefetch stream but used on this one.
+                for tensor in preprocessed[:2]:
+                    if tensor is not None:
+                        tensor.record_stream(current_stream)
+            image = preprocessed.image
+
+        inputs_opt = None
+        key = self._cache_key(image_hash)
+        if key is not None:
+            inputs_opt = self.embedding_cache.get(key)
+        if inputs_opt is None:
+            inputs_opt = yield from self.encode_image(raw_image, image)
+            if key is not None:
+                self.embedding_cache.put(key, inputs_opt)
+
+        yield "6"
+
+        # The attention mask of the query embeddings (atts_opt) is all ones, so it isn't cached.
+        if preprocessed is not None:
+            input_ids = preprocessed.input_ids
+        else:
+            input_ids = self.tokenizer([prompt], return_tensors="pt").to(
+                inputs_opt.device
+            ).input_ids
+        yield "7"
+        return inputs_opt, input_ids
+
     def generate(
         self,
         prompt: str,
         raw_image,
+        image_hash: str = None,
+        preprocessed: Preprocessed = None,
         use_nucleus_sampling=False,
         num_beams=5,
         max_length=30,
@@ -112,11 +276,15 @@ class Model:
         length_penalty=1.0,
         num_captions=1,
         temperature=1,
+        should_stop=None,
+        speculative=False,
     ):
         """
         Args:
             prompt (str): The prompt text
             raw_image (Image): The input image
+            image_hash (str): Hash of the input image, used to look up the embedding cache.
+            preprocessed (Preprocessed): Output of preprocess() for this prompt and image, if it ran already.
             use_nucleus_sampling (bool): Whether to use nucleus sampling. If False, use top-k sampling.
             num_beams (int): Number of beams for beam search. 1 means no beam search.
             max_length (int): The maximum length of the sequence to be generated.
@@ -124,45 +292,32 @@ class Model:
             top_p (float): The cumulative probability for nucleus sampling.
             repetition_penalty (float): The parameter for repetition penalty. 1.0 means no penalty.
             num_captions (int): Number of captions to be generated for each image.
+            should_stop (callable): Polled with the number of tokens generated so far after every decode step,
+                generation stops early (with truncated captions) once it returns True.
+            speculative (bool): Decode greedily with the help of the draft model (see speculative.py),
+                beams and num_captions are ignored then. Also ignored when sampling or without a draft.
         Returns:
             captions (list): A list of strings of length batch_size * num_captions.
         """
-        yield "0"
-        image = self.vis_proc(raw_image).unsqueeze(0).to(self.device)
-        yield "1"
-        
-        with self.main.maybe_autocast(), torch.no_grad():
-            image_embeds = self.main.ln_vision(self.main.visual_encoder(image))
-            yield "2"
-            image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(
-                image.device
-            )
-            yield "3"
-            query_tokens = self.main.query_tokens.expand(image_embeds.shape[0], -1, -1)
-            yield "4"
-            query_output = self.main.Qformer.bert(
-                query_embeds=query_tokens,
-                encoder_hidden_states=image_embeds,
-                encoder_attention_mask=image_atts,
-                return_dict=True,
-            )
-            yield "5"
+        inputs_opt, input_ids = yield from self.prepare(prompt, raw_image, image_hash, preprocessed)
 
-            inputs_opt = self.main.opt_proj(query_output.last_hidden_state)
-            atts_opt = torch.ones(inputs_opt.size()[:-1], dtype=torch.long).to(
-                image.device
+        if speculative and self.draft is not None and not use_nucleus_sampling:
+            yield "8"
+            yield "9"
+            tokens = generate_speculatively(
+                self.main.opt_model, self.draft, inputs_opt, input_ids, self.main.eos_token_id,
+                max_length, min_length, repetition_penalty, config.DRAFT_TOKENS, should_stop, self.main.maybe_autocast
             )
-            
-            yield "6"
-            
-            prompt = [prompt] * image.size(0)
+            yield "10"
+            output_text = [self.tokenizer.decode(tokens, skip_special_tokens=True).strip()]
+            yield "11"
+            return output_text
 
-            opt_tokens = self.main.opt_tokenizer(prompt, return_tensors="pt").to(
-                image.device
+        with self.main.maybe_autocast(), torch.no_grad():
+            atts_opt = torch.ones(inputs_opt.size()[:-1], dtype=torch.long).to(
+                inputs_opt.device
             )
-            yield "7"
-            input_ids = opt_tokens.input_ids
-            attention_mask = torch.cat([atts_opt, opt_tokens.attention_mask], dim=1)
+            attention_mask = torch.cat([atts_opt, torch.ones_like(input_ids)], dim=1)
             yield "8"
 
             if use_nucleus_sampling:
@@ -171,6 +326,10 @@ class Model:
             else:
                 query_embeds = inputs_opt.repeat_interleave(num_beams, dim=0)
 
+            stopping_criteria = None
+            if should_stop is not None:
+                stopping_criteria = StoppingCriteriaList([_StopWhen(should_stop, input_ids.shape[1])])
+
             yield "9"
             outputs = self.main.opt_model.generate(
                 input_ids=input_ids,
@@ -186,10 +345,11 @@ class Model:
                 repetition_penalty=repetition_penalty,
                 length_penalty=length_penalty,
                 num_return_sequences=num_captions,
+                stopping_criteria=stopping_criteria,
             )
             yield "10"
 
-            prompt_length = opt_tokens.input_ids.shape[1]
+            prompt_length = input_ids.shape[1]
             output_text = self.main.opt_tokenizer.batch_decode(
                 outputs[:, prompt_length:], skip_special_tokens=True
             )
@@ -197,14 +357,378 @@ class Model:
             yield "11"
             return output_text
 
+    def create_batch_engine(self, max_batch_size: int) -> batching.BatchEngine | None:
+        return batching.BatchEngine(
+            self.main.opt_model,
+            self.main.opt_tokenizer,
+            self.main.eos_token_id,
+            max_batch_size,
+            autocast=self.main.maybe_autocast
+        )
+
+
+class T5Model(Model):
+    """
+    A BLIP-2 FlanT5 model (LAVIS blip2_t5). The query embeddings and the prompt go through the T5 encoder,
+    the decoder generates the answer from scratch, so these works don't batch (see batching.py) nor keep
+    session state and always take the generate() path.
+    """
+    LANGUAGE_MODEL = "t5_model"
+
+    @property
+    def tokenizer(self):
+        return self.main.t5_tokenizer
+
+    def _project(self, query_output: torch.Tensor) -> torch.Tensor:
+        return self.main.t5_proj(query_output)
+
+    def generate(
+        self,
+        prompt: str,
+        raw_image,
+        image_hash: str = None,
+        preprocessed: Preprocessed = None,
+        use_nucleus_sampling=False,
+        num_beams=5,
+        max_length=30,
+        min_length=1,
+        top_p=0.9,
+        repetition_penalty=1.0,
+        length_penalty=1.0,
+        num_captions=1,
+        temperature=1,
+        should_stop=None,
+        speculative=False,
+    ):
+        """
+        Same as Model.generate(), without speculative decoding.
+        """
+        inputs_t5, input_ids = yield from self.prepare(prompt, raw_image, image_hash, preprocessed)
+
+        # Like LAVIS, the T5 weights are bfloat16.
+        with self.main.maybe_autocast(dtype=torch.bfloat16), torch.no_grad():
+            atts_t5 = torch.ones(inputs_t5.size()[:-1], dtype=torch.long).to(
+                inputs_t5.device
+            )
+            attention_mask = torch.cat([atts_t5, torch.ones_like(input_ids)], dim=1)
+            inputs_embeds = self.main.t5_model.encoder.embed_tokens(input_ids)
+            inputs_embeds = torch.cat([inputs_t5, inputs_embeds], dim=1)
+            yield "8"
+
+            if use_nucleus_sampling:
+                num_beams = 1
+
+            stopping_criteria = None
+            if should_stop is not None:
+                # The decoder starts from its start token alone.
+                stopping_criteria = StoppingCriteriaList([_StopWhen(should_stop, 1)])
+
+            yield "9"
+            outputs = self.main.t5_model.generate(
+                inputs_embeds=inputs_embeds,
+                attention_mask=attention_mask,
+                do_sample=use_nucleus_sampling,
+                top_p=top_p,
+                temperature=temperature,
+                num_beams=num_beams,
+                max_new_tokens=max_length,
+                min_length=min_length,
+                repetition_penalty=repetition_penalty,
+                length_penalty=length_penalty,
+                num_return_sequences=num_captions,
+                stopping_criteria=stopping_criteria,
+            )
+            yield "10"
+
+            output_text = self.main.t5_tokenizer.batch_decode(outputs, skip_special_tokens=True)
+            output_text = [text.strip() for text in output_text]
+            yield "11"
+            return output_text
+
+    def create_batch_engine(self, max_batch_size: int) -> batching.BatchEngine | None:
+        return None
+
+
+# Model classes by LAVIS model name, the first part of the config.MODELS entries.
+MODEL_CLASSES = {
+    "blip2_opt": Model,
+    "blip2_t5": T5Model,
+}
+
+
+class Weights(typing.NamedTuple):
+    """
+    A model variant loaded on the host, see load_weights().
+    """
+    main: torch.nn.Module
+    vis_proc: typing.Any
+    txt_proc: typing.Any
+    # Its name in config.MODELS.
+    name: str
+
+
+def _tensors(module: torch.nn.Module) -> list[torch.Tensor]:
+    # Tied weights are the same tensor, so they are only counted once.
+    return list({id(t): t for t in itertools.chain(module.parameters(), module.buffers())}.values())
+
+
+def _move_to_shared_memory(module: torch.nn.Module):
+    tensors = _tensors(module)
+    offsets = []
+    total = 0
+    for t in tensors:
+        total = -(-total // 64) * 64
+        offsets.append(total)
+        total += t.nelement() * t.element_size()
+
+    block = torch.empty(total, dtype=torch.uint8).share_memory_()
+    for t, offset in zip(tensors, offsets):
+        view = block[offset:offset + t.nelement() * t.element_size()].view(t.dtype).view(t.shape)
+        view.copy_(t.data)
+        t.data = view
+
+
+def load_weights(name: str, float32: bool) -> Weights:
+    """
+    Loads a variant of config.MODELS on the host.
+    float32 is what LAVIS does for CPU inference, otherwise the weights keep the precision of the checkpoint.
+    """
+    model_name, model_type = config.MODELS[name]
+    model_cls = registry.get_model_class(model_name)
+    model = model_cls.from_pretrained(model_type=model_type).eval()
+    if float32:
+        model = model.float()
+
+    cfg = OmegaConf.load(model_cls.default_config_path(model_type))
+    vis_processors, txt_processors = load_preprocess(cfg.preprocess)
+    return Weights(model, vis_processors["eval"], txt_processors["eval"], name)
+
+
+def load_shared_weights(float32: bool, name: str = config.DEFAULT_MODEL) -> Weights:
+    """
+    Loads a variant once in the main process with all its weights in one shared memory block, for ModelRegistry.
+    Pickling it to a worker process only sends a handle to the block.
+    float32 is for CPU workers, they then use the shared weights in place.
+    """
+    weights = load_weights(name, float32)
+    _move_to_shared_memory(weights.main)
+    return weights
+
+
+def load_draft_model(device) -> torch.nn.Module:
+    """
+    The draft model of the speculative decoding (config.DRAFT_MODEL), in the precision of the OPT models.
+    """
+    dtype = torch.float32 if device.type == "cpu" else torch.float16
+    return OPTForCausalLM.from_pretrained(config.DRAFT_MODEL, torch_dtype=dtype).to(device).eval()
+
+
+def cpu_supports_bf16() -> bool:
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def optimize_for_cpu(model: Model, quantize: bool, bf16: bool):
+    """
+    Makes fp32 CPU inference cheaper, in place:
+    quantize applies int8 dynamic quantization to the linear layers of the language model and the Q-Former,
+    bf16 converts the vision encoder to bfloat16 if the CPU supports it (AVX512-BF16 or AMX).
+    """
+    if quantize:
+        for name in (model.LANGUAGE_MODEL, "Qformer"):
+            torch.ao.quantization.quantize_dynamic(
+                getattr(model.main, name), {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+    if bf16 and cpu_supports_bf16():
+        model.main.visual_encoder.to(torch.bfloat16)
+        model.vision_dtype = torch.bfloat16
+
+
+def _cpu_threads() -> int:
+    if config.CPU_THREADS is not None:
+        return config.CPU_THREADS
+    cpu_workers = sum(torch.device(d).type == "cpu" for d in config.WORKERS) * config.MAX_WORKERS_PER_DEVICE
+    return max(1, (os.cpu_count() or 1) // max(cpu_workers, 1))
+
+
+def _setup_cpu_model(model: Model) -> Model:
+    torch.set_num_threads(_cpu_threads())
+    optimize_for_cpu(model, config.CPU_QUANTIZE, config.CPU_BF16)
+    return model
+
+
+def _create_embedding_cache() -> EmbeddingCache | None:
+    if config.EMBEDDING_CACHE_BYTES > 0:
+        return EmbeddingCache(config.EMBEDDING_CACHE_BYTES)
+    return None
+
+
+class _Variant:
+    """
+    A variant loaded by a ModelRegistry, with its weights either on the device (resident) or only on the host.
+    """
+
+    def __init__(self, model: Model, shared: bool):
+        self.model = model
+        self.shared = shared
+        # Every weight with its host copy, which stays valid while the weights are on the device as they are
+        # never written to. Not kept on CPU devices, those use the host weights in place.
+        self._host = None
+        if model.device.type != "cpu":
+            self._host = [(t, t.data) for t in _tensors(model.main)]
+        self.bytes = sum(t.nelement() * t.element_size() for t in _tensors(model.main))
+        self.resident = self._host is None
+
+    def to_device(self):
+        for t, host in self._host:
+            t.data = host.to(self.model.device, non_blocking=True)
+        self.resident = True
+
+    def to_host(self):
+        for t, host in self._host:
+            t.data = host
+        self.resident = False
+
+
+class ModelRegistry:
+    """
+    The model variants of a worker (see config.MODELS), each loaded the first time a work asks for it.
+
+    The weights of the variants resident on a CUDA device take at most config.MODEL_DEVICE_MEMORY of its memory,
+    shared with the other device_workers workers the device can hold.
+    Making room for another one evicts the least recently used variants that aren't busy. Their weights are offloaded
+    to the host copy kept since loading, pinned (or the shared memory block of shared weights), so reloading them
+    is one copy to the device. The host copies of the evicted variants take at most config.MODEL_HOST_MEMORY bytes,
+    shared ones aside. The least recently used ones beyond that are dropped, on_drop(name) is called and they're loaded
+    from disk again next time. CPU workers use the host weights in place and never evict.
+    """
+
+    def __init__(self, device, shared: Weights = None, on_drop=None, logger: logging.Logger = None,
+                 device_workers: int = 1):
+        self.device = device
+        self._logger = logger or logging.getLogger()
+        # Shared by the variants, see Model._cache_key().
+        self.embedding_cache = _create_embedding_cache()
+        self._shared = {} if shared is None else {shared.name: shared}
+        self._device_budget = None
+        if device.type == "cuda" and config.MODEL_DEVICE_MEMORY is not None:
+            self._device_budget = \
+                torch.cuda.get_device_properties(device).total_memory * config.MODEL_DEVICE_MEMORY / device_workers
+        self._host_budget = config.MODEL_HOST_MEMORY
+        self._on_drop = on_drop
+        # Least recently used first.
+        self._variants: collections.OrderedDict[str, _Variant] = collections.OrderedDict()
+        # Shared by the OPT variants, loaded by the first speculative work. False if that failed.
+        self._draft_model = None
+
+    @property
+    def resident(self) -> list[str]:
+        """
+        Names of the variants with their weights on the device.
+        """
+        return [name for name, variant in self._variants.items() if variant.resident]
+
+    def peek(self, name: str) -> Model | None:
+        """
+        A loaded variant's model, whether it's resident or not. Its processors and tokenizer can be used either way.
+        """
+        variant = self._variants.get(name)
+        return None if variant is None else variant.model
+
+    def get(self, name: str, busy=()) -> Model | None:
+        """
+        Returns a variant's model with its weights on the device, loading it or reloading it if needed.
+        None if that needs evicting a busy variant (one of the names in busy), try again once it's done.
+        """
+        variant = self._variants.get(name)
+        if variant is None:
+            variant = self._variants[name] = self._load(name)
+        self._variants.move_to_end(name)
+        if variant.resident:
+            return variant.model
+
+        if not self._make_room(variant, busy):
+            return None
+        started_at = time.time()
+        variant.to_device()
+        self._logger.info(f"Moved model {name} to {self.device} in {time.time() - started_at:.2f}s")
+        self._drop_host_copies()
+        return variant.model
+
+    def load_draft(self, model: Model):
+        """
+        Gives a resident OPT variant its draft for speculative decoding, if it has none yet.
+        Without one (no config.DRAFT_MODEL, or it failed to load), Model.generate() decodes as usual.
+        """
+        if model.draft is not None or type(model) is not Model or config.DRAFT_MODEL is None \
+                or self._draft_model is False:
+            return
+        if self._draft_model is None:
+            started_at = time.time()
+            try:
+                self._draft_model = load_draft_model(self.device)
+            except OSError as e:
+                self._logger.warning(f"Failed to load the draft model {config.DRAFT_MODEL}: {e}")
+                self._draft_model = False
+                return
+            self._logger.info(f"Loaded draft model {config.DRAFT_MODEL} in {time.time() - started_at:.2f}s")
+
+        model.draft = Draft(self._draft_model, fit_projection(
+            model.main.opt_model.get_input_embeddings().weight, self._draft_model.get_input_embeddings().weight
+        ))
+
+    def _load(self, name: str) -> _Variant:
+        started_at = time.time()
+        weights = self._shared.get(name)
+        if weights is None:
+            weights = load_weights(name, self.device.type == "cpu")
+            if self.device.type == "cuda":
+                for t in _tensors(weights.main):
+                    t.data = t.data.pin_memory()
+
+        model = MODEL_CLASSES[config.MODELS[name][0]](
+            weights.main, weights.vis_proc, weights.txt_proc, self.device, self.embedding_cache, name
+        )
+        if self.device.type == "cpu":
+            # Quantizing replaces the shared linear layers with private int8 ones, the rest stays shared.
+            _setup_cpu_model(model)
+        variant = _Variant(model, name in self._shared)
+        self._logger.info(
+            f"Loaded model {name} ({variant.bytes / 1024 ** 3:.1f} GiB) in {time.time() - started_at:.2f}s"
+        )
+        return variant
+
+    def _make_room(self, variant: _Variant, busy) -> bool:
+        if self._device_budget is None:
+            return True
+        resident = [(name, v) for name, v in self._variants.items() if v.resident]
+        used = sum(v.bytes for _, v in resident)
+        evictable = [(name, v) for name, v in resident if name not in busy]
+        if len(evictable) < len(resident) and \
+                used - sum(v.bytes for _, v in evictable) + variant.bytes > self._device_budget:
+            return False
+
+        # With nothing busy, a variant larger than the budget still gets the device to itself.
+        for name, v in evictable:
+            if used + variant.bytes <= self._device_budget:
+                break
+            v.to_host()
+            used -= v.bytes
+            self._logger.info(f"Evicted model {name} from {self.device}")
+        return True
 
-def load_model(device) -> Model:
-    model, _vis_processors, _txt_processors = load_model_and_preprocess(
-        name=config.MODEL_NAME,
-        model_type=config.MODEL_TYPE,
-        is_eval=True,
-        device=device
-    )
-    vis_processor = _vis_processors["eval"]
-    txt_processor = _txt_processors["eval"]
-    return Model(model, vis_processor, txt_processor, device)
+    def _drop_host_copies(self):
+        if self._host_budget is None:
+            return
+        evicted = [(name, v) for name, v in self._variants.items() if not v.resident and not v.shared]
+        total = sum(v.bytes for _, v in evicted)
+        for name, v in evicted:
+            if total <= self._host_budget:
+                break
+            del self._variants[name]
+            total -= v.bytes
+            self._logger.info(f"Dropped model {name}")
+            if self._on_drop is not None:
+                self._on_drop(name)
@@ -0,0 +1,83 @@
+"""
+Outbound messages to the clients. Every connection has its own queue and writer task, so queuing a message never
+waits for the network and a slow client only delays its own messages.
+
+Messages are encoded once (JSON, UTF-8) however many connections they go to. Superseded messages are dropped:
+a message with the same key as one still queued replaces it in place (e.g. the progress of a request),
+and a queue longer than max_size drops its oldest droppable messages. Results and errors are never dropped.
+"""
+import asyncio
+import collections
+import json
+import logging
+
+import websockets
+
+import metrics
+
+
+def encode(event: str, msg: dict) -> bytes:
+    return json.dumps({"event": event, "data": msg}, ensure_ascii=False).encode()
+
+
+class Outbox:
+    def __init__(self, conn, max_size: int):
+        self.conn = conn
+        self.max_size = max_size
+
+        # [key, frame, event] of the queued messages, key is None for the ones that can't be dropped.
+        self._queue: collections.deque[list] = collections.deque()
+        self._by_key: dict[object, list] = {}
+        self._ready = asyncio.Event()
+        self._writer = asyncio.create_task(self._write())
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, event: str, frame: bytes, key=None):
+        """
+        Queues an encoded message (see encode()).
+        A key makes it droppable, and replaces the queued message with the same key if there is one.
+        """
+        entry = self._by_key.get(key) if key is not None else None
+        if entry is not None:
+            entry[1] = frame
+            metrics.OUTBOUND_DROPPED.inc(event=event)
+            return
+
+        entry = [key, frame, event]
+        self._queue.append(entry)
+        if key is not None:
+            self._by_key[key] = entry
+        if len(self._queue) > self.max_size:
+            self._shed()
+        self._ready.set()
+
+    def _shed(self):
+        kept = collections.deque()
+        excess = len(self._queue) - self.max_size
+        for entry in self._queue:
+            if excess > 0 and entry[0] is not None:
+                del self._by_key[entry[0]]
+                metrics.OUTBOUND_DROPPED.inc(event=entry[2])
+                excess -= 1
+            else:
+                kept.append(entry)
+        self._queue = kept
+
+    async def _write(self):
+        while True:
+            while not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+            key, frame, _ = self._queue.popleft()
+            if key is not None:
+                del self._by_key[key]
+            try:
+                await self.conn.send(frame, text=True)
+            except websockets.ConnectionClosed as e:
+                logging.info(f"Stopped sending to {self.conn.remote_address}: {e}")
+                return
+
+    def close(self):
+        self._writer.cancel()
@@ -0,0 +1,95 @@
+"""
+Binary frame format used by clients to upload images:
+
+    [u32 little endian: header length][header: UTF-8 JSON][payload: image bytes]
+
+The header has the same shape as a text message ({"event": ..., "data": {...}}),
+data["format"] tells how the payload is encoded (see IMAGE_FORMATS).
+Raw RGB payloads also need data["image_width"] and data["image_height"].
+"""
+import io
+import json
+
+
+HEADER_LENGTH_SIZE = 4
+
+# Frame format name -> PIL format name (None for raw pixels)
+IMAGE_FORMATS = {
+    "png": "PNG",
+    "jpeg": "JPEG",
+    "webp": "WEBP",
+    "rgb": None,
+}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class MemoryViewReader(io.RawIOBase):
+    """
+    Read-only seekable file over a memoryview, so PIL can decode a slice of a frame without copying it first.
+    """
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self._view) - self._pos)
+        if n <= 0:
+            return 0
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        self._pos = max(self._pos, 0)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+def parse_frame(frame: bytes) -> tuple[dict, memoryview]:
+    """
+    Splits a binary frame into its decoded header and a view of the payload.
+    """
+    view = memoryview(frame)
+    if len(view) < HEADER_LENGTH_SIZE:
+        raise ProtocolError("Frame too short.")
+    header_len = int.from_bytes(view[:HEADER_LENGTH_SIZE], "little")
+    header_end = HEADER_LENGTH_SIZE + header_len
+    if header_end > len(view):
+        raise ProtocolError("Header length exceeds frame length.")
+
+    try:
+        header = json.loads(str(view[HEADER_LENGTH_SIZE:header_end], "utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ProtocolError(f"Invalid header: {e}")
+    if type(header) is not dict:
+        raise ProtocolError("Header is not an object.")
+    return header, view[header_end:]
+
+
+def build_frame(header: dict, payload: bytes) -> bytes:
+    """
+    Inverse of parse_frame().
+    """
+    header_bytes = json.dumps(header, ensure_ascii=False).encode()
+    return len(header_bytes).to_bytes(HEADER_LENGTH_SIZE, "little") + header_bytes + payload
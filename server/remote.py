@@ -0,0 +1,185 @@
+"""
+Workers on other machines. A remote agent (worker_agent.py) runs worker processes on its machine and connects
+to the dispatcher over TCP, every worker of the agent then shows up in the WorkerPool as a RemoteWorker.
+
+Messages are binary frames (see protocol.py) prefixed with their u32 little endian length.
+The header has a "type":
+    register (agent -> dispatcher, first message): {"name", "devices", "token"}
+    worker (agent -> dispatcher): a worker message {"worker": index, "msg": MsgType name, "uid", "data"}
+    work (dispatcher -> agent): {"worker": index, "work": {...}}, the payload is the compressed image
+    cancel (dispatcher -> agent): {"worker": index, "uid"}, stops a work (see worker.Cancel)
+    heartbeat (both ways), a side that hears nothing for REMOTE_HEARTBEAT_TIMEOUT seconds drops the connection.
+Works held by a lost agent are requeued.
+"""
+import asyncio
+import collections
+import hmac
+import io
+import logging
+
+from PIL import Image
+
+import config
+import protocol
+import worker
+
+
+LENGTH_SIZE = 4
+MAX_MESSAGE_SIZE = 64 * 1024 ** 2
+
+
+def pack(header: dict, payload: bytes = b"") -> bytes:
+    frame = protocol.build_frame(header, payload)
+    return len(frame).to_bytes(LENGTH_SIZE, "little") + frame
+
+
+async def read_message(reader: asyncio.StreamReader) -> tuple[dict, memoryview]:
+    size = int.from_bytes(await reader.readexactly(LENGTH_SIZE), "little")
+    if size > MAX_MESSAGE_SIZE:
+        raise protocol.ProtocolError(f"Message too large: {size} bytes.")
+    return protocol.parse_frame(await reader.readexactly(size))
+
+
+async def send_heartbeats(writer: asyncio.StreamWriter):
+    while True:
+        writer.write(pack({"type": "heartbeat"}))
+        await asyncio.sleep(config.REMOTE_HEARTBEAT_INTERVAL)
+
+
+def encode_worker_message(index: int, msg: worker.MsgType, uid: int | None, data) -> bytes:
+    if isinstance(data, worker.Partial):
+        data = {"partial": data.texts}
+    return pack({"type": "worker", "worker": index, "msg": msg.name, "uid": uid, "data": data})
+
+
+def decode_worker_message(header: dict) -> tuple[worker.MsgType, int | None, object]:
+    msg = worker.MsgType[header["msg"]]
+    data = header["data"]
+    if msg == worker.MsgType.PROGRESS and isinstance(data, dict):
+        data = worker.Partial(data["partial"])
+    return msg, header["uid"], data
+
+
+def encode_work(index: int, work: worker.Work) -> bytes:
+    buffer = io.BytesIO()
+    image_format = protocol.IMAGE_FORMATS[config.REMOTE_IMAGE_FORMAT]
+    # Fast rather than small, the link is rarely slower than compressing.
+    options = {"compress_level": 1} if image_format == "PNG" else {"quality": 95}
+    work.image.save(buffer, format=image_format, **options)
+    return pack({
+        "type": "work",
+        "worker": index,
+        "work": {
+            "uid": work.uid,
+            "request_id": work.request_id,
+            "prompt": work.prompt,
+            "args": work.args,
+            "image_hash": work.image_hash,
+            "stream": work.stream,
+            "dispatched_at": work.dispatched_at,
+            "session_id": work.session_id,
+            "turn": work.turn,
+            "history": work.history,
+            "model": work.model,
+            "format": config.REMOTE_IMAGE_FORMAT,
+        },
+    }, buffer.getvalue())
+
+
+def decode_work(header: dict, payload: memoryview) -> tuple[int, worker.Work]:
+    data = header["work"]
+    image = Image.open(protocol.MemoryViewReader(payload), formats=(protocol.IMAGE_FORMATS[data["format"]],))
+    image = image.convert("RGB")
+    work = worker.Work(None, data["request_id"], data["prompt"], image, data["args"], data["image_hash"], data["stream"],
+                       data["session_id"], data["turn"], data["history"], data["model"])
+    # Keeps the dispatcher's uid, the messages about it refer to it.
+    work.uid = data["uid"]
+    work.dispatched_at = data["dispatched_at"]
+    return header["worker"], work
+
+
+class RemoteWorker(worker.BaseWorker):
+    """
+    A worker of a remote agent. Its messages are queued by the agent connection, which wakes the pool up.
+    """
+
+    def __init__(self, pool: worker.WorkerPool, name: str, index: int, writer: asyncio.StreamWriter,
+                 progress_callback, result_callback):
+        super().__init__(pool, name, progress_callback, result_callback)
+        self._index = index
+        self._writer = writer
+        self.inbox = collections.deque()
+
+    @property
+    def busy(self):
+        return self._writer.is_closing() or super().busy
+
+    def close(self):
+        self._writer.close()
+
+    async def _send(self, work):
+        self._writer.write(encode_work(self._index, work))
+        try:
+            await self._writer.drain()
+        except ConnectionError:
+            # The agent connection requeues the work when it notices.
+            pass
+
+    def _send_cancel(self, uid: int):
+        self._writer.write(pack({"type": "cancel", "worker": self._index, "uid": uid}))
+
+    async def update(self):
+        """
+        Call this method regularly!
+        """
+        while self.inbox:
+            await self._handle_message(*self.inbox.popleft())
+
+
+async def _handle_agent(pool: worker.WorkerPool, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    address = writer.get_extra_info("peername")
+    workers = []
+    heartbeats = None
+    try:
+        header, _ = await asyncio.wait_for(read_message(reader), config.REMOTE_HEARTBEAT_TIMEOUT)
+        token = str(header.get("token") or "").encode()
+        if header.get("type") != "register" or (
+                config.REMOTE_WORKERS_TOKEN is not None
+                and not hmac.compare_digest(token, config.REMOTE_WORKERS_TOKEN.encode())):
+            logging.warning(f"Rejected remote agent {address}: invalid registration.")
+            return
+
+        name = str(header.get("name", address))
+        workers = [
+            RemoteWorker(pool, f"{name} worker {i} ({device})", i, writer, *pool.worker_callbacks)
+            for i, device in enumerate(header.get("devices", []))
+        ]
+        logging.info(f"Remote agent {name} registered from {address} with {len(workers)} workers.")
+        pool.add_workers(workers)
+        heartbeats = asyncio.create_task(send_heartbeats(writer))
+
+        while True:
+            header, _ = await asyncio.wait_for(read_message(reader), config.REMOTE_HEARTBEAT_TIMEOUT)
+            if header.get("type") == "worker":
+                workers[header["worker"]].inbox.append(decode_worker_message(header))
+                pool.wake()
+    except asyncio.TimeoutError:
+        logging.warning(f"Remote agent {address} timed out.")
+    except (asyncio.IncompleteReadError, ConnectionError) as e:
+        logging.warning(f"Remote agent {address} disconnected: {e}")
+    except (protocol.ProtocolError, KeyError, IndexError, ValueError) as e:
+        logging.warning(f"Invalid message from remote agent {address}: {e}")
+    finally:
+        if heartbeats is not None:
+            heartbeats.cancel()
+        writer.close()
+        # Delivers what arrived before the connection was lost, then requeues the rest.
+        for w in workers:
+            await w.update()
+        await pool.remove_workers(workers)
+
+
+async def serve(pool: worker.WorkerPool, host: str, port: int):
+    server = await asyncio.start_server(lambda r, w: _handle_agent(pool, r, w), host, port)
+    logging.info(f"Accepting remote worker agents at {host}:{port}")
+    return server
@@ -0,0 +1,41 @@
+"""
+Request traces, one JSON line per submitted work, recorded by the server when config.TRACE_PATH is set
+and replayed by load_test.py. Prompts and pixels aren't recorded, only their sizes.
+"""
+import itertools
+import json
+import time
+
+
+class TraceRecorder:
+    def __init__(self, path: str):
+        # Line buffered, so a crash loses at most the line being written.
+        self._file = open(path, "a", buffering=1, encoding="utf-8")
+        self._client_ids = {}
+        self._next_client_id = itertools.count()
+
+    def record(self, work):
+        client_id = self._client_ids.get(work.client)
+        if client_id is None:
+            client_id = self._client_ids[work.client] = next(self._next_client_id)
+        self._file.write(json.dumps({
+            "time": time.time(),
+            "client": client_id,
+            "image_hash": work.image_hash,
+            "image_size": list(work.image.size),
+            "prompt_length": len(work.prompt),
+            "args": work.args,
+            "stream": work.stream,
+            "model": work.model,
+        }) + "\n")
+
+    def forget_client(self, client):
+        self._client_ids.pop(client, None)
+
+    def close(self):
+        self._file.close()
+
+
+def load_trace(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
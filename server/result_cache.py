@@ -0,0 +1,75 @@
+import collections
+import json
+import time
+
+
+# Defaults of Model.generate(), requests leaving them out are the same as requests giving them.
+GENERATE_DEFAULTS = {
+    "use_nucleus_sampling": False,
+    "num_beams": 5,
+    "max_length": 30,
+    "min_length": 1,
+    "top_p": 0.9,
+    "repetition_penalty": 1.0,
+    "length_penalty": 1.0,
+    "num_captions": 1,
+    "temperature": 1,
+}
+# Only used when sampling.
+_SAMPLING_ARGS = ("top_p", "temperature")
+
+
+def result_key(work) -> str | None:
+    """
+    Key of the result of a work, None if it isn't deterministic (sampled), has no image hash
+    or is a follow-up in a session (its answer depends on the earlier turns).
+    The first turn of a session is keyed like any work: when it's answered from the cache or by an identical work,
+    no worker keeps the session's state and its follow-up prefills the whole conversation.
+    """
+    args = {**GENERATE_DEFAULTS, **work.args}
+    if args["use_nucleus_sampling"] or work.image_hash is None or work.session_id is not None and work.turn > 0:
+        return None
+    for name in _SAMPLING_ARGS:
+        del args[name]
+    # Speculative decoding gives the same greedy output, only faster.
+    args.pop("speculative", None)
+    # 5 and 5.0 beams are the same request.
+    args = {k: float(v) if type(v) is int else v for k, v in args.items()}
+    return json.dumps([work.model, work.image_hash, work.prompt, args, work.stream], sort_keys=True)
+
+
+class ResultCache:
+    """
+    LRU cache of generated texts by result_key(), holding at most max_entries results for at most ttl seconds.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: collections.OrderedDict[str, tuple[float, list[str]]] = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> list[str] | None:
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] > self.ttl:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return list(entry[1])
+
+    def put(self, key: str, result: list[str]):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (time.monotonic(), list(result))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
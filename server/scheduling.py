@@ -0,0 +1,250 @@
+"""
+Work queue policies for WorkerPool.
+
+Every scheduler has the interface of work_queue.WorkQueue (append, remove, remove_client, position,
+clients, client_works, len, iteration in scheduling order) plus pop(), which takes the next work to dispatch.
+"""
+import collections
+import heapq
+import itertools
+import math
+
+from work_queue import WorkQueue
+
+
+# Cost of the vision encoder and Q-Former, in decoded tokens.
+ENCODE_COST = 20
+
+
+def _arg(args: dict, key: str, default, cast):
+    try:
+        return cast(args.get(key, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def estimate_rows(args: dict) -> int:
+    """
+    Rows a work decodes at once (beams or sampled captions), derived from its generate arguments.
+    """
+    if _arg(args, "use_nucleus_sampling", False, bool):
+        rows = _arg(args, "num_captions", 1, int)
+    else:
+        rows = _arg(args, "num_beams", 5, int)
+    return max(rows, 1)
+
+
+def estimate_cost(args: dict) -> float:
+    """
+    Rough cost of a work in decoded tokens (rows times new tokens), derived from its generate arguments.
+    """
+    return ENCODE_COST + estimate_rows(args) * max(_arg(args, "max_length", 30, int), 1)
+
+
+class FifoScheduler(WorkQueue):
+    pop = WorkQueue.popleft
+
+
+class _IndexedScheduler:
+    """
+    Keeps the per client index and caches positions, subclasses do the ordering.
+    Positions come from a dry run of the policy, computed once per change of the queue.
+    """
+
+    def __init__(self):
+        self._by_client: dict[object, dict[int, object]] = {}
+        self._len = 0
+        self._positions: dict[int, int] | None = None
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return iter(self._dry_run())
+
+    def __contains__(self, work):
+        return work.uid in self._by_client.get(work.client, {})
+
+    def _index(self, work):
+        self._by_client.setdefault(work.client, {})[work.uid] = work
+        self._len += 1
+        self._positions = None
+
+    def _unindex(self, work):
+        client_works = self._by_client[work.client]
+        del client_works[work.uid]
+        if not client_works:
+            del self._by_client[work.client]
+        self._len -= 1
+        self._positions = None
+
+    def append(self, work):
+        self._index(work)
+        self._push(work)
+
+    def pop(self):
+        work = self._pop()
+        self._unindex(work)
+        return work
+
+    def remove(self, work) -> bool:
+        if work not in self:
+            return False
+        self._unindex(work)
+        self._discard(work)
+        return True
+
+    def remove_client(self, client) -> list:
+        works = list(self._by_client.get(client, {}).values())
+        for work in works:
+            self.remove(work)
+        return works
+
+    def position(self, work) -> int:
+        if self._positions is None:
+            self._positions = {w.uid: i for i, w in enumerate(self._dry_run())}
+        return self._positions[work.uid]
+
+    def clients(self):
+        return self._by_client.keys()
+
+    def client_works(self, client):
+        return self._by_client.get(client, {}).values()
+
+    def _push(self, work):
+        raise NotImplementedError
+
+    def _pop(self):
+        raise NotImplementedError
+
+    def _discard(self, work):
+        raise NotImplementedError
+
+    def _dry_run(self) -> list:
+        raise NotImplementedError
+
+
+class DeficitRoundRobinScheduler(_IndexedScheduler):
+    """
+    Fair queuing between clients: they take turns, and each turn a client gets quantum worth of cost
+    to spend on its works, in order. Unspent cost carries over to its next turn while it has works queued.
+    """
+
+    def __init__(self, quantum: float = None):
+        super().__init__()
+        self.quantum = estimate_cost({}) if quantum is None else quantum
+
+        self._queues: dict[object, collections.deque] = {}
+        self._costs: dict[int, float] = {}
+        # Clients with queued works, the first one is the one whose turn it is.
+        self._active = collections.deque()
+        self._deficit: dict[object, float] = {}
+
+    def _advance(self, active, deficit, head_cost):
+        """
+        Rotates the turns until a client can afford its next work, charges it and returns that client.
+        A client gets a quantum whenever its turn begins.
+        """
+        client = active[0]
+        if head_cost(client) > deficit[client]:
+            # Whole rounds in which no client can afford its next work give every client a quantum each,
+            # they're skipped at once rather than rotated through (a work may cost many quanta).
+            rounds = min(math.ceil((head_cost(c) - deficit[c]) / self.quantum) for c in active) - 1
+            if rounds > 0:
+                for c in active:
+                    deficit[c] += rounds * self.quantum
+        while True:
+            client = active[0]
+            cost = head_cost(client)
+            if cost <= deficit[client]:
+                deficit[client] -= cost
+                return client
+            active.rotate(-1)
+            deficit[active[0]] += self.quantum
+
+    def _deactivate(self, active, deficit, client):
+        was_head = active[0] == client
+        active.remove(client)
+        del deficit[client]
+        if was_head and active:
+            deficit[active[0]] += self.quantum
+
+    def _push(self, work):
+        self._costs[work.uid] = estimate_cost(work.args)
+        works = self._queues.get(work.client)
+        if works is None:
+            works = self._queues[work.client] = collections.deque()
+            self._active.append(work.client)
+            self._deficit[work.client] = self.quantum if len(self._active) == 1 else 0.0
+        works.append(work)
+
+    def _pop(self):
+        client = self._advance(self._active, self._deficit, lambda c: self._costs[self._queues[c][0].uid])
+        works = self._queues[client]
+        work = works.popleft()
+        del self._costs[work.uid]
+        if not works:
+            del self._queues[client]
+            self._deactivate(self._active, self._deficit, client)
+        return work
+
+    def _discard(self, work):
+        works = self._queues[work.client]
+        works.remove(work)
+        del self._costs[work.uid]
+        if not works:
+            del self._queues[work.client]
+            self._deactivate(self._active, self._deficit, work.client)
+
+    def _dry_run(self) -> list:
+        active = collections.deque(self._active)
+        deficit = dict(self._deficit)
+        heads = dict.fromkeys(self._queues, 0)
+        order = []
+        while active:
+            client = self._advance(active, deficit, lambda c: self._costs[self._queues[c][heads[c]].uid])
+            order.append(self._queues[client][heads[client]])
+            heads[client] += 1
+            if heads[client] == len(self._queues[client]):
+                self._deactivate(active, deficit, client)
+        return order
+
+
+class ShortestJobFirstScheduler(_IndexedScheduler):
+    """
+    Dispatches the cheapest work first (FIFO among equal costs). Minimizes mean wait, but can starve expensive works.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._heap = []
+        self._seq = itertools.count()
+
+    def _push(self, work):
+        heapq.heappush(self._heap, (estimate_cost(work.args), next(self._seq), work))
+
+    def _drop_removed(self):
+        while self._heap and self._heap[0][2] not in self:
+            heapq.heappop(self._heap)
+
+    def _pop(self):
+        self._drop_removed()
+        return heapq.heappop(self._heap)[2]
+
+    def _discard(self, work):
+        # Left in the heap and skipped when it comes up.
+        pass
+
+    def _dry_run(self) -> list:
+        return [work for _, _, work in sorted(self._heap) if work in self]
+
+
+SCHEDULERS = {
+    "fifo": FifoScheduler,
+    "drr": DeficitRoundRobinScheduler,
+    "sjf": ShortestJobFirstScheduler,
+}
+
+
+def create_scheduler(name: str):
+    return SCHEDULERS[name]()
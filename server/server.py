@@ -1,15 +1,23 @@
-import binascii
-import io
+import contextlib
 import logging
 import asyncio
 import json
-import base64
-import PIL
+import signal
+import uuid
 from PIL import Image
 import websockets
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
 from websockets.legacy.server import WebSocketServerProtocol
 
-import utils
+import admission
+import config
+import metrics
+import ingest
+import protocol
+import outbound
+import remote
+import request_trace
+import logs
 import worker
 
 
@@ -18,51 +26,104 @@ class ClientHandlingException(Exception):
         self.cause = cause
         self.extra_data = extra_data or {}
 
+
+class Session:
+    """
+    A conversation of a client about one image, its follow-ups only need the prompt.
+    """
+
+    def __init__(self, image: Image.Image, image_hash: str, model: str):
+        # Unique across clients, the workers cache the session's state by it.
+        self.key = uuid.uuid4().hex
+        self.image = image
+        self.image_hash = image_hash
+        self.model = model
+        self.history: str | None = None
+        self.turn = 0
+        # A turn is running, the next one has to wait for its answer.
+        self.busy = False
+
+
 class Server:
     def __init__(self):
         self.pool = worker.WorkerPool(
             self._on_queue_update,
             self._on_progress,
-            self._on_result
+            self._on_result,
+            failure_callback=self._on_failure
         )
 
-        self._clients: list[WebSocketServerProtocol, ...] = []
+        # Connected clients and their outbound queues.
+        self._outboxes: dict[WebSocketServerProtocol, outbound.Outbox] = {}
 
-    @staticmethod
-    async def send(conns: WebSocketServerProtocol | list[WebSocketServerProtocol, ...], event: str, msg: dict):
-        msg_json = json.dumps({"event": event, "data": msg}, ensure_ascii=False)
+        self._queue_notify_task = None
+        self._sent_queue_len = None
+        self._sent_positions: dict[WebSocketServerProtocol, dict[int, int]] = {}
+        # Sessions of every client by their session_id.
+        self._sessions: dict[WebSocketServerProtocol, dict[str, Session]] = {}
+        # Unfinished works of every client by request id, to cancel them.
+        self._works: dict[WebSocketServerProtocol, dict[int, worker.Work]] = {}
+
+        self._ingest_pool = ingest.Ingest(config.INGEST_THREADS, config.INGEST_MAX_PENDING)
+
+        self._trace = None
+        if config.TRACE_PATH is not None:
+            self._trace = request_trace.TraceRecorder(config.TRACE_PATH)
+
+    def send(self, conns: WebSocketServerProtocol | list[WebSocketServerProtocol, ...], event: str, msg: dict,
+             key=None):
+        """
+        Queues a message to one or more clients, see outbound.Outbox.put() for the key.
+        """
+        frame = outbound.encode(event, msg)
         if type(conns) is not list:
             conns = [conns]
 
         for conn in conns:
-            await conn.send(msg_json)
+            outbox = self._outboxes.get(conn)
+            # Gone otherwise.
+            if outbox is not None:
+                outbox.put(event, frame, key)
     # noinspection PyMethodMayBeStatic
     async def _handle(self, conn: WebSocketServerProtocol):
         logging.info(f"Accepted client: {conn.remote_address}")
-        self._clients.append(conn)
+        self._outboxes[conn] = outbound.Outbox(conn, config.OUTBOX_SIZE)
 
         while True:
             try:
                 msg_raw = await conn.recv()
-                try:
-                    msg = json.loads(msg_raw)
-                except json.JSONDecodeError as e:
-                    logging.warning(f"Failed to parse client message: {e}\n{msg_raw}")
-                    continue
+                payload = None
+                if isinstance(msg_raw, bytes):
+                    try:
+                        msg, payload = protocol.parse_frame(msg_raw)
+                    except protocol.ProtocolError as e:
+                        logging.warning(f"Failed to parse binary client message: {e}")
+                        continue
+                else:
+                    try:
+                        msg = json.loads(msg_raw)
+                    except json.JSONDecodeError as e:
+                        logging.warning(f"Failed to parse client message: {e}\n{msg_raw}")
+                        continue
                 logging.debug(f"Received {msg}")
 
                 try:
-                    await self._handle_client_message(conn, msg)
-                except Exception as e:
-                    logging.exception(f"An uncaught exception occurred when handling client message: {msg}", e)
+                    await self._handle_client_message(conn, msg, payload)
+                except Exception:
+                    logging.exception(f"An uncaught exception occurred when handling client message: {msg}")
             except websockets.WebSocketException as e:
                 logging.info(f"Client disconnected: {e}")
                 break
         
         self.pool.on_client_disconnect(conn)
-        self._clients.remove(conn)
+        self._outboxes.pop(conn).close()
+        self._sessions.pop(conn, None)
+        self._works.pop(conn, None)
+        if self._trace is not None:
+            self._trace.forget_client(conn)
+        await self._on_queue_update(self.pool.queue)
 
-    async def _handle_client_message(self, conn: WebSocketServerProtocol, msg: dict):
+    async def _handle_client_message(self, conn: WebSocketServerProtocol, msg: dict, payload: memoryview = None):
         event = msg.get("event")
         if event is None:
             logging.warning(f"Client message didn't defined the event type: {msg}")
@@ -71,10 +132,17 @@ class Server:
 
         if event == "submit":
             try:
-                await self._handle_submission(conn, data)
+                if payload is None:
+                    await self._handle_submission(conn, data)
+                else:
+                    await self._handle_binary_submission(conn, data, payload)
             except ClientHandlingException as e:
                 logging.warning(f"Failed to handle submission: {e.cause} {e.extra_data}")
-                await self.send(conn, "submit_fail", {"cause": e.cause, **e.extra_data})
+                self.send(conn, "submit_fail", {"cause": e.cause, **e.extra_data})
+        elif event == "cancel":
+            await self._handle_cancel(conn, data)
+        elif event == "stats":
+            self.send(conn, "stats", {**metrics.snapshot(), "embedding_cache": self.pool.embedding_cache_stats})
 
     async def _handle_submission(self, conn: WebSocketServerProtocol, data: dict):
         request_id = data.get("id")
@@ -83,49 +151,223 @@ class Server:
         image_width = data.get("image_width")
         image_height = data.get("image_height")
         args = data.get("args", {})
+        session_id = data.get("session_id")
+
+        error_extras = {} if request_id is None else {"id": request_id}
+        # Follow-ups of a session can leave the image out.
+        if type(request_id) is not int or\
+            type(prompt) is not str or\
+            (image is not None or session_id is None) and (
+                type(image) is not str or
+                type(image_width) is not int or
+                type(image_height) is not int) or\
+            type(args) is not dict or\
+            session_id is not None and type(session_id) is not str:
+            raise ClientHandlingException(
+                "Invalid id, prompt, image, args or session_id.",
+                error_extras
+            )
+        stream = data.get("stream") is True
+        model, args = self._model(args, stream, error_extras)
+        self._admit(conn, error_extras)
+
+        ingested = None
+        if image is not None:
+            ingested = await self._ingest(error_extras, ingest.ingest_base64, image, image_width, image_height)
+
+        await self._submit(conn, request_id, prompt, ingested, args, stream, session_id, model)
+
+    async def _handle_binary_submission(self, conn: WebSocketServerProtocol, data: dict, payload: memoryview):
+        request_id = data.get("id")
+        prompt = data.get("prompt")
+        image_format = data.get("format")
+        args = data.get("args", {})
+        session_id = data.get("session_id")
 
         error_extras = {} if request_id is None else {"id": request_id}
         if type(request_id) is not int or\
             type(prompt) is not str or\
-            type(image) is not str or\
-            type(image_width) is not int or\
-            type(image_height) is not int or\
-            type(args) is not dict:
+            image_format not in protocol.IMAGE_FORMATS or\
+            type(args) is not dict or\
+            session_id is not None and type(session_id) is not str:
             raise ClientHandlingException(
-                "Invalid id, prompt, image or args.",
+                "Invalid id, prompt, format, args or session_id.",
                 error_extras
             )
+        stream = data.get("stream") is True
+        model, args = self._model(args, stream, error_extras)
+        self._admit(conn, error_extras)
+
+        if len(payload) == 0 and session_id is not None:
+            # A follow-up without an image.
+            await self._submit(conn, request_id, prompt, None, args, stream, session_id, model)
+            return
+
+        ingested = await self._ingest(
+            error_extras, ingest.ingest_frame, payload, image_format, data.get("image_width"), data.get("image_height")
+        )
+        await self._submit(conn, request_id, prompt, ingested, args, stream, session_id, model)
+
+    @staticmethod
+    def _model(args: dict, stream: bool, error_extras: dict) -> tuple[str, dict]:
+        """
+        Takes the model variant (see config.MODELS) out of the generate arguments and checks the others,
+        and that the work can stream if asked to.
+        """
+        model = args.get("model", config.DEFAULT_MODEL)
+        if type(model) is not str or model not in config.MODELS:
+            raise ClientHandlingException(f"Unknown model, one of: {', '.join(config.MODELS)}.", error_extras)
+        args = {k: v for k, v in args.items() if k != "model"}
+        rejection = admission.check_args(args)
+        if rejection is None and stream:
+            rejection = admission.check_stream(model, args, worker.BATCHING)
+        if rejection is not None:
+            raise ClientHandlingException(rejection.cause, error_extras)
+        return model, args
+
+    def _admit(self, conn: WebSocketServerProtocol, error_extras: dict):
+        rejection = admission.check_load(
+            len(self.pool.queue), len(self._works.get(conn, {})), self.pool.estimated_wait()
+        )
+        if rejection is not None:
+            raise ClientHandlingException(rejection.cause, {**error_extras, **rejection.extra_data()})
 
+    async def _ingest(self, error_extras: dict, func, *args) -> ingest.Ingested:
         try:
-            image = base64.b64decode(image, validate=True)
-            image = Image.frombytes("RGBA", (image_width, image_height), image).convert("RGB")
-        except (binascii.Error, PIL.UnidentifiedImageError) as e:
-            raise ClientHandlingException(f"Failed to load image: {e}", error_extras)
+            return await self._ingest_pool.run(func, *args)
+        except ingest.IngestError as e:
+            raise ClientHandlingException(e.cause, {**error_extras, **e.extra_data})
 
-        work = worker.Work(conn, request_id, prompt, image, args)
-        logging.info(f"Submitting work: {prompt}")
+    async def _handle_cancel(self, conn: WebSocketServerProtocol, data: dict):
+        work = self._works.get(conn, {}).pop(data.get("id"), None)
+        if work is None:
+            # Finished already, or never submitted.
+            return
+        self.pool.cancel(work)
+        session = self._work_session(work)
+        if session is not None:
+            # The turn never happened.
+            session.busy = False
+        self.send(conn, "cancelled", {"id": work.request_id})
+        await self._on_queue_update(self.pool.queue)
+
+    def _work_session(self, work: worker.Work) -> Session | None:
+        if work.session_id is None:
+            return None
+        return next((s for s in self._sessions.get(work.client, {}).values() if s.key == work.session_id), None)
+
+    def _session(self, conn: WebSocketServerProtocol, request_id: int, session_id: str, image: Image.Image | None,
+                 image_hash: str | None, model: str) -> Session:
+        """
+        Returns the client's session for a new turn, starting it or starting it over if the image changed.
+        """
+        sessions = self._sessions.setdefault(conn, {})
+        session = sessions.get(session_id)
+        if session is not None and session.busy:
+            raise ClientHandlingException("Session busy.", {"id": request_id})
+        if session is None or image_hash is not None and image_hash != session.image_hash:
+            if image is None:
+                raise ClientHandlingException("Unknown session, the first turn needs an image.", {"id": request_id})
+            session = sessions[session_id] = Session(image, image_hash, model)
+        elif model != session.model:
+            # The state cached by the workers is the other variant's, the conversation goes on without it.
+            session.key = uuid.uuid4().hex
+            session.model = model
+        return session
+
+    async def _submit(self, conn: WebSocketServerProtocol, request_id: int, prompt: str,
+                      ingested: ingest.Ingested | None, args: dict, stream: bool, session_id: str = None,
+                      model: str = config.DEFAULT_MODEL):
+        image, image_hash = ingested if ingested is not None else (None, None)
+        if session_id is None:
+            work = worker.Work(conn, request_id, prompt, image, args, image_hash, stream, model=model)
+        else:
+            session = self._session(conn, request_id, session_id, image, image_hash, model)
+            work = worker.Work(conn, request_id, prompt, session.image, args, session.image_hash, stream,
+                               session.key, session.turn, session.history, model)
+            session.busy = True
+        logging.info(f"Submitting work {work.uid}: {prompt}", extra={"stage": "submit", "uid": work.uid})
+        if self._trace is not None:
+            self._trace.record(work)
+        self._works.setdefault(conn, {})[request_id] = work
         await self.pool.submit(work)
 
     async def _on_queue_update(self, queue):
-        await self.send(self._clients, "queue_len", {"len": len(queue)})
+        # Debounced: every change within QUEUE_NOTIFY_INTERVAL ends up in one round of notifications.
+        if self._queue_notify_task is None:
+            self._queue_notify_task = asyncio.create_task(self._notify_queue(queue))
+
+    async def _notify_queue(self, queue):
+        await asyncio.sleep(config.QUEUE_NOTIFY_INTERVAL)
+        self._queue_notify_task = None
 
-        for i, work in enumerate(queue):
-            await self.send(work.client, "queue_pos", {"id": work.request_id, "pos": i})
+        if len(queue) != self._sent_queue_len:
+            self._sent_queue_len = len(queue)
+            self.send(list(self._outboxes), "queue_len", {"len": len(queue)}, key="queue_len")
+
+        sent_positions = {}
+        for client in list(queue.clients()):
+            positions = {w.request_id: queue.position(w) for w in queue.client_works(client)}
+            sent_positions[client] = positions
+            last = self._sent_positions.get(client, {})
+            changed = [[request_id, pos] for request_id, pos in positions.items() if last.get(request_id) != pos]
+            if changed:
+                # Only the changes, so these can't be dropped.
+                self.send(client, "queue_positions", {"positions": changed})
+        self._sent_positions = sent_positions
 
     async def _on_progress(self, _, work, progress):
-        await self.send(work.client, "progress", {"id": work.request_id, "progress": progress})
+        if isinstance(progress, worker.Partial):
+            self.send(work.client, "partial", {"id": work.request_id, "text": progress.texts},
+                      key=("partial", work.request_id))
+            return
+        self.send(work.client, "progress", {"id": work.request_id, "progress": progress},
+                  key=("progress", work.request_id))
 
     async def _on_result(self, _, work, result):
-        await self.send(work.client, "result", {"id": work.request_id, "result": result})
+        self._works.get(work.client, {}).pop(work.request_id, None)
+        session = self._work_session(work)
+        if session is not None:
+            session.history = f"{work.full_prompt} {result[0] if result else ''}".rstrip()
+            session.turn += 1
+            session.busy = False
+        self.send(work.client, "result", {"id": work.request_id, "result": result})
+
+    async def _on_failure(self, work, cause: str):
+        self._works.get(work.client, {}).pop(work.request_id, None)
+        session = self._work_session(work)
+        if session is not None:
+            # The turn never happened.
+            session.busy = False
+        self.send(work.client, "submit_fail", {"id": work.request_id, "cause": cause})
 
     async def main(self):
-        async with websockets.serve(self._handle, "localhost", 8001):
-            while True:
-                await self.pool.update()
-                await asyncio.sleep(0.01)
+        # Stops on SIGTERM like on Ctrl+C, releasing the workers and the shared memory of the pool.
+        with contextlib.suppress(NotImplementedError):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        try:
+            await self._serve()
+        finally:
+            self.pool.close()
+            self._ingest_pool.close()
+
+    async def _serve(self):
+        if config.METRICS_PORT is not None:
+            await metrics.serve(config.METRICS_HOST, config.METRICS_PORT)
+        if config.REMOTE_WORKERS_PORT is not None:
+            await remote.serve(self.pool, config.REMOTE_WORKERS_HOST, config.REMOTE_WORKERS_PORT)
+        extensions = None
+        if config.WEBSOCKET_COMPRESSION:
+            # Smaller windows than the defaults, much less memory per connection for about the same ratio.
+            extensions = [ServerPerMessageDeflateFactory(
+                server_max_window_bits=12, client_max_window_bits=12, compress_settings={"memLevel": 5}
+            )]
+        async with websockets.serve(self._handle, "localhost", 8001, compression=None, extensions=extensions):
+            await self.pool.run(config.DISPATCH_POLL_INTERVAL)
 
 
 if __name__ == '__main__':
-    utils.configure_logger(logging.getLogger())
+    logs.start()
     server = Server()
-    asyncio.run(server.main())
+    with contextlib.suppress(asyncio.CancelledError):
+        asyncio.run(server.main())
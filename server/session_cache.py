@@ -0,0 +1,95 @@
+import collections
+import time
+import typing
+
+import torch
+
+
+class Session(typing.NamedTuple):
+    # Number of turns the cached state covers.
+    turn: int
+    # Past key values (batch size 1) of everything the model has seen in this session, but the pending tokens.
+    past: list[tuple[torch.Tensor, torch.Tensor]]
+    # The last prompt token and the answer of the last turn, prefilled with the next turn.
+    pending: list[int]
+
+
+def _past_bytes(past) -> int:
+    return sum(t.element_size() * t.nelement() for kv in past for t in kv)
+
+
+class SessionCache:
+    """
+    Decoder state of multi-turn sessions, so a follow-up only prefills its new tokens.
+    LRU within max_bytes of key/value tensors, sessions idle for idle_timeout seconds are dropped.
+    """
+
+    def __init__(self, max_bytes: int, idle_timeout: float):
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+
+        # Least recently used first: session id -> (session, size in bytes, last use).
+        self._entries: collections.OrderedDict[str, tuple[Session, int, float]] = collections.OrderedDict()
+        self._bytes = 0
+        # Net changes since the last drain_changes().
+        self._added = set()
+        self._evicted = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, session_id: str):
+        return session_id in self._entries
+
+    @property
+    def bytes(self) -> int:
+        return self._bytes
+
+    def get(self, session_id: str, turn: int) -> Session | None:
+        """
+        Returns the session if its cached state is at the given turn.
+        """
+        entry = self._entries.get(session_id)
+        if entry is None or entry[0].turn != turn:
+            return None
+        self._entries[session_id] = (entry[0], entry[1], time.monotonic())
+        self._entries.move_to_end(session_id)
+        return entry[0]
+
+    def _remove(self, session_id: str):
+        _, size, _ = self._entries.pop(session_id)
+        self._bytes -= size
+        self._added.discard(session_id)
+        self._evicted.add(session_id)
+
+    def put(self, session_id: str, session: Session):
+        if session_id in self._entries:
+            self._remove(session_id)
+        size = _past_bytes(session.past)
+        if size > self.max_bytes:
+            return
+
+        while self._bytes + size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+        self._entries[session_id] = (session, size, time.monotonic())
+        self._bytes += size
+        self._evicted.discard(session_id)
+        self._added.add(session_id)
+
+    def expire(self):
+        now = time.monotonic()
+        while self._entries:
+            session_id, (_, _, last_used) = next(iter(self._entries.items()))
+            if now - last_used < self.idle_timeout:
+                break
+            self._remove(session_id)
+
+    def drain_changes(self) -> tuple[list[str], list[str]]:
+        """
+        Returns the sessions added and evicted since the last call, so another process can mirror the contents.
+        """
+        added, evicted = list(self._added), list(self._evicted)
+        self._added.clear()
+        self._evicted.clear()
+        return added, evicted
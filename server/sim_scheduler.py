@@ -0,0 +1,129 @@
+"""
+Discrete event simulation of the work queue policies in scheduling.py on synthetic workloads.
+Reports p50/p95/p99 queue wait times per policy, overall and for the light (default args) clients.
+
+Service time of a work is estimate_cost(args) * --time-per-token, with some noise.
+Workers take one work at a time.
+
+    python sim_scheduler.py [--workers 9] [--time-per-token 0.015] [--seed 0]
+"""
+import argparse
+import heapq
+import itertools
+import random
+
+import scheduling
+
+
+class SimWork:
+    _uids = itertools.count()
+
+    def __init__(self, client: str, args: dict, arrival: float):
+        self.uid = next(self._uids)
+        self.client = client
+        self.args = args
+        self.arrival = arrival
+
+
+HEAVY_ARGS = {"num_beams": 5, "max_length": 100}
+LIGHT_ARGS = {}
+GREEDY_ARGS = {"num_beams": 1, "max_length": 30}
+
+
+def _poisson(rng: random.Random, client: str, args: dict, rate: float, duration: float, start: float = 0.0):
+    t = start
+    while True:
+        t += rng.expovariate(rate)
+        if t > duration:
+            return
+        yield SimWork(client, args, t)
+
+
+def workload_uniform(rng: random.Random) -> list[SimWork]:
+    """20 clients with default args at a steady rate."""
+    works = []
+    for i in range(20):
+        works += _poisson(rng, f"client {i}", LIGHT_ARGS, 0.15, 600)
+    return works
+
+
+def workload_heavy_hitter(rng: random.Random) -> list[SimWork]:
+    """Light clients plus one client that submits bursts of 50 expensive requests."""
+    works = []
+    for i in range(10):
+        works += _poisson(rng, f"client {i}", LIGHT_ARGS, 0.1, 600)
+    for burst in range(0, 600, 120):
+        works += [SimWork("heavy", HEAVY_ARGS, burst + rng.random()) for _ in range(50)]
+    return works
+
+
+def workload_mixed(rng: random.Random) -> list[SimWork]:
+    """Clients with a random mix of greedy, default and expensive requests."""
+    works = []
+    for i in range(15):
+        for args in (LIGHT_ARGS, GREEDY_ARGS, HEAVY_ARGS):
+            works += _poisson(rng, f"client {i}", args, 0.04, 600)
+    return works
+
+
+WORKLOADS = {
+    "uniform": workload_uniform,
+    "heavy hitter": workload_heavy_hitter,
+    "mixed": workload_mixed,
+}
+
+
+def simulate(policy: str, works: list[SimWork], num_workers: int, time_per_token: float, rng: random.Random) -> dict:
+    """
+    Returns the queue wait time of every work, by uid.
+    """
+    queue = scheduling.create_scheduler(policy)
+    events = [(w.arrival, 0, w.uid, w) for w in works]
+    heapq.heapify(events)
+    free_workers = num_workers
+    waits = {}
+
+    while events:
+        now, kind, _, work = heapq.heappop(events)
+        if kind == 0:
+            queue.append(work)
+        else:
+            free_workers += 1
+
+        while free_workers > 0 and len(queue) > 0:
+            work = queue.pop()
+            waits[work.uid] = now - work.arrival
+            service = scheduling.estimate_cost(work.args) * time_per_token * rng.uniform(0.8, 1.2)
+            heapq.heappush(events, (now + service, 1, work.uid, work))
+            free_workers -= 1
+    return waits
+
+
+def percentile(values, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=9)
+    parser.add_argument("--time-per-token", type=float, default=0.015,
+                        help="Seconds of service time per estimated cost unit.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for workload_name, workload in WORKLOADS.items():
+        works = workload(random.Random(args.seed))
+        print(f"== {workload_name} ({len(works)} works)")
+        print(f"{'policy':<8} {'':<8} {'p50':>9} {'p95':>9} {'p99':>9}")
+        for policy in scheduling.SCHEDULERS:
+            waits = simulate(policy, works, args.workers, args.time_per_token, random.Random(args.seed))
+            light = [waits[w.uid] for w in works if w.args is LIGHT_ARGS]
+            for name, values in (("all", list(waits.values())), ("light", light)):
+                print(f"{policy:<8} {name:<8} "
+                      + " ".join(f"{percentile(values, p):8.2f}s" for p in (50, 95, 99)))
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+"""
+Speculative (assisted) decoding of one greedy request: a small draft model proposes a few tokens, the model checks
+them all in one forward pass and keeps the longest prefix it agrees with, plus its own next token.
+The output is the model's greedy one, in fewer of its forward passes the more the draft guesses right.
+
+The draft is an OPT sharing the model's tokenizer (e.g. facebook/opt-125m for the BLIP-2 OPT models). It sees the same
+projected query embeddings as the model, mapped to its own embedding space by a least squares fit between the two
+token embedding tables (see fit_projection()), so it knows something about the image without a trained projection.
+"""
+import contextlib
+
+import torch
+
+
+class Draft:
+    """
+    A draft model and the projection of the model's input embeddings to its own, None if they're the same.
+    Counts the tokens it proposed and the ones the model accepted, see drain_counts().
+    """
+
+    def __init__(self, model: torch.nn.Module, projection: torch.Tensor | None = None):
+        self.model = model
+        self.projection = projection
+        self.proposed = 0
+        self.accepted = 0
+
+    def embed(self, query_embeds: torch.Tensor | None, input_ids: torch.Tensor) -> torch.Tensor:
+        embeds = self.model.get_input_embeddings()(input_ids)
+        if query_embeds is None:
+            return embeds
+        if self.projection is not None:
+            query_embeds = query_embeds.float() @ self.projection
+        return torch.cat([query_embeds.to(embeds.dtype), embeds], dim=1)
+
+    def drain_counts(self) -> tuple[int, int]:
+        """
+        Returns the tokens proposed and accepted since the last call.
+        """
+        counts = self.proposed, self.accepted
+        self.proposed = self.accepted = 0
+        return counts
+
+
+def fit_projection(embeddings: torch.Tensor, draft_embeddings: torch.Tensor, ridge: float = 1e-3) -> torch.Tensor:
+    """
+    Least squares map from the model's token embeddings to the draft's, token by token, ridge regularized.
+    Computed in float32 on the device of the model's embeddings.
+    """
+    if embeddings.shape[0] != draft_embeddings.shape[0]:
+        raise ValueError(
+            f"The draft doesn't share the vocabulary: {draft_embeddings.shape[0]} tokens, not {embeddings.shape[0]}."
+        )
+    x = embeddings.float()
+    y = draft_embeddings.to(x.device).float()
+    gram = x.T @ x
+    gram += ridge * gram.diagonal().mean() * torch.eye(gram.shape[0], device=x.device)
+    return torch.linalg.solve(gram, x.T @ y)
+
+
+def _forward(model, inputs_embeds: torch.Tensor, past):
+    length = inputs_embeds.shape[1] + (0 if past is None else past[0][0].shape[2])
+    outputs = model(
+        inputs_embeds=inputs_embeds,
+        attention_mask=torch.ones((1, length), dtype=torch.long, device=inputs_embeds.device),
+        past_key_values=None if past is None else tuple(past),
+        use_cache=True,
+        return_dict=True,
+    )
+    past = outputs.past_key_values
+    if hasattr(past, "to_legacy_cache"):
+        past = past.to_legacy_cache()
+    return outputs.logits[0].float(), list(past)
+
+
+def _truncate(past, length: int):
+    return [(k[:, :, :length], v[:, :, :length]) for k, v in past]
+
+
+def _greedy(logits: torch.Tensor, seen: list[int], generated: int, min_length: int, repetition_penalty: float,
+            eos_token_id: int) -> int:
+    # The logits processing of batching.py, min_length only counts the generated tokens.
+    if repetition_penalty != 1.0:
+        logits = logits.clone()
+        index = torch.tensor(seen, device=logits.device).unique()
+        score = logits[index]
+        logits[index] = torch.where(score < 0, score * repetition_penalty, score / repetition_penalty)
+    if generated < min_length:
+        logits = logits.clone()
+        logits[eos_token_id] = -float("inf")
+    return int(logits.argmax())
+
+
+@torch.no_grad()
+def generate(model, draft: Draft, query_embeds: torch.Tensor, input_ids: torch.Tensor, eos_token_id: int,
+             max_length: int = 30, min_length: int = 1, repetition_penalty: float = 1.0, num_draft_tokens: int = 4,
+             should_stop=None, autocast=contextlib.nullcontext) -> list[int]:
+    """
+    Decodes greedily with the help of the draft.
+    query_embeds are the projected Q-Former outputs of one image, input_ids the tokenized prompt (batch size 1).
+    should_stop is polled with the number of tokens generated so far after every round, like in Model.generate().
+    Returns the generated tokens, up to the EOS token included.
+    """
+    prompt = input_ids[0].tolist()
+    tokens: list[int] = []
+    with autocast():
+        # Like batching.py, the last prompt token is fed with the first round.
+        embed = model.get_input_embeddings()
+        inputs_embeds = torch.cat([query_embeds, embed(input_ids[:, :-1]).to(query_embeds.dtype)], dim=1)
+        _, past = _forward(model, inputs_embeds, None)
+        _, draft_past = _forward(draft.model, draft.embed(query_embeds, input_ids[:, :-1]), None)
+    # Tokens in the model's cache, and the ones the draft still has to be fed.
+    length = past[0][0].shape[2]
+    pending = prompt[-1:]
+
+    while len(tokens) < max_length and not (tokens and tokens[-1] == eos_token_id):
+        if should_stop is not None and should_stop(len(tokens)):
+            break
+        k = min(num_draft_tokens, max_length - len(tokens) - 1)
+
+        with autocast():
+            proposal = []
+            draft_input = pending
+            for _ in range(k):
+                logits, draft_past = _forward(
+                    draft.model, draft.embed(None, torch.tensor([draft_input], device=input_ids.device)), draft_past
+                )
+                proposal.append(_greedy(logits[-1], prompt + tokens + proposal, len(tokens) + len(proposal),
+                                        min_length, repetition_penalty, eos_token_id))
+                draft_input = proposal[-1:]
+                if proposal[-1] == eos_token_id:
+                    break
+
+            # One pass over the last token and the proposal gives the model's choice after each of them.
+            verify = [tokens[-1] if tokens else prompt[-1]] + proposal
+            logits, past = _forward(model, embed(torch.tensor([verify], device=input_ids.device)), past)
+
+        accepted = 0
+        choice = None
+        for i in range(len(proposal) + 1):
+            choice = _greedy(logits[i], prompt + tokens + proposal[:i], len(tokens) + i,
+                             min_length, repetition_penalty, eos_token_id)
+            if i == len(proposal) or proposal[i] != choice:
+                break
+            accepted += 1
+        draft.proposed += len(proposal)
+        draft.accepted += accepted
+
+        new_tokens = proposal[:accepted] + [choice]
+        if eos_token_id in new_tokens:
+            new_tokens = new_tokens[:new_tokens.index(eos_token_id) + 1]
+        new_tokens = new_tokens[:max_length - len(tokens)]
+
+        # The model's cache keeps the fed tokens that were accepted, the draft's the ones it was fed of those.
+        length += 1 + accepted
+        past = _truncate(past, length)
+        draft_fed = len(pending) + len(proposal) - 1 if proposal else 0
+        draft_kept = min(draft_fed, len(pending) + accepted)
+        draft_past = _truncate(draft_past, draft_past[0][0].shape[2] - draft_fed + draft_kept)
+        pending = (pending + proposal[:accepted])[draft_kept:] + [choice]
+        tokens += new_tokens
+    return tokens
+
+
+if __name__ == '__main__':
+    # Self check on CPU with tiny randomly initialized OPTs: whatever the draft proposes,
+    # the output must be the model's greedy decoding. A draft that is the model itself gets everything accepted.
+    from transformers import OPTConfig, OPTForCausalLM
+
+    def tiny_opt(hidden_size: int, seed: int):
+        torch.manual_seed(seed)
+        return OPTForCausalLM(OPTConfig(
+            vocab_size=64, hidden_size=hidden_size, num_hidden_layers=2, ffn_dim=64, num_attention_heads=4,
+            max_position_embeddings=128, word_embed_proj_dim=hidden_size,
+        )).eval()
+
+    def reference(model, query, ids, args, eos):
+        # Greedy decoding with the same logits processing, one token per forward pass.
+        embed = model.get_input_embeddings()
+        past = None
+        inputs_embeds = torch.cat([query, embed(ids)], dim=1)
+        prompt, tokens = ids[0].tolist(), []
+        while len(tokens) < args["max_length"]:
+            logits, past = _forward(model, inputs_embeds, past)
+            tokens.append(_greedy(logits[-1], prompt + tokens, len(tokens), args["min_length"],
+                                  args["repetition_penalty"], eos))
+            if tokens[-1] == eos:
+                break
+            inputs_embeds = embed(torch.tensor([tokens[-1:]]))
+        return tokens
+
+    model = tiny_opt(32, 0)
+    eos = 2
+    drafts = {
+        "self": Draft(model),
+        "other": Draft(tiny_opt(32, 1)),
+        "projected": Draft(tiny_opt(16, 2)),
+    }
+    drafts["projected"].projection = fit_projection(
+        model.get_input_embeddings().weight, drafts["projected"].model.get_input_embeddings().weight
+    )
+
+    # Plain greedy decoding with transformers for the default processing, as a check of reference().
+    query, ids = torch.randn(1, 4, 32), torch.randint(3, 64, (1, 3))
+    embeds = torch.cat([query, model.get_input_embeddings()(ids)], dim=1)
+    out = model.generate(
+        inputs_embeds=embeds, attention_mask=torch.ones(embeds.shape[:2], dtype=torch.long),
+        do_sample=False, num_beams=1, max_new_tokens=12, min_length=0, eos_token_id=eos, pad_token_id=1,
+    )[0].tolist()
+    if eos in out:
+        out = out[:out.index(eos) + 1]
+    assert reference(model, query, ids, {"max_length": 12, "min_length": 0, "repetition_penalty": 1.0}, eos) == out
+
+    for i in range(20):
+        query, ids = torch.randn(1, 4, 32), torch.randint(3, 64, (1, 2 + i % 4))
+        args = {"max_length": 4 + i, "min_length": i % 3, "repetition_penalty": 1.0 if i % 2 else 1.3}
+        expected = reference(model, query, ids, args, eos)
+        for name, draft in drafts.items():
+            result = generate(model, draft, query, ids, eos, num_draft_tokens=1 + i % 5, **args)
+            assert result == expected, (name, i, result, expected)
+
+    assert drafts["self"].accepted == drafts["self"].proposed > 0, drafts["self"].drain_counts()
+    print("OK", {name: draft.drain_counts() for name, draft in drafts.items()})
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The server modules import each other by bare name, like when run from server/.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+# DummyModel workers, importing worker.py doesn't need LAVIS then.
+os.environ.setdefault("BTLP2_DEBUGGING", "1")
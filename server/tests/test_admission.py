@@ -0,0 +1,118 @@
+import math
+
+import pytest
+
+import admission
+import config
+
+
+@pytest.mark.parametrize("args", [
+    {},
+    {"num_beams": 3, "max_length": 40, "min_length": 5, "length_penalty": -1.0},
+    {"use_nucleus_sampling": True, "top_p": 1, "temperature": 0.7, "num_captions": 3},
+    {"repetition_penalty": 1.5, "speculative": True},
+])
+def test_valid_args(args):
+    assert admission.check_args(dict(args)) is None
+
+
+@pytest.mark.parametrize("args, cause", [
+    ({"beams": 3}, "Unknown argument beams"),
+    ({"num_beams": "3"}, "Invalid num_beams"),
+    ({"num_beams": 3.0}, "Invalid num_beams"),
+    ({"num_beams": True}, "Invalid num_beams"),
+    ({"use_nucleus_sampling": 1}, "Invalid use_nucleus_sampling"),
+    ({"temperature": 0}, "Invalid temperature"),
+    ({"temperature": -1.0}, "Invalid temperature"),
+    ({"top_p": -1}, "Invalid top_p"),
+    ({"top_p": 1.5}, "Invalid top_p"),
+    ({"repetition_penalty": 0.0}, "Invalid repetition_penalty"),
+    ({"length_penalty": math.nan}, "Invalid length_penalty"),
+    ({"temperature": math.inf}, "Invalid temperature"),
+    ({"max_length": 0}, "Invalid max_length"),
+    ({"max_length": config.GENERATE_ARG_LIMITS["max_length"] + 1}, "Invalid max_length"),
+    ({"num_captions": config.GENERATE_ARG_LIMITS["num_captions"] + 1}, "Invalid num_captions"),
+    ({"min_length": 40}, "Invalid min_length"),
+    ({"min_length": -1, "max_length": 40}, "Invalid min_length"),
+])
+def test_invalid_args(args, cause):
+    rejection = admission.check_args(args)
+    assert rejection is not None and rejection.cause.startswith(cause)
+    assert rejection.retry_after is None and rejection.extra_data() == {}
+
+
+def test_speculative_without_effect_is_dropped(monkeypatch):
+    monkeypatch.setattr(config, "DRAFT_MODEL", "draft")
+    for args in ({"speculative": False}, {"speculative": True, "use_nucleus_sampling": True}):
+        assert admission.check_args(args) is None
+        assert "speculative" not in args
+    args = {"speculative": True}
+    assert admission.check_args(args) is None and args == {"speculative": True}
+
+    monkeypatch.setattr(config, "DRAFT_MODEL", None)
+    assert admission.check_args(args) is None and args == {}
+
+
+def test_stream():
+    assert admission.check_stream(config.DEFAULT_MODEL, {}, True) is None
+    assert admission.check_stream(config.DEFAULT_MODEL, {"num_beams": 1}, True) is None
+    assert admission.check_stream(config.DEFAULT_MODEL, {"num_beams": 3, "use_nucleus_sampling": True}, True) is None
+    assert admission.check_stream(config.DEFAULT_MODEL, {"num_beams": 3}, True) is not None
+    assert admission.check_stream(config.DEFAULT_MODEL, {"speculative": True}, True) is not None
+    assert admission.check_stream(config.DEFAULT_MODEL, {}, False) is not None
+    t5 = next((m for m, (name, _) in config.MODELS.items() if name == "blip2_t5"), None)
+    if t5 is not None:
+        assert admission.check_stream(t5, {}, True) is not None
+
+
+def test_image_size(monkeypatch):
+    monkeypatch.setattr(config, "MAX_IMAGE_PIXELS", 100)
+    assert admission.check_image_size(10, 10) is None
+    assert admission.check_image_size(0, 10) is not None
+    assert admission.check_image_size(11, 10).cause.startswith("Image too large")
+    monkeypatch.setattr(config, "MAX_IMAGE_PIXELS", None)
+    assert admission.check_image_size(10000, 10000) is None
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(config, "MAX_CLIENT_WORKS", 4)
+    monkeypatch.setattr(config, "MAX_QUEUE_DEPTH", 10)
+    monkeypatch.setattr(config, "MAX_ESTIMATED_WAIT", 60.0)
+    monkeypatch.setattr(config, "DEFAULT_RETRY_AFTER", 5.0)
+
+
+def test_load_within_limits(limits):
+    assert admission.check_load(9, 3, 59.0) is None
+    assert admission.check_load(0, 0, None) is None
+
+
+def test_client_limit(limits):
+    rejection = admission.check_load(0, 4, None)
+    assert rejection.cause.startswith("Too many unfinished requests")
+    assert rejection.retry_after is None
+
+
+def test_queue_full(limits):
+    # Without an estimate, the default hint.
+    assert admission.check_load(10, 0, None).extra_data() == {"retry_after": 5}
+    # Until one work of the queue is dispatched, at 2 seconds per work.
+    assert admission.check_load(10, 0, 20.0).extra_data() == {"retry_after": 2}
+    assert admission.check_load(12, 0, 24.0).extra_data() == {"retry_after": 6}
+
+
+def test_wait_too_long(limits):
+    rejection = admission.check_load(5, 0, 75.5)
+    assert rejection.cause.startswith("Estimated wait too long")
+    assert rejection.extra_data() == {"retry_after": 16}
+
+
+@pytest.mark.parametrize("name", ["MAX_CLIENT_WORKS", "MAX_QUEUE_DEPTH", "MAX_ESTIMATED_WAIT"])
+def test_limits_can_be_disabled(limits, monkeypatch, name):
+    monkeypatch.setattr(config, name, None)
+    rejected = {
+        "MAX_CLIENT_WORKS": (0, 100, None),
+        "MAX_QUEUE_DEPTH": (100, 0, None),
+        "MAX_ESTIMATED_WAIT": (0, 0, 1e9),
+    }[name]
+    assert admission.check_load(*rejected) is None
@@ -0,0 +1,75 @@
+import asyncio
+
+import outbound
+
+
+class _Connection:
+    remote_address = ("test", 0)
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, frame, text=False):
+        self.sent.append(frame)
+
+
+async def _drain(outbox: outbound.Outbox):
+    # The writer only runs once the messages are queued, like when they're put within one callback.
+    while len(outbox):
+        await asyncio.sleep(0)
+
+
+def test_sheds_the_oldest_droppable_messages():
+    async def run():
+        conn = _Connection()
+        outbox = outbound.Outbox(conn, 3)
+        outbox.put("result", b"result")
+        for i in range(4):
+            outbox.put("progress", b"progress %d" % i, key=("progress", i))
+        assert len(outbox) == 3
+
+        await _drain(outbox)
+        assert conn.sent == [b"result", b"progress 2", b"progress 3"]
+        outbox.close()
+
+    asyncio.run(run())
+
+
+def test_results_are_never_dropped():
+    async def run():
+        conn = _Connection()
+        outbox = outbound.Outbox(conn, 1)
+        outbox.put("progress", b"progress", key="progress")
+        for i in range(3):
+            outbox.put("result", b"result %d" % i)
+
+        await _drain(outbox)
+        assert conn.sent == [b"result 0", b"result 1", b"result 2"]
+        outbox.close()
+
+    asyncio.run(run())
+
+
+def test_same_key_replaces_in_place():
+    async def run():
+        conn = _Connection()
+        outbox = outbound.Outbox(conn, 10)
+        outbox.put("progress", b"old", key=("progress", 1))
+        outbox.put("result", b"other")
+        outbox.put("progress", b"new", key=("progress", 1))
+        assert len(outbox) == 2
+
+        await _drain(outbox)
+        assert conn.sent == [b"new", b"other"]
+
+        # Sent messages aren't replaced anymore.
+        outbox.put("progress", b"newer", key=("progress", 1))
+        await _drain(outbox)
+        assert conn.sent == [b"new", b"other", b"newer"]
+        outbox.close()
+
+    asyncio.run(run())
+
+
+def test_encode():
+    assert outbound.encode("result", {"text": "é"}) == '{"event": "result", "data": {"text": "é"}}'.encode()
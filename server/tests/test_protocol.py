@@ -0,0 +1,49 @@
+import io
+
+import pytest
+from PIL import Image
+
+import protocol
+
+
+def test_frame_round_trip():
+    header = {"event": "submit", "data": {"id": 1, "prompt": "Qu'est-ce que c'est ?"}}
+    frame = protocol.build_frame(header, b"payload")
+    parsed, payload = protocol.parse_frame(frame)
+    assert parsed == header
+    assert isinstance(payload, memoryview) and bytes(payload) == b"payload"
+
+
+def test_empty_payload():
+    _, payload = protocol.parse_frame(protocol.build_frame({}, b""))
+    assert len(payload) == 0
+
+
+@pytest.mark.parametrize("frame, message", [
+    (b"\x01\x00", "too short"),
+    ((100).to_bytes(4, "little") + b"{}", "exceeds"),
+    ((3).to_bytes(4, "little") + b"{x}", "Invalid header"),
+    ((2).to_bytes(4, "little") + b"\xff\xfe", "Invalid header"),
+    ((2).to_bytes(4, "little") + b"[]", "not an object"),
+])
+def test_invalid_frames(frame, message):
+    with pytest.raises(protocol.ProtocolError, match=message):
+        protocol.parse_frame(frame)
+
+
+def test_images_decode_from_the_payload_view():
+    buffer = io.BytesIO()
+    Image.new("RGB", (3, 2), (10, 20, 30)).save(buffer, "PNG")
+    _, payload = protocol.parse_frame(protocol.build_frame({"data": {"format": "png"}}, buffer.getvalue()))
+
+    image = Image.open(protocol.MemoryViewReader(payload))
+    assert image.size == (3, 2)
+    assert image.convert("RGB").getpixel((2, 1)) == (10, 20, 30)
+
+
+def test_memory_view_reader_seeks():
+    reader = protocol.MemoryViewReader(memoryview(b"0123456789"))
+    assert reader.seek(-3, io.SEEK_END) == 7
+    assert reader.read(10) == b"789"
+    assert reader.seek(-20, io.SEEK_CUR) == 0
+    assert reader.read(2) == b"01"
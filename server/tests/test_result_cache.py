@@ -0,0 +1,144 @@
+import asyncio
+
+import result_cache
+import worker
+
+
+def _work(client="a", args=None, session_id=None, turn=0, stream=False):
+    return worker.Work(client, 0, "What is this?", None, args or {}, "hash", stream, session_id, turn)
+
+
+def test_lru_eviction():
+    cache = result_cache.ResultCache(2, 60.0)
+    cache.put("a", ["A"])
+    cache.put("b", ["B"])
+    assert cache.get("a") == ["A"]
+    cache.put("c", ["C"])
+
+    assert cache.get("b") is None
+    assert cache.get("a") == ["A"]
+    assert cache.get("c") == ["C"]
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_ttl_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(result_cache.time, "monotonic", lambda: now[0])
+    cache = result_cache.ResultCache(10, 60.0)
+    cache.put("a", ["A"])
+
+    now[0] += 59.0
+    assert cache.get("a") == ["A"]
+    now[0] += 2.0
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_results_are_copied():
+    cache = result_cache.ResultCache(10, 60.0)
+    result = ["A"]
+    cache.put("a", result)
+    result.append("B")
+    cache.get("a").append("C")
+    assert cache.get("a") == ["A"]
+
+
+def test_zero_size_disables_the_cache():
+    cache = result_cache.ResultCache(0, 60.0)
+    cache.put("a", ["A"])
+    assert cache.get("a") is None
+
+
+def test_result_keys():
+    key = result_cache.result_key(_work())
+    assert key is not None
+    assert result_cache.result_key(_work(args={"num_beams": 5, "top_p": 0.5})) == key
+    assert result_cache.result_key(_work(args={"num_beams": 5.0})) == key
+    assert result_cache.result_key(_work(args={"speculative": True})) != key
+    assert result_cache.result_key(_work(args={"max_length": 20})) != key
+    assert result_cache.result_key(_work(stream=True, args={"num_beams": 1})) \
+        != result_cache.result_key(_work(args={"num_beams": 1}))
+    # Sampled works differ every time.
+    assert result_cache.result_key(_work(args={"use_nucleus_sampling": True})) is None
+    # The first turn of a session is like any work, its follow-ups depend on the earlier turns.
+    assert result_cache.result_key(_work(session_id="s")) == key
+    assert result_cache.result_key(_work(session_id="s", turn=1)) is None
+
+
+def _pool(events: list) -> worker.WorkerPool:
+    async def on_queue_update(queue):
+        pass
+
+    async def on_progress(_, work, progress):
+        events.append(("progress", work.client, progress))
+
+    async def on_result(_, work, result):
+        events.append(("result", work.client, result))
+
+    async def on_failure(work, cause):
+        events.append(("failure", work.client, cause))
+
+    # No workers, the works stay queued until the test plays their worker.
+    return worker.WorkerPool(on_queue_update, on_progress, on_result, devices=(), failure_callback=on_failure)
+
+
+def test_identical_works_share_one_run():
+    async def run():
+        events = []
+        pool = _pool(events)
+        on_progress, on_result = pool.worker_callbacks
+        first, second = _work("a"), _work("b")
+        await pool.submit(first)
+        await pool.submit(second)
+        assert list(pool.queue) == [first]
+
+        await on_progress(None, first, "5")
+        await on_result(None, first, ["A cat."])
+        assert events == [
+            ("progress", "a", "5"), ("progress", "b", "5"), ("result", "a", ["A cat."]), ("result", "b", ["A cat."])
+        ]
+
+        # Answered from the result cache from now on.
+        events.clear()
+        await pool.submit(_work("c"))
+        assert events == [("result", "c", ["A cat."])]
+        # Never dispatched here, the first one stays queued.
+        assert list(pool.queue) == [first]
+
+    asyncio.run(run())
+
+
+def test_cancelled_leader_hands_over():
+    async def run():
+        events = []
+        pool = _pool(events)
+        _, on_result = pool.worker_callbacks
+        first, second = _work("a"), _work("b")
+        await pool.submit(first)
+        await pool.submit(second)
+
+        assert pool.cancel(first)
+        assert list(pool.queue) == [second]
+        await on_result(None, second, ["A dog."])
+        assert events == [("result", "b", ["A dog."])]
+
+    asyncio.run(run())
+
+
+def test_failure_reaches_every_identical_work():
+    async def run():
+        events = []
+        pool = _pool(events)
+        first, second = _work("a"), _work("b")
+        await pool.submit(first)
+        await pool.submit(second)
+
+        await pool.fail(first, "The generation failed.")
+        assert events == [("failure", "a", "The generation failed."), ("failure", "b", "The generation failed.")]
+        # Nothing was cached, the next one runs again.
+        third = _work("c")
+        await pool.submit(third)
+        assert third in pool.queue
+
+    asyncio.run(run())
@@ -0,0 +1,77 @@
+import types
+
+import scheduling
+
+
+def _work(uid: int, client="a", **args):
+    return types.SimpleNamespace(uid=uid, client=client, args=args)
+
+
+def test_estimates():
+    assert scheduling.estimate_rows({}) == 5
+    assert scheduling.estimate_rows({"use_nucleus_sampling": True, "num_captions": 3, "num_beams": 8}) == 3
+    assert scheduling.estimate_cost({}) == scheduling.ENCODE_COST + 5 * 30
+    assert scheduling.estimate_cost({"num_beams": 1, "max_length": 10}) == scheduling.ENCODE_COST + 10
+    # Garbage falls back to the defaults.
+    assert scheduling.estimate_cost({"max_length": "long"}) == scheduling.estimate_cost({})
+
+
+def test_drr_takes_turns_between_clients():
+    queue = scheduling.DeficitRoundRobinScheduler()
+    for i in range(4):
+        queue.append(_work(i, "a"))
+    queue.append(_work(4, "b"))
+
+    # b's work doesn't wait behind all of a's.
+    assert [queue.pop().uid for _ in range(5)] == [0, 4, 1, 2, 3]
+
+
+def test_drr_shares_by_cost():
+    queue = scheduling.DeficitRoundRobinScheduler()
+    # Works of a cost two quanta, those of b one.
+    assert scheduling.estimate_cost({"max_length": 64}) == 2 * queue.quantum
+    for i in range(6):
+        queue.append(_work(i, "a", max_length=64))
+    for i in range(6, 12):
+        queue.append(_work(i, "b"))
+
+    clients = [queue.pop().client for _ in range(9)]
+    assert clients.count("b") == 2 * clients.count("a")
+
+
+def test_drr_doesnt_starve_expensive_works():
+    queue = scheduling.DeficitRoundRobinScheduler()
+    expensive = _work(0, "a", num_beams=10, max_length=256)
+    queue.append(expensive)
+    for i in range(1, 30):
+        queue.append(_work(i, "b"))
+
+    # 15.2 quanta: a's turns add up to it while b spends one quantum per work.
+    assert scheduling.estimate_cost(expensive.args) / queue.quantum > 15
+    assert queue.position(expensive) == 15
+    assert [queue.pop() for _ in range(30)].index(expensive) == 15
+
+
+def test_drr_new_client_starts_at_the_end_of_the_round():
+    queue = scheduling.DeficitRoundRobinScheduler()
+    queue.append(_work(0, "a"))
+    queue.append(_work(1, "a"))
+    assert queue.pop().uid == 0
+    queue.append(_work(2, "b"))
+    assert [queue.pop().uid for _ in range(2)] == [2, 1]
+
+
+def test_sjf_orders_by_cost_then_arrival():
+    queue = scheduling.ShortestJobFirstScheduler()
+    big = _work(0, max_length=100)
+    small = _work(1, num_beams=1)
+    mid = _work(2)
+    small_too = _work(3, num_beams=1)
+    for w in (big, small, mid, small_too):
+        queue.append(w)
+
+    assert list(queue) == [small, small_too, mid, big]
+    assert queue.position(mid) == 2
+    queue.remove(small_too)
+    assert queue.position(mid) == 1
+    assert [queue.pop() for _ in range(3)] == [small, mid, big]
@@ -0,0 +1,82 @@
+import types
+
+import pytest
+
+import scheduling
+from work_queue import WorkQueue
+
+
+def _work(uid: int, client="a", **args):
+    return types.SimpleNamespace(uid=uid, client=client, args=args)
+
+
+def test_positions_skip_removed_works():
+    queue = WorkQueue()
+    works = [_work(i) for i in range(5)]
+    for w in works:
+        queue.append(w)
+
+    assert queue.remove(works[1])
+    assert queue.remove(works[3])
+    assert not queue.remove(works[3])
+    assert len(queue) == 3
+    assert [queue.position(w) for w in (works[0], works[2], works[4])] == [0, 1, 2]
+
+    assert queue.popleft() is works[0]
+    assert [queue.position(w) for w in (works[2], works[4])] == [0, 1]
+    assert list(queue) == [works[2], works[4]]
+
+
+def test_removing_the_head_moves_everyone_up():
+    queue = WorkQueue()
+    works = [_work(i) for i in range(3)]
+    for w in works:
+        queue.append(w)
+
+    queue.remove(works[0])
+    assert queue.position(works[1]) == 0
+    assert queue.position(works[2]) == 1
+    assert queue.popleft() is works[1]
+
+
+def test_remove_client_only_takes_its_works():
+    queue = WorkQueue()
+    works = [_work(0, "a"), _work(1, "b"), _work(2, "a"), _work(3, "b")]
+    for w in works:
+        queue.append(w)
+
+    assert queue.remove_client("a") == [works[0], works[2]]
+    assert queue.remove_client("a") == []
+    assert list(queue.clients()) == ["b"]
+    assert list(queue.client_works("b")) == [works[1], works[3]]
+    assert works[0] not in queue
+    assert [queue.position(w) for w in (works[1], works[3])] == [0, 1]
+
+
+@pytest.mark.parametrize("name", sorted(scheduling.SCHEDULERS))
+def test_positions_follow_the_dispatch_order(name):
+    queue = scheduling.create_scheduler(name)
+    works = [_work(i, "ab"[i % 2], max_length=10 + 7 * i % 40) for i in range(10)]
+    for w in works:
+        queue.append(w)
+    queue.remove(works[3])
+    queue.remove_client("c")
+    assert works[3] not in queue
+
+    order = list(queue)
+    assert [queue.position(w) for w in order] == list(range(len(order)))
+    popped = [queue.pop() for _ in range(len(queue))]
+    assert popped == order
+    assert works[3] not in popped
+    assert len(queue) == 0 and not list(queue.clients())
+
+
+@pytest.mark.parametrize("name", sorted(scheduling.SCHEDULERS))
+def test_cancelled_works_are_never_dispatched(name):
+    queue = scheduling.create_scheduler(name)
+    works = [_work(i, "ab"[i % 2]) for i in range(6)]
+    for w in works:
+        queue.append(w)
+
+    assert queue.remove_client("a") == works[0::2]
+    assert [queue.pop() for _ in range(len(queue))] == works[1::2]
@@ -1,23 +1,11 @@
-import logging
-import sys
+import hashlib
 
 
-def configure_logger(logger: logging.Logger):
-    formatter = logging.Formatter("%(asctime)s [%(name)s %(levelname)s] %(message)s")
-
-    console_hdl = logging.StreamHandler(sys.stdout)
-    console_hdl.setFormatter(formatter)
-    console_hdl.addFilter(lambda log: log.levelno <= logging.INFO)
-    logger.addHandler(console_hdl)
-
-    console_hdl_err = logging.StreamHandler(sys.stderr)
-    console_hdl_err.setFormatter(formatter)
-    console_hdl_err.setLevel(logging.WARNING)
-    logger.addHandler(console_hdl_err)
-    
-    file_hdl = logging.FileHandler("latest.log")
-    file_hdl.setFormatter(formatter)
-    file_hdl.setLevel(logging.INFO)
-    logger.addHandler(file_hdl)
-
-    logger.setLevel(logging.INFO)
+def image_hash(image) -> str:
+    """
+    Content hash of a decoded PIL image.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{image.mode} {image.size}".encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
@@ -0,0 +1,78 @@
+import bisect
+import collections
+
+
+class WorkQueue:
+    """
+    FIFO queue of works, indexed by client.
+
+    Every work gets an increasing sequence number when queued. Works removed from the middle
+    (e.g. when their client disconnects) are only forgotten and skipped later, their sequence
+    numbers are kept in a sorted list, so a position is a subtraction and a bisect away.
+    """
+
+    def __init__(self):
+        self._queue = collections.deque()
+        self._seqs: dict[int, int] = {}
+        self._removed: list[int] = []
+        self._by_client: dict[object, dict[int, object]] = {}
+        self._next_seq = 0
+
+    def __len__(self):
+        return len(self._seqs)
+
+    def __iter__(self):
+        return (w for w in self._queue if w.uid in self._seqs)
+
+    def __contains__(self, work):
+        return work.uid in self._seqs
+
+    def append(self, work):
+        self._seqs[work.uid] = self._next_seq
+        self._next_seq += 1
+        self._queue.append(work)
+        self._by_client.setdefault(work.client, {})[work.uid] = work
+
+    def _forget(self, work) -> int:
+        seq = self._seqs.pop(work.uid)
+        client_works = self._by_client[work.client]
+        del client_works[work.uid]
+        if not client_works:
+            del self._by_client[work.client]
+        return seq
+
+    def _drop_removed_head(self):
+        while self._queue and self._queue[0].uid not in self._seqs:
+            self._queue.popleft()
+        head_seq = self._seqs[self._queue[0].uid] if self._queue else self._next_seq
+        del self._removed[:bisect.bisect_left(self._removed, head_seq)]
+
+    def popleft(self):
+        work = self._queue.popleft()
+        self._forget(work)
+        self._drop_removed_head()
+        return work
+
+    def remove(self, work) -> bool:
+        if work.uid not in self._seqs:
+            return False
+        bisect.insort(self._removed, self._forget(work))
+        self._drop_removed_head()
+        return True
+
+    def remove_client(self, client) -> list:
+        works = list(self._by_client.get(client, {}).values())
+        for work in works:
+            self.remove(work)
+        return works
+
+    def position(self, work) -> int:
+        seq = self._seqs[work.uid]
+        head_seq = self._seqs[self._queue[0].uid]
+        return seq - head_seq - bisect.bisect_left(self._removed, seq)
+
+    def clients(self):
+        return self._by_client.keys()
+
+    def client_works(self, client):
+        return self._by_client.get(client, {}).values()
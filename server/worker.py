@@ -1,19 +1,38 @@
+import collections
+import concurrent.futures
+import functools
+import itertools
 import logging
 import multiprocessing
 from multiprocessing import Process, Pipe
 import enum
 import asyncio
+import io
+import os
+import time
+import typing
 
 import PIL
 from PIL import Image
 import torch
 
 import config
+import embedding_cache
+import image_slots
+import logs
+import metrics
+import result_cache
+import scheduling
+import session_cache
 import utils
 
 
 ##### DEBUG SECTION START #####
-DEBUGGING = False
+DEBUGGING = os.environ.get("BTLP2_DEBUGGING", "0") == "1"
+# Delay of each DummyModel progress step in seconds, random when unset.
+DUMMY_STEP_DELAY = os.environ.get("BTLP2_DUMMY_STEP_DELAY")
+# Probability of a DummyModel generation killing its worker process, to exercise the restarts.
+DUMMY_CRASH_RATE = float(os.environ.get("BTLP2_DUMMY_CRASH_RATE", "0"))
 if DEBUGGING:
     from time import sleep
     from random import random
@@ -21,6 +40,9 @@ if DEBUGGING:
 if not DEBUGGING:
     import model_api
 
+# Whether workers run their works in batches (see batching.py), otherwise one at a time.
+BATCHING = config.BATCHING and not DEBUGGING
+
 class DummyModel:
     # noinspection PyMissingConstructor
     def __init__(self):
@@ -30,6 +52,7 @@ class DummyModel:
             self,
             prompt: str,
             image: torch.Tensor,
+            image_hash: str = None,
             use_nucleus_sampling=False,
             num_beams=5,
             max_length=30,
@@ -39,202 +62,1419 @@ class DummyModel:
             length_penalty=1.0,
             num_captions=1,
             temperature=1,
+            should_stop=None,
+            speculative=False,
     ):
         for i in range(3):
+            if should_stop is not None and should_stop(i):
+                return ["DUMMY"]
             yield f"progress {i+1}"
-            sleep(random())
+            sleep(random() if DUMMY_STEP_DELAY is None else float(DUMMY_STEP_DELAY))
+            if random() < DUMMY_CRASH_RATE / 3:
+                os._exit(1)
         return ["DUMMY RESULT"]
 
 def _debug_load_model():
     sleep(random() * 3)
     return DummyModel()
+
+class _DebugModels:
+    """
+    Stands in for model_api.ModelRegistry: a DummyModel per variant, loaded on first use and never evicted.
+    """
+    device = None
+    embedding_cache = None
+
+    def __init__(self):
+        self._models = {}
+
+    @property
+    def resident(self) -> list[str]:
+        return list(self._models)
+
+    def peek(self, name: str):
+        return self._models.get(name)
+
+    def get(self, name: str, busy=()):
+        if name not in self._models:
+            self._models[name] = _debug_load_model()
+        return self._models[name]
+
+    def load_draft(self, model):
+        pass
 ##### DEBUG SECTION END #####
 
 class MsgType(enum.Enum):
     PENDING = enum.auto()
     PROGRESS = enum.auto()
     RESULT = enum.auto()
+    CACHE_UPDATE = enum.auto()
+    METRICS = enum.auto()
+    CANCELLED = enum.auto()
+    FAILED = enum.auto()
+
+
+class Cancel(typing.NamedTuple):
+    """
+    Sent to a worker after a work to stop it. The worker answers with MsgType.CANCELLED,
+    unless the work finished already.
+    """
+    uid: int
+
+
+class Partial(typing.NamedTuple):
+    """
+    Progress carrying the text generated so far (one entry per caption) of a streaming work.
+    """
+    texts: list[str]
+
+
+def _run_stages(generator, on_progress):
+    while True:
+        try:
+            on_progress(next(generator))
+        except StopIteration as si:
+            return si.value
+
+
+def _load_image(work, image_reader: image_slots.ImageSlotReader):
+    if work.image_handle is not None and work.image is None:
+        work.image = image_reader.load(work.image_handle)
+
+
+class _Prefetcher:
+    """
+    Loads and preprocesses (Model.preprocess) the works waiting in a worker on a background thread,
+    so this overlaps with the model working on the current ones.
+    Works of variants the worker hasn't loaded yet wait for take().
+    """
+
+    def __init__(self, models, image_reader: image_slots.ImageSlotReader, collector: "_MetricsCollector"):
+        self._models = models
+        self._image_reader = image_reader
+        self._collector = collector
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="Prefetch")
+        self._stream = torch.cuda.Stream(models.device) if models.device.type == "cuda" else None
+        self._futures: dict[int, concurrent.futures.Future] = {}
+
+    def _preprocess(self, work):
+        start = time.perf_counter()
+        _load_image(work, self._image_reader)
+        model = self._models.peek(work.model)
+        preprocessed = model.preprocess(work.full_prompt, work.image, work.image_hash, self._stream)
+        self._collector.preprocessed(time.perf_counter() - start)
+        return preprocessed
+
+    def prefetch(self, works):
+        for work in works:
+            if work.uid not in self._futures and self._models.peek(work.model) is not None:
+                self._futures[work.uid] = self._executor.submit(self._preprocess, work)
+
+    def take(self, work):
+        """
+        Returns the preprocessed tensors of a work, waits for them if they aren't ready yet.
+        """
+        future = self._futures.pop(work.uid, None)
+        if future is None:
+            future = self._executor.submit(self._preprocess, work)
+        return future.result()
+
+    def discard(self, work):
+        future = self._futures.pop(work.uid, None)
+        if future is not None:
+            future.cancel()
+
+
+# Generation stages timed between two progress markers of Model.prepare() and Model.generate().
+# The preprocess stage is timed by _Prefetcher, which runs it before them.
+STAGES = {
+    "vision_encoder": ("1", "2"),
+    "qformer": ("2", "5"),
+    "tokenize": ("6", "7"),
+    "decode": ("9", "10"),
+    "detokenize": ("10", "11"),
+}
+_STAGE_STARTS = {start for start, _ in STAGES.values()}
+_STAGE_ENDS = {end: (stage, start) for stage, (start, end) in STAGES.items()}
+
 
+class _MetricsCollector:
+    """
+    Collects the timings of a worker and sends them to the main process every METRICS_INTERVAL seconds,
+    see metrics.record_worker_report().
 
-def _worker_func(pipe, name: str, device_name: str):
-    logger: logging.Logger = multiprocessing.get_logger()
-    logger.name = name
-    utils.configure_logger(logger)
+    On CUDA the stage markers are events recorded on the model's stream, so timing them doesn't synchronize.
+    They're only read when reporting, by which time they have almost always completed.
+    """
+
+    def __init__(self, pipe, device=None):
+        self._pipe = pipe
+        self._cuda = device is not None and device.type == "cuda"
+        self._marks: dict[int, dict[str, object]] = {}
+        # Seconds of the preprocess stage, appended by the prefetch thread.
+        self._preprocess = collections.deque()
+        self._reset(time.monotonic())
+
+    def _reset(self, now: float):
+        self._reported_at = now
+        self._stages = []
+        self._pipe_transfer = []
+        self._idle_gaps = []
+        self._busy = 0.0
+        self._tokens = 0
+        self._draft = [0, 0]
+
+    def _clock(self):
+        if self._cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def received(self, work):
+        if work.dispatched_at is not None:
+            self._pipe_transfer.append(max(0.0, time.time() - work.dispatched_at))
+
+    def progress(self, uid: int, progress):
+        if progress not in _STAGE_STARTS and progress not in _STAGE_ENDS:
+            return
+        marks = self._marks.setdefault(uid, {})
+        mark = marks[progress] = self._clock()
+        if progress in _STAGE_ENDS:
+            stage, start = _STAGE_ENDS[progress]
+            if start in marks:
+                self._stages.append((stage, marks[start], mark))
+
+    def idle_gap(self, seconds: float):
+        self._idle_gaps.append(seconds)
+
+    def forget(self, uid: int):
+        self._marks.pop(uid, None)
+
+    def busy(self, seconds: float):
+        self._busy += seconds
+
+    def preprocessed(self, seconds: float):
+        self._preprocess.append(seconds)
+
+    def decoded(self, tokens: int):
+        self._tokens += tokens
+
+    def drafted(self, proposed: int, accepted: int):
+        self._draft[0] += proposed
+        self._draft[1] += accepted
+
+    def report(self):
+        now = time.monotonic()
+        if now - self._reported_at < config.METRICS_INTERVAL:
+            return
+
+        stages = []
+        for stage, start, end in self._stages:
+            if self._cuda:
+                end.synchronize()
+                stages.append((stage, start.elapsed_time(end) / 1000))
+            else:
+                stages.append((stage, end - start))
+        while self._preprocess:
+            stages.append(("preprocess", self._preprocess.popleft()))
+
+        self._pipe.send((MsgType.METRICS, None, {
+            "stages": stages,
+            "pipe_transfer": self._pipe_transfer,
+            "idle_gaps": self._idle_gaps,
+            "tokens": self._tokens,
+            "draft": self._draft,
+            "busy": self._busy,
+            "interval": now - self._reported_at,
+        }))
+        self._reset(now)
+
+
+def _worker_func(pipe, name: str, device_name: str, shared_weights=None, spawned_at: float = None,
+                 device_workers: int = 1, log_conn=None):
+    started_at = time.time()
+    if log_conn is not None:
+        logs.configure_process(log_conn)
+    logger = logging.getLogger(name)
 
     logger.info(f"Loading with device: {device_name}")
 
+    # Batch engine of every loaded variant, None for the ones that can't batch.
+    engines = {}
     if not DEBUGGING:
-        device = torch.device(device_name)
-        model = model_api.load_model(device)
+        # Dropped variants are loaded again from scratch, engine included.
+        models = model_api.ModelRegistry(
+            torch.device(device_name), shared_weights, lambda variant: engines.pop(variant, None), logger,
+            device_workers
+        )
     else:
-        model = _debug_load_model()
+        models = _DebugModels()
+    models.get(config.DEFAULT_MODEL)
+    loaded_at = time.time()
 
-    logger.info("Loading completed, waiting for tasks...")
+    def busy_models() -> set[str]:
+        return {variant for variant, engine in engines.items() if engine is not None and not engine.idle}
 
-    gen_cnt = 0
-    while True:
-        pipe.send((MsgType.PENDING, None))
+    def load(variant: str):
+        """
+        Returns the model and batch engine of a variant with its weights on the device, loading it if needed.
+        None while that needs evicting variants that are still decoding.
+        """
+        resident = models.resident
+        model = models.get(variant, busy_models())
+        if model is None:
+            return None
+        if variant not in engines:
+            engines[variant] = model.create_batch_engine(config.MAX_BATCH_SIZE) if BATCHING else None
+        if models.resident != resident:
+            send_cache_update()
+        return model, engines[variant]
+
+    # With shared weights, unpickling them (attaching) happens before this function starts.
+    logger.info(
+        "Loading completed, waiting for tasks. "
+        + (f"Spawn and attach: {started_at - spawned_at:.2f}s, " if spawned_at is not None else "")
+        + f"{'device transfer' if shared_weights is not None else 'model loading'}: {loaded_at - started_at:.2f}s"
+    )
+
+    collector = _MetricsCollector(pipe, models.device)
+
+    def send_progress(work, progress):
+        logger.info(f"Generation {work.uid} progress: {progress}", extra={"stage": "progress", "uid": work.uid})
+        collector.progress(work.uid, progress)
+        pipe.send((MsgType.PROGRESS, work.uid, progress))
+
+    def send_result(work, result):
+        logger.info(f"Generation {work.uid} completed: {result}", extra={"stage": "result", "uid": work.uid})
+        collector.forget(work.uid)
+        pipe.send((MsgType.RESULT, work.uid, result))
+        pipe.send((MsgType.PENDING, None, None))
+
+    def send_cancelled(work, started: bool, reclaimed: float = 0.0):
+        logger.info(f"Generation {work.uid} cancelled", extra={"stage": "result", "uid": work.uid})
+        collector.forget(work.uid)
+        pipe.send((MsgType.CANCELLED, work.uid, {"started": started, "reclaimed": reclaimed}))
+        pipe.send((MsgType.PENDING, None, None))
+
+    def send_failed(work, error: Exception):
+        # Only this work fails, the worker and the other works of its batch go on.
+        logger.error(f"Generation {work.uid} failed: {error!r}", exc_info=error,
+                         extra={"stage": "result", "uid": work.uid})
+        collector.forget(work.uid)
+        works.pop(work.uid, None)
+        stream_sent.pop(work.uid, None)
+        session_prefixes.pop(work.uid, None)
+        stopped_at.pop(work.uid, None)
+        pipe.send((MsgType.FAILED, work.uid, f"The generation failed: {error}"))
+        pipe.send((MsgType.PENDING, None, None))
+
+    def receive():
         work = pipe.recv()
+        if isinstance(work, Cancel):
+            cancelled.add(work.uid)
+            return
+        received[work.uid] = time.monotonic()
+        collector.received(work)
+        backlog.append(work)
 
-        logger.info(f"Starting generation {gen_cnt}...\nPrompt: {work.prompt}\nImage(size): {work.image.size}\nArgs: {work.args}")
+    def cancel_works():
+        for uid in cancelled:
+            work = next((w for w in backlog if w.uid == uid), None)
+            if work is not None:
+                backlog.remove(work)
+                received.pop(uid)
+                if prefetcher is not None:
+                    prefetcher.discard(work)
+                send_cancelled(work, False)
+            elif uid in works:
+                # Its rows leave the batch before the next step.
+                work = works.pop(uid)
+                stream_sent.pop(uid, None)
+                session_prefixes.pop(uid, None)
+                send_cancelled(work, True, engines[work.model].cancel(uid) * seconds_per_token)
+            # Otherwise it finished already.
+        cancelled.clear()
 
-        generator = model.generate(work.prompt, work.image, **work.args)
-        while True:
+    def should_stop(work, started_at: float, max_length: int, tokens: int) -> bool:
+        """
+        Polled while a work generates outside the batch engine (speculative works, variants that can't batch),
+        picks up what arrived meanwhile and runs a step of the batches, which would stall until it's done otherwise.
+        """
+        while pipe.poll():
+            receive()
+        if work.uid not in cancelled:
+            if cancelled:
+                cancel_works()
+            step_engines()
+            return False
+        cancelled.discard(work.uid)
+        elapsed = time.monotonic() - started_at
+        # What generating the remaining tokens would have taken, at the pace so far.
+        stopped_at[work.uid] = elapsed / tokens * max(max_length - tokens, 0) if tokens > 0 else elapsed
+        return True
+
+    def send_cache_update():
+        cache = models.embedding_cache
+        added, evicted = cache.drain_changes() if cache is not None else ([], [])
+        sessions_added, sessions_evicted = sessions.drain_changes() if sessions is not None else ([], [])
+        pipe.send((MsgType.CACHE_UPDATE, None, {
+            "added": added,
+            "evicted": evicted,
+            "hits": cache.hits if cache is not None else 0,
+            "misses": cache.misses if cache is not None else 0,
+            "sessions_added": sessions_added,
+            "sessions_evicted": sessions_evicted,
+            "models": models.resident,
+        }))
+
+    def continue_session(work, engine, session: session_cache.Session, progress):
+        """
+        Prefills a follow-up on top of its session's cached state, returns the past of the new prefix.
+        """
+        progress("6")
+        input_ids = engine.tokenizer(" " + work.prompt, add_special_tokens=False, return_tensors="pt").input_ids
+        input_ids = torch.cat([torch.tensor([session.pending]), input_ids], dim=1)
+        progress("7")
+        return engine.add(work.uid, None, input_ids, work.args, past=session.past), input_ids[0, -1].item()
+
+    def cache_session(work, engine, sequences: list[list[int]]):
+        # The next turn prefills the last prompt token and the best answer, on top of the prefix.
+        prefix, last_token = session_prefixes.pop(work.uid)
+        tokens = sequences[0] if sequences else []
+        if tokens and tokens[-1] == engine.eos_token_id:
+            tokens = tokens[:-1]
+        sessions.put(work.session_id, session_cache.Session(work.turn + 1, prefix, [last_token] + tokens))
+
+    def step_engines():
+        """
+        Runs a decode step of every batch engine with requests, and sends what it produced.
+        """
+        nonlocal seconds_per_token, engines_busy
+        for variant in busy_models():
+            engine = engines[variant]
+            step_start = time.monotonic()
+            decoded_tokens = engine.decoded_tokens
             try:
-                progress = next(generator)
-                logger.info(f"Generation {gen_cnt} progress: {progress}")
-                pipe.send((MsgType.PROGRESS, progress))
-            except StopIteration as si:
-                logger.info(f"Generation {gen_cnt} completed:\n" + "\n".join(si.value))
-                gen_cnt += 1
-                pipe.send((MsgType.RESULT, si.value))
+                finished = engine.step()
+            except Exception as e:
+                # Not down to one request (the forward pass of the batch raised), all its works fail.
+                finished = []
+                for work in [w for w in works.values() if w.model == variant]:
+                    engine.cancel(work.uid)
+                    send_failed(work, e)
+            else:
+                for uid, e in engine.failed:
+                    send_failed(works[uid], e)
+            step_end = time.monotonic()
+            collector.busy(step_end - step_start)
+            engines_busy += step_end - step_start
+            collector.decoded(engine.decoded_tokens - decoded_tokens)
+            step_cost = (step_end - step_start) / max(engine.decoded_tokens - decoded_tokens, 1)
+            seconds_per_token = step_cost if seconds_per_token == 0.0 else 0.9 * seconds_per_token + 0.1 * step_cost
+
+            now = time.monotonic()
+            finished_uids = {uid for uid, _ in finished}
+            for uid, work in works.items():
+                if work.stream and work.model == variant and uid not in finished_uids \
+                        and now - stream_sent.get(uid, 0) >= config.STREAM_INTERVAL:
+                    pipe.send((MsgType.PROGRESS, uid, Partial(engine.partial(uid))))
+                    stream_sent[uid] = now
+
+            for uid, sequences in finished:
+                stream_sent.pop(uid, None)
+                work = works.pop(uid)
+                try:
+                    send_progress(work, "10")
+                    result = engine.decode(sequences)
+                    send_progress(work, "11")
+                    if uid in session_prefixes:
+                        # Before the result, which lets the client send the next turn.
+                        cache_session(work, engine, sequences)
+                        send_cache_update()
+                except Exception as e:
+                    send_failed(work, e)
+                    continue
+                send_result(work, result)
+
+    capacity = (config.MAX_CONCURRENT_WORKS if BATCHING else 1) + config.WORKER_QUEUE_DEPTH
+    for _ in range(capacity):
+        pipe.send((MsgType.PENDING, None, None))
+
+    sessions = None
+    if BATCHING:
+        # Session ids are unique across variants, the server starts a session over when its variant changes.
+        sessions = session_cache.SessionCache(config.SESSION_CACHE_BYTES, config.SESSION_IDLE_TIMEOUT)
+    # Prefix past and last prompt token of the running session works, cached with their answer when they finish.
+    session_prefixes = {}
+    send_cache_update()
+
+    image_reader = image_slots.ImageSlotReader()
+    prefetcher = None
+    if not DEBUGGING:
+        prefetcher = _Prefetcher(models, image_reader, collector)
+
+    works = {}
+    # Uids of the works to cancel, received since the last cancel_works().
+    cancelled = set()
+    # Estimated seconds reclaimed by the works stopped by should_stop().
+    stopped_at = {}
+    # Average compute time of one decoded token (a row and a step) of the batch engines.
+    seconds_per_token = 0.0
+    # Compute time of all the batch engine steps so far.
+    engines_busy = 0.0
+    # Time of the last partial sent for each streaming work, partials are coalesced to one per STREAM_INTERVAL.
+    stream_sent = {}
+    backlog = collections.deque()
+    received = {}
+    # The model is idle between the end of its last computation and the start of the next one.
+    # Time spent there while a work was waiting is logged as that work's idle gap.
+    compute_end = time.monotonic()
+    while True:
+        if not backlog and not busy_models():
+            # Idle workers keep reporting, so their busy ratio drops.
+            while not pipe.poll(config.METRICS_INTERVAL):
+                collector.report()
+            receive()
+        while pipe.poll():
+            receive()
+        if cancelled:
+            cancel_works()
+        if sessions is not None:
+            sessions.expire()
+        if prefetcher is not None:
+            # Follow-ups of the sessions cached here need neither the image nor the whole prompt.
+            prefetcher.prefetch(w for w in backlog if sessions is None or w.session_id not in sessions)
+
+        while backlog:
+            if cancelled:
+                # Received while generating the previous work.
+                cancel_works()
+                continue
+            work = backlog[0]
+            loaded = load(work.model)
+            if loaded is None:
+                # Its variant waits for room on the device, until the batches of the others are done.
                 break
+            model, engine = loaded
+            batched = engine is not None and engine.supports(work.args)
+            if batched and not engine.can_admit(work.args):
+                # Joins the batch once enough rows retired.
+                break
+            backlog.popleft()
+
+            session = None
+            if batched and work.session_id is not None:
+                session = sessions.get(work.session_id, work.turn)
+            preprocessed = None
+            if prefetcher is not None and session is None:
+                preprocessed = prefetcher.take(work)
+            else:
+                if prefetcher is not None:
+                    prefetcher.discard(work)
+                _load_image(work, image_reader)
+            idle_gap = max(0.0, time.monotonic() - max(received.pop(work.uid), compute_end))
+            collector.idle_gap(idle_gap)
+
+            logger.info(
+                f"Starting generation {work.uid}: model {work.model}, prompt {work.full_prompt!r}, "
+                f"image size {work.image.size}, args {work.args}, idle gap {idle_gap * 1000:.1f} ms",
+                extra={"stage": "start", "uid": work.uid}
+            )
+            compute_start = time.monotonic()
+            # The batch steps it runs meanwhile (see should_stop()) count themselves.
+            engines_busy_before = engines_busy
+            progress = functools.partial(send_progress, work)
+            try:
+                if batched:
+                    if session is not None:
+                        prefix = continue_session(work, engine, session, progress)
+                    else:
+                        query_embeds, input_ids = _run_stages(
+                            model.prepare(work.full_prompt, work.image, work.image_hash, preprocessed),
+                            progress
+                        )
+                        send_cache_update()
+                        prefix = engine.add(work.uid, query_embeds, input_ids, work.args), input_ids[0, -1].item()
+                    if work.session_id is not None:
+                        session_prefixes[work.uid] = prefix
+                    works[work.uid] = work
+                    progress("9")
+                else:
+                    kwargs = {} if preprocessed is None else {"preprocessed": preprocessed}
+                    if work.args.get("speculative"):
+                        models.load_draft(model)
+                    stop = functools.partial(should_stop, work, compute_start, int(work.args.get("max_length", 30)))
+                    generator = model.generate(work.full_prompt, work.image, image_hash=work.image_hash,
+                                               should_stop=stop, **kwargs, **work.args)
+                    result = _run_stages(generator, progress)
+                    if getattr(model, "draft", None) is not None:
+                        collector.drafted(*model.draft.drain_counts())
+                    if work.uid in stopped_at:
+                        send_cancelled(work, True, stopped_at.pop(work.uid))
+                    else:
+                        send_result(work, result)
+                    send_cache_update()
+            except Exception as e:
+                if engine is not None:
+                    # In case it joined the batch before failing.
+                    engine.cancel(work.uid)
+                send_failed(work, e)
+            compute_end = time.monotonic()
+            collector.busy(compute_end - compute_start - (engines_busy - engines_busy_before))
+
+        if busy_models():
+            step_engines()
+            compute_end = time.monotonic()
 
+        collector.report()
 
-class Worker:
-    def __init__(self, pool: "WorkerPool", name: str, device: str, progress_callback, result_callback):
+
+# Weight of the latest work in the averages of BaseWorker.seconds_per_cost and BaseWorker.concurrency.
+SERVICE_TIME_SMOOTHING = 0.1
+
+
+class BaseWorker:
+    """
+    Dispatcher side of a worker, whatever the transport: tracks its free slots and works,
+    and handles its messages (MsgType, uid, data).
+    """
+    # Whether images can be handed over through the pool's shared memory slots.
+    uses_image_slots = False
+
+    def __init__(self, pool: "WorkerPool", name: str, progress_callback, result_callback):
         self.pool = pool
+        self.name = name
         self._progress_callback = progress_callback
         self._result_callback = result_callback
 
-        multiprocessing.set_start_method("spawn", True)
-        self._pipe, _proc_pipe = Pipe()
-        _proc = Process(target=_worker_func, args=(_proc_pipe, name, device), name=name)
-        _proc.start()
-        logging.info(f"Worker process starting: {name}")
+        self._free_slots = 0
+        self._works = {}
+
+        # Mirror of the keys in the worker's embedding cache (see embedding_cache.cache_key()),
+        # and of the sessions in its session cache.
+        self.cached_images = set()
+        self.cached_sessions = set()
+        # Model variants with their weights on the worker's device, every worker starts with the default one.
+        self.resident_models = {config.DEFAULT_MODEL}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Whether the worker finished loading (it sent its first free slots), and since when it has no works
+        # (time.monotonic()), None while it has some.
+        self.ready = False
+        self.idle_since: float | None = None
 
-        self._initializing = True
-        self._busy = True
-        self._work = None
+        # Recent averages of the seconds per unit of estimated cost (see scheduling.estimate_cost()) a work takes
+        # from dispatch to result, and of the works running alongside, see WorkerPool.estimated_wait().
+        self.seconds_per_cost: float | None = None
+        self.concurrency: float | None = None
 
     @property
     def busy(self):
-        return self._busy
+        return self._free_slots == 0
+
+    @property
+    def rows(self) -> int:
+        """
+        Rows of the works handed to this worker (see scheduling.estimate_rows()), running or waiting there.
+        """
+        return sum(scheduling.estimate_rows(w.args) for w in self._works.values())
+
+    def has_room(self, work) -> bool:
+        """
+        Whether the worker would start the work right away, with room for it in its batch, rather than only
+        prefetch it behind its others (see config.WORKER_QUEUE_DEPTH).
+        """
+        if not self._works:
+            return True
+        return BATCHING and len(self._works) < config.MAX_CONCURRENT_WORKS \
+            and self.rows + scheduling.estimate_rows(work.args) <= config.MAX_BATCH_SIZE
+
+    @property
+    def alive(self):
+        return True
+
+    def close(self):
+        raise NotImplementedError
+
+    def _send(self, work):
+        raise NotImplementedError
+
+    def _send_cancel(self, uid: int):
+        raise NotImplementedError
+
+    @property
+    def works(self):
+        return self._works.values()
+
+    @property
+    def throughput(self) -> float | None:
+        """
+        Estimated cost units this worker gets through per second, None until a work completed.
+        """
+        if self.seconds_per_cost is None:
+            return None
+        return self.concurrency / self.seconds_per_cost
+
+    def _record_service(self, work):
+        seconds_per_cost = max(time.time() - work.dispatched_at, 1e-3) / scheduling.estimate_cost(work.args)
+        # Itself included.
+        concurrency = len(self._works) + 1
+        if self.seconds_per_cost is None:
+            self.seconds_per_cost, self.concurrency = seconds_per_cost, concurrency
+        else:
+            self.seconds_per_cost += SERVICE_TIME_SMOOTHING * (seconds_per_cost - self.seconds_per_cost)
+            self.concurrency += SERVICE_TIME_SMOOTHING * (concurrency - self.concurrency)
+
+    def cancel(self, work) -> bool:
+        """
+        Asks the worker to stop a work handed to it, returns False if it doesn't have it (anymore).
+        """
+        if work.uid not in self._works:
+            return False
+        self._send_cancel(work.uid)
+        return True
+
+    def take_works(self) -> list:
+        """
+        Forgets the works handed to this worker and returns them in that order, to requeue them when it's gone.
+        """
+        works = list(self._works.values())
+        self._works.clear()
+        self._free_slots = 0
+        return works
 
     async def submit(self, work):
         await self.update()
         assert not self.busy, "This worker is still busy."
 
-        self._pipe.send(work)
-        self._busy = True
-        self._work = work
+        work.dispatched_at = time.time()
+        self._free_slots -= 1
+        self._works[work.uid] = work
+        self.idle_since = None
+        await self._send(work)
 
     async def update(self):
         """
         Call this method regularly!
         """
-        while self._pipe.poll():
-            msg, data = self._pipe.recv()
-            if msg == MsgType.PENDING:
-                self._busy = False
+        raise NotImplementedError
+
+    def _pop_work(self, uid: int):
+        work = self._works.pop(uid)
+        if not self._works:
+            self.idle_since = time.monotonic()
+        return work
+
+    async def _handle_message(self, msg: MsgType, uid: int | None, data):
+        if msg == MsgType.PENDING:
+            self._free_slots += 1
+            if not self.ready:
+                self.ready = True
+                self.idle_since = time.monotonic()
+        elif msg in (MsgType.PROGRESS, MsgType.RESULT, MsgType.CANCELLED, MsgType.FAILED):
+            work = self._works.get(uid)
+            if work is None:
+                # A late message of a work taken back from it (see take_works()), or a misbehaving remote agent.
+                logging.warning(f"{self.name} sent {msg.name} for unknown work {uid}, dropping it.")
             elif msg == MsgType.PROGRESS:
-                await self._progress_callback(self, self._work, data)
+                work.started = True
+                await self._progress_callback(self, work, data)
             elif msg == MsgType.RESULT:
-                await self._result_callback(self, self._work, data)
+                self._pop_work(uid)
+                self._record_service(work)
+                self.pool.release_image(work)
+                await self._result_callback(self, work, data)
+            elif msg == MsgType.FAILED:
+                self._pop_work(uid)
+                self.pool.release_image(work)
+                metrics.WORK_FAILURES.inc(worker=self.name)
+                await self.pool.fail(work, data)
             else:
-                assert False
+                self._pop_work(uid)
+                self.pool.release_image(work)
+                metrics.CANCELLED.inc(where="running" if data["started"] else "worker")
+                metrics.RECLAIMED_SECONDS.inc(data["reclaimed"], worker=self.name)
+        elif msg == MsgType.CACHE_UPDATE:
+            self.cached_images.update(data["added"])
+            self.cached_images.difference_update(data["evicted"])
+            self.cache_hits = data["hits"]
+            self.cache_misses = data["misses"]
+            self.cached_sessions.update(data["sessions_added"])
+            self.cached_sessions.difference_update(data["sessions_evicted"])
+            self.resident_models = set(data["models"])
+        elif msg == MsgType.METRICS:
+            metrics.record_worker_report(self.name, data)
+        else:
+            assert False
+
+
+class Worker(BaseWorker):
+    """
+    A worker process on this machine, talking through a pipe.
+    """
+    uses_image_slots = True
+
+    def __init__(self, pool: "WorkerPool", name: str, device: str, progress_callback, result_callback,
+                 shared_weights=None, device_workers: int = 1):
+        super().__init__(pool, name, progress_callback, result_callback)
+        self.device = device
+        # The process is gone: the pipe reached its end or broke.
+        self._exited = False
+
+        multiprocessing.set_start_method("spawn", True)
+        self._pipe, _proc_pipe = Pipe()
+        log_conn = logs.connect()
+        self._proc = Process(
+            target=_worker_func,
+            args=(_proc_pipe, name, device, shared_weights, time.time(), device_workers, log_conn),
+            name=name
+        )
+        self._proc.start()
+        # Only the process holds their ends now, the pipes reach their end when it exits.
+        _proc_pipe.close()
+        log_conn.close()
+        logging.info(f"Worker process starting: {name} ({device})")
+
+    @property
+    def alive(self):
+        return not self._exited and self._proc.exitcode is None
+
+    @property
+    def exitcode(self) -> int | None:
+        return self._proc.exitcode
+
+    def fileno(self):
+        return self._pipe.fileno()
+
+    def close(self):
+        self._proc.terminate()
+        self._proc.join()
+        self._pipe.close()
+
+    async def _send(self, work):
+        try:
+            self._pipe.send(work)
+        except OSError:
+            # The pool requeues the work with the others when it notices.
+            self._exited = True
+
+    def _send_cancel(self, uid: int):
+        try:
+            self._pipe.send(Cancel(uid))
+        except OSError:
+            self._exited = True
+
+    async def update(self):
+        """
+        Call this method regularly!
+        """
+        try:
+            while not self._exited and self._pipe.poll():
+                await self._handle_message(*self._pipe.recv())
+        except (EOFError, OSError):
+            self._exited = True
 
 
 class Work:
-    def __init__(self, client, request_id: int, prompt: str, image: PIL.Image, args: dict):
+    _uids = itertools.count()
+
+    def __init__(self, client, request_id: int, prompt: str, image: PIL.Image, args: dict, image_hash: str = None,
+                 stream: bool = False, session_id: str = None, turn: int = 0, history: str = None,
+                 model: str = config.DEFAULT_MODEL):
+        self.uid = next(self._uids)
         self.client = client
         self.request_id = request_id
 
         self.prompt = prompt
         self.image = image
         self.args = args
-    
+        self.image_hash = image_hash
+
+        self.stream = stream
+        if (stream or args.get("speculative")) and not args.get("use_nucleus_sampling", False):
+            # Beams can't be streamed (admission.check_stream() rejects them) nor drafted, both decode greedily
+            # unless sampling.
+            self.args = {**args, "num_beams": 1}
+        # Set while the pixels are in a shared memory slot, the image itself isn't pickled then.
+        self.image_handle: image_slots.ImageHandle | None = None
+
+        # Multi-turn sessions: a follow-up is the turn-th one of its session, history is the text of
+        # the earlier turns (prompts and answers). Workers that cached the session only prefill the prompt.
+        self.session_id = session_id
+        self.turn = turn
+        self.history = history
+        # The variant in config.MODELS generating it.
+        self.model = model
+
+        # Set by the pool, see result_cache.result_key().
+        self.result_key: str | None = None
+        self.submitted_at: float | None = None
+        # Wall clock time, it's compared with the worker's clock.
+        self.dispatched_at: float | None = None
+        # Set by WorkerPool.cancel(), the work's events aren't delivered anymore.
+        self.cancelled = False
+        # Whether its worker reported progress on it, and the workers that crashed while running it
+        # (see config.MAX_WORK_CRASHES).
+        self.started = False
+        self.crashes = 0
+        # PNG of the image while it's compressed (see compress_image()), image is None then.
+        self.compressed_image: bytes | None = None
+
     def __getstate__(self):
         return {
+            "uid": self.uid,
             "request_id": self.request_id,
             "prompt": self.prompt,
-            "image": self.image,
-            "args": self.args
+            "image": self.image if self.image_handle is None else None,
+            "image_handle": self.image_handle,
+            "args": self.args,
+            "image_hash": self.image_hash,
+            "stream": self.stream,
+            "dispatched_at": self.dispatched_at,
+            "session_id": self.session_id,
+            "turn": self.turn,
+            "history": self.history,
+            "model": self.model,
         }
 
+    @property
+    def image_bytes(self) -> int:
+        """
+        Memory taken by the decoded image, 0 while it's compressed.
+        """
+        if self.image is None:
+            return 0
+        return self.image.width * self.image.height * len(self.image.getbands())
+
+    def compress_image(self):
+        buffer = io.BytesIO()
+        # Lossless and fast rather than small.
+        self.image.save(buffer, format="PNG", compress_level=1)
+        self.compressed_image = buffer.getvalue()
+        self.image = None
+
+    def decompress_image(self):
+        if self.compressed_image is not None:
+            self.image = Image.open(io.BytesIO(self.compressed_image), formats=("PNG",)).convert("RGB")
+            self.compressed_image = None
+
+    @property
+    def full_prompt(self) -> str:
+        """
+        The prompt including the earlier turns of the session, what the model sees.
+        """
+        if self.history is None:
+            return self.prompt
+        return f"{self.history} {self.prompt}"
+
+
+def device_capacity(device_name: str, max_workers: int = config.MAX_WORKERS_PER_DEVICE) -> int:
+    """
+    Workers a device runs at most: max_workers, fewer if the memory budget of a CUDA device doesn't fit them.
+    """
+    device = torch.device(device_name)
+    if device.type != "cuda" or DEBUGGING:
+        return max_workers
+    budget = torch.cuda.get_device_properties(device).total_memory * config.DEVICE_MEMORY_BUDGET
+    return max(1, min(max_workers, int(budget // config.WORKER_DEVICE_MEMORY)))
+
+
+# Seconds between two checks of the restarts due and of the scaling, see WorkerPool._maintain().
+MAINTENANCE_INTERVAL = 1.0
+
 
 class WorkerPool:
-    def __init__(self, queue_update_callback, progress_callback, result_callback):
-        self._workers = []
+    """
+    Dispatches the queued works to the workers: local worker processes on the devices, between min_workers_per_device
+    and their capacity (see device_capacity()) scaled by the queue (see _scale()) and restarted when they crash,
+    and the workers of remote agents (see add_workers()).
+    failure_callback(work, cause) is called for the works that can't be completed.
+    """
 
-        for i, device_name in enumerate(config.WORKERS):
-            self._workers.append(Worker(
-                self,
-                f"Worker {i}",
-                device_name,
-                progress_callback,
-                result_callback
-            ))
+    def __init__(self, queue_update_callback, progress_callback, result_callback, devices=config.WORKERS,
+                 scheduler: str = config.SCHEDULER, failure_callback=None,
+                 min_workers_per_device: int = config.MIN_WORKERS_PER_DEVICE,
+                 max_workers_per_device: int = config.MAX_WORKERS_PER_DEVICE):
+        self._workers = []
 
-        self._work_queue = []
+        # The default variant, loaded once here and shared by the workers, fp32 for CPU workers.
+        # Kept alive for as long as the workers use it, restarted ones included.
+        self._shared_weights = {}
+        if config.SHARED_WEIGHTS and not DEBUGGING:
+            for float32 in {torch.device(d).type == "cpu" for d in devices}:
+                started_at = time.time()
+                self._shared_weights[float32] = model_api.load_shared_weights(float32)
+                logging.info(f"Loaded shared {'fp32 ' if float32 else ''}weights in {time.time() - started_at:.2f}s")
 
         self._queue_update_callback = queue_update_callback
+        self._progress_callback = progress_callback
+        self._result_callback = result_callback
+        self._failure_callback = failure_callback
+        self._wakeup = asyncio.Event()
+        # Set by run() while it watches the pipes of the local workers, and their file descriptors.
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._watched: dict[Worker, int] = {}
+
+        # Local workers by device index in devices.
+        self._devices = tuple(devices)
+        self._capacity = [device_capacity(d, max_workers_per_device) for d in self._devices]
+        self._min_workers = min_workers_per_device
+        self._device_workers: list[list[Worker]] = [[] for _ in self._devices]
+        self._worker_ids = itertools.count()
+        # Crashed workers to start again: (time.monotonic() when due, device index).
+        self._restarts: list[tuple[float, int]] = []
+        self._restart_delays = [config.WORKER_RESTART_DELAY] * len(self._devices)
+        self._maintained_at = time.monotonic()
+        self._scaled_at = time.monotonic()
+        for i, capacity in enumerate(self._capacity):
+            for _ in range(min(self._min_workers, capacity)):
+                self._start_worker(i)
+
+        self._work_queue = scheduling.create_scheduler(scheduler)
+
+        self._image_slots = None
+        if config.SHARED_MEMORY_IMAGES:
+            self._image_slots = image_slots.ImageSlotPool(
+                sum(self._capacity) * (config.MAX_CONCURRENT_WORKS + config.WORKER_QUEUE_DEPTH)
+            )
+
+        self._result_cache = result_cache.ResultCache(config.RESULT_CACHE_SIZE, config.RESULT_CACHE_TTL)
+        # Identical deterministic works that are queued or running, by result key: the one actually queued
+        # (or running) and all the works receiving its events, itself included while its client is connected.
+        self._coalesced: dict[str, tuple[Work, list[Work]]] = {}
+
+    @property
+    def workers(self):
+        return tuple(self._workers)
 
     @property
     def queue(self):
-        return tuple(self._work_queue)
+        return self._work_queue
+
+    @property
+    def worker_callbacks(self) -> tuple:
+        """
+        The progress and result callbacks to give to workers created outside the pool (see add_workers()).
+        """
+        return self._on_progress, self._on_result
+
+    @property
+    def embedding_cache_stats(self) -> dict:
+        hits = sum(w.cache_hits for w in self._workers)
+        misses = sum(w.cache_misses for w in self._workers)
+        return {
+            "hits": hits,
+            "misses": misses,
+            "workers": [{"hits": w.cache_hits, "misses": w.cache_misses} for w in self._workers],
+        }
 
     async def submit(self, work: Work):
+        work.submitted_at = time.monotonic()
+        work.result_key = result_cache.result_key(work)
+        if work.result_key is not None:
+            result = self._result_cache.get(work.result_key)
+            if result is not None:
+                metrics.RESULT_CACHE_HITS.inc()
+                await self._result_callback(None, work, result)
+                return
+            shared = self._coalesced.get(work.result_key)
+            if shared is not None:
+                shared[1].append(work)
+                metrics.COALESCED.inc()
+                return
+            self._coalesced[work.result_key] = (work, [work])
+
+        if work.image is not None and \
+                sum(w.image_bytes for w in self._queued_works()) + work.image_bytes > config.QUEUED_IMAGES_MEMORY:
+            work.compress_image()
+            metrics.COMPRESSED_IMAGES.inc()
         self._work_queue.append(work)
+        metrics.set_queue_depth(len(self._work_queue))
+        self._wakeup.set()
         await self._queue_update_callback(self.queue)
 
+    def _queued_works(self):
+        # Unordered, cheaper than iterating the queue in scheduling order.
+        return (w for client in self._work_queue.clients() for w in self._work_queue.client_works(client))
+
+    def estimated_wait(self) -> float | None:
+        """
+        Estimated seconds a work submitted now would wait in the queue: the estimated cost of the queued works
+        over the recent throughput of the workers. None until a worker completed a work.
+        """
+        throughputs = [t for t in (w.throughput for w in self._workers) if t is not None]
+        if not throughputs:
+            return None
+        wait = sum(scheduling.estimate_cost(w.args) for w in self._queued_works()) / sum(throughputs)
+        metrics.ESTIMATED_WAIT.set(wait)
+        return wait
+
+    def cancel(self, work: Work) -> bool:
+        """
+        Cancels a work, whether it's queued or handed to a worker already (which then stops it).
+        Identical works it shares its events with (see submit()) go on, one of them takes over if needed.
+        Returns False if it was cancelled or done already.
+        """
+        if work.cancelled:
+            return False
+        work.cancelled = True
+
+        shared = self._coalesced.get(work.result_key) if work.result_key is not None else None
+        if shared is not None and (work is shared[0] or work in shared[1]):
+            leader, works = shared
+            if work in works:
+                works.remove(work)
+            if works or not leader.cancelled:
+                if leader.cancelled and self._work_queue.remove(leader):
+                    # Another client waits for the same result, its work takes over (at the end of the queue).
+                    self._coalesced[work.result_key] = (works[0], works)
+                    self._work_queue.append(works[0])
+                    self._wakeup.set()
+                # Otherwise the leader keeps running for the others.
+                metrics.CANCELLED.inc(where="shared")
+                return True
+            # Nobody waits for the leader's result anymore.
+            del self._coalesced[work.result_key]
+            work = leader
+
+        if self._work_queue.remove(work):
+            metrics.CANCELLED.inc(where="queue")
+            metrics.set_queue_depth(len(self._work_queue))
+            return True
+        # The worker reports it with MsgType.CANCELLED.
+        return any(w.cancel(work) for w in self._workers)
+
     def on_client_disconnect(self, client):
-        self._work_queue = [w for w in self._work_queue if w.client == client]
+        """
+        Cancels every work of a client, queued or running.
+        """
+        works = list(self._work_queue.client_works(client))
+        works += [w for _, shared in self._coalesced.values() for w in shared if w.client is client]
+        works += [w for worker in self._workers for w in worker.works if w.client is client]
+        for work in works:
+            self.cancel(work)
+
+    def _recipients(self, work: Work, done: bool = False) -> list[Work]:
+        """
+        The works sharing the events of a dispatched work.
+        """
+        shared = self._coalesced.get(work.result_key) if work.result_key is not None else None
+        if shared is None or shared[0] is not work:
+            return [] if work.cancelled else [work]
+        if done:
+            del self._coalesced[work.result_key]
+        return list(shared[1])
+
+    async def _on_progress(self, worker: BaseWorker, work: Work, progress):
+        for w in self._recipients(work):
+            await self._progress_callback(worker, w, progress)
+
+    async def _on_result(self, worker: BaseWorker, work: Work, result):
+        if work.result_key is not None:
+            self._result_cache.put(work.result_key, result)
+        for w in self._recipients(work, done=True):
+            await self._result_callback(worker, w, result)
+
+    async def fail(self, work: Work, cause: str):
+        """
+        Fails a work its worker couldn't complete, and the identical works waiting for it.
+        """
+        for w in self._recipients(work, done=True):
+            if self._failure_callback is not None:
+                await self._failure_callback(w, cause)
 
     async def update(self):
         """
-        Call this regularly!
+        Call this regularly, or let run() do it!
         """
 
         for w in self._workers:
             await w.update()
+        crashed = [w for workers in self._device_workers for w in workers if not w.alive]
+        if crashed:
+            await self._on_crashed(crashed)
 
         while len(self._work_queue) > 0:
-            for w in self._workers:
-                if not w.busy:
-                    work = self._work_queue.pop(0)
-                    print(work, work.client, work.request_id, work.prompt, work.image, work.args)
-                    await w.submit(work)
-                    await self._queue_update_callback(self.queue)
-                    break
-            else:
+            free_workers = [w for w in self._workers if not w.busy]
+            if not free_workers:
                 break
+            work = self._work_queue.pop()
+            work.decompress_image()
+            metrics.QUEUE_WAIT.observe(time.monotonic() - work.submitted_at)
+            metrics.set_queue_depth(len(self._work_queue))
+            w = self._pick_worker(work, free_workers)
+            logging.info(f"Dispatching work {work.uid} to {w.name}", extra={"stage": "dispatch", "uid": work.uid})
+            if self._image_slots is not None and w.uses_image_slots:
+                # Falls back to pickling the image when all slots are taken.
+                work.image_handle = self._image_slots.put(work.image)
+            await w.submit(work)
+            await self._queue_update_callback(self.queue)
 
+        now = time.monotonic()
+        if now - self._maintained_at >= MAINTENANCE_INTERVAL:
+            self._maintained_at = now
+            self._maintain(now)
 
-if __name__ == '__main__':
-    utils.configure_logger(logging.getLogger())
-    logging.basicConfig()
+    @staticmethod
+    def _pick_worker(work: Work, free_workers: list[BaseWorker]) -> BaseWorker:
+        """
+        A worker that can start the work right away if there is one, the prefetch slots of the others only fill up
+        when there is none. Among the workers that can start it, the one holding the session's decoder state
+        is preferred, then one with the work's variant resident (which a worker loads otherwise), then one with the
+        image's embeddings cached, then the least loaded (fewest outstanding rows). Among the others, the least
+        loaded, the affinities only break ties.
+        """
+        key = embedding_cache.cache_key(work.model, work.image_hash)
 
-    def on_queue_update(queue):
-        logging.warning(f"Queue update: {len(queue)}")
+        def affinity(w: BaseWorker) -> tuple[bool, bool, bool]:
+            return (
+                work.session_id is None or work.session_id not in w.cached_sessions,
+                work.model not in w.resident_models,
+                key not in w.cached_images,
+            )
+
+        with_room = [w for w in free_workers if w.has_room(work)]
+        if with_room:
+            return min(with_room, key=lambda w: (affinity(w), w.rows))
+        return min(free_workers, key=lambda w: (w.rows, affinity(w)))
 
-    def on_progress(worker, work, progress):
-        logging.warning(f"Progress: {work} {progress}")
+    def _start_worker(self, index: int) -> Worker:
+        device_name = self._devices[index]
+        w = Worker(
+            self,
+            f"Worker {next(self._worker_ids)}",
+            device_name,
+            self._on_progress,
+            self._on_result,
+            self._shared_weights.get(torch.device(device_name).type == "cpu"),
+            self._capacity[index]
+        )
+        self._device_workers[index].append(w)
+        self._workers.append(w)
+        if self._loop is not None:
+            self._watch(w)
+        self._record_workers()
+        return w
 
-    def on_result(worker, work, result):
-        logging.warning(f"Progress: {work} {result}")
+    def _watch(self, w: Worker):
+        self._loop.add_reader(w.fileno(), self._wakeup.set)
+        self._watched[w] = w.fileno()
 
-    pool = WorkerPool(on_queue_update, on_progress, on_result)
+    def _stop_worker(self, w: Worker):
+        """
+        Forgets a local worker and closes it, without looking at its works.
+        """
+        next(workers for workers in self._device_workers if w in workers).remove(w)
+        self._workers.remove(w)
+        if w in self._watched:
+            self._loop.remove_reader(self._watched.pop(w))
+        w.close()
+        self._record_workers()
 
-    for i in range(17):
-        path = f"../img_prompt/{i+1:02d}/"
-        prompt = open(path + "prompt.txt").read().strip()
-        image = Image.open(path + "img.jpg").convert("RGB")
-        image = path + "img.jpg"
-        pool.submit(Work(
-            None, 1, prompt, image, {}
-        ))
+    def _record_workers(self):
+        counts = collections.Counter(w.device for workers in self._device_workers for w in workers)
+        for device in self._devices:
+            metrics.WORKERS.set(counts[device], device=device)
 
-    # for i in range(17):
-    #     prompt = f"prompt {i}"
-    #     image = None
-    #     pool.submit(Work(
-    #         None, 1, prompt, image, {}
-    #     ))
+    async def _on_crashed(self, crashed: list[Worker]):
+        """
+        Schedules the restart of crashed local workers and requeues their works.
+        """
+        now = time.monotonic()
+        works = {}
+        for w in crashed:
+            index = next(i for i, workers in enumerate(self._device_workers) if w in workers)
+            works[w] = w.take_works()
+            self._stop_worker(w)
+            # Crashing while loading probably happens again, the delay grows until one loads.
+            delay = config.WORKER_RESTART_DELAY if w.ready \
+                else min(2 * self._restart_delays[index], config.WORKER_MAX_RESTART_DELAY)
+            self._restart_delays[index] = delay
+            self._restarts.append((now + delay, index))
+            metrics.WORKER_CRASHES.inc(device=w.device)
+            logging.error(f"{w.name} ({w.device}) exited with code {w.exitcode}, restarting it in {delay:.0f}s")
+        await self._requeue(works, crashed=True)
 
-    async def test():
+    def _maintain(self, now: float):
+        """
+        Restarts the crashed workers that are due, then scales the local workers.
+        """
+        for restart in [r for r in self._restarts if r[0] <= now]:
+            self._restarts.remove(restart)
+            w = self._start_worker(restart[1])
+            logging.info(f"Restarted a crashed worker: {w.name} ({w.device})")
+        if now - self._scaled_at >= config.SCALE_INTERVAL:
+            self._scale(now)
+
+    def _scale(self, now: float):
+        """
+        Starts a local worker on the device with the most room when the queued works would wait longer than
+        config.SCALE_UP_WAIT, or retires one idle for config.SCALE_DOWN_IDLE when nothing is queued.
+        """
+        local = [w for workers in self._device_workers for w in workers]
+        if len(self._work_queue) > 0:
+            if self._restarts or not all(w.ready for w in local):
+                # The workers on their way aren't part of the estimate yet.
+                return
+            wait = self.estimated_wait()
+            if wait is not None and wait <= config.SCALE_UP_WAIT:
+                return
+            room = [i for i, workers in enumerate(self._device_workers) if len(workers) < self._capacity[i]]
+            if not room:
+                return
+            w = self._start_worker(min(room, key=lambda i: len(self._device_workers[i]) / self._capacity[i]))
+            logging.info(f"Scaling up, {len(self._work_queue)} works queued"
+                         f"{f' for {wait:.1f}s' if wait is not None else ''}: {w.name} ({w.device})")
+            metrics.SCALING.inc(direction="up")
+            self._scaled_at = now
+            return
+
+        idle = [
+            w for workers in self._device_workers if len(workers) > self._min_workers
+            for w in workers if w.idle_since is not None and now - w.idle_since >= config.SCALE_DOWN_IDLE
+        ]
+        if idle:
+            w = min(idle, key=lambda w: w.idle_since)
+            logging.info(f"Scaling down, idle for {now - w.idle_since:.0f}s: {w.name} ({w.device})")
+            self._stop_worker(w)
+            metrics.SCALING.inc(direction="down")
+            self._scaled_at = now
+
+    async def run(self, poll_interval: float = None):
+        """
+        Runs the dispatch loop forever.
+        Wakes up as soon as a worker pipe is readable or a work is submitted, and every MAINTENANCE_INTERVAL,
+        or calls update() every poll_interval seconds if one is given.
+        """
+        loop = asyncio.get_running_loop()
+        ticker = None
+        if poll_interval is None:
+            try:
+                # Remote workers wake the loop up themselves (see wake()).
+                self._loop = loop
+                for w in self._workers:
+                    if isinstance(w, Worker):
+                        self._watch(w)
+                ticker = asyncio.create_task(self._tick())
+            except NotImplementedError:
+                logging.warning("The event loop can't watch the worker pipes, falling back to polling.")
+                self._loop = None
+                poll_interval = 0.01
+
+        try:
+            while True:
+                if poll_interval is None:
+                    await self._wakeup.wait()
+                    # Cleared before updating, so anything arriving meanwhile wakes us up again.
+                    self._wakeup.clear()
+                else:
+                    await asyncio.sleep(poll_interval)
+                await self.update()
+        finally:
+            if ticker is not None:
+                ticker.cancel()
+            for fd in self._watched.values():
+                loop.remove_reader(fd)
+            self._watched.clear()
+            self._loop = None
+
+    async def _tick(self):
         while True:
-            pool.update()
-            await asyncio.sleep(0)
+            await asyncio.sleep(MAINTENANCE_INTERVAL)
+            self._wakeup.set()
+
+    def wake(self):
+        """
+        Makes run() update as soon as possible.
+        """
+        self._wakeup.set()
+
+    def add_workers(self, workers: list[BaseWorker]):
+        self._workers.extend(workers)
+        self._wakeup.set()
+
+    async def remove_workers(self, workers: list[BaseWorker]):
+        """
+        Removes workers that are gone, their unfinished works go back to the queue.
+        """
+        for w in workers:
+            self._workers.remove(w)
+        await self._requeue({w: w.take_works() for w in workers})
+
+    async def _requeue(self, works: dict[BaseWorker, list[Work]], crashed: bool = False):
+        """
+        Puts the unfinished works of workers that are gone back in the queue.
+        Those that crashed config.MAX_WORK_CRASHES workers fail instead.
+        """
+        requeued = []
+        # A crash is charged to the works that reported progress, and to the first work handed to the worker
+        # (in dispatch order), which it runs first and which may crash it before reporting any.
+        # The works waiting behind it in the worker's backlog had nothing to do with it.
+        charged = {w.uid for worker_works in works.values() for w in worker_works[:1]}
+        for work in (work for worker_works in works.values() for work in worker_works):
+            self.release_image(work)
+            # Cancelled works only go on if identical works wait for them.
+            if not self._recipients(work):
+                continue
+            if crashed and (work.started or work.uid in charged):
+                work.crashes += 1
+            work.started = False
+            if work.crashes < config.MAX_WORK_CRASHES:
+                requeued.append(work)
+                continue
+            logging.error(f"Work {work.uid} crashed {work.crashes} workers, giving up on it.")
+            for w in self._recipients(work, done=True):
+                if self._failure_callback is not None:
+                    await self._failure_callback(w, "The request crashed its worker.")
+        if not requeued:
+            return
+
+        logging.warning(f"Requeuing {len(requeued)} works of {', '.join(w.name for w in works)}")
+        for work in requeued:
+            self._work_queue.append(work)
+        metrics.set_queue_depth(len(self._work_queue))
+        self._wakeup.set()
+        await self._queue_update_callback(self.queue)
+
+    def release_image(self, work: Work):
+        if work.image_handle is not None:
+            self._image_slots.release(work.image_handle)
+            work.image_handle = None
+
+    def close(self):
+        for w in self._workers:
+            w.close()
+        if self._image_slots is not None:
+            self._image_slots.close()
+
+
+if __name__ == '__main__':
+    # Runs the sample prompts through the pool. load_test.py load tests the whole server.
+    logs.start()
+
+    async def on_queue_update(queue):
+        logging.warning(f"Queue update: {len(queue)}")
+
+    async def on_progress(worker, work, progress):
+        logging.warning(f"Progress: {work.uid} {progress}")
+
+    async def on_result(worker, work, result):
+        logging.warning(f"Result: {work.uid} {result}")
+
+    async def on_failure(work, cause):
+        logging.warning(f"Failure: {work.uid} {cause}")
+
+    async def test():
+        pool = WorkerPool(on_queue_update, on_progress, on_result, failure_callback=on_failure)
+        for i in range(17):
+            path = f"../img_prompt/{i+1:02d}/"
+            prompt = open(path + "prompt.txt").read().strip()
+            image = Image.open(path + "img.jpg").convert("RGB")
+            await pool.submit(Work(None, 1, prompt, image, {}, utils.image_hash(image)))
+        try:
+            await pool.run()
+        finally:
+            pool.close()
 
     asyncio.run(test())
@@ -0,0 +1,150 @@
+"""
+Remote worker agent: runs worker processes on this machine for the WorkerPool of a server on another one
+(see remote.py). Reconnects when the connection is lost, the workers keep running meanwhile.
+
+    python worker_agent.py --devices cuda:0,cuda:1 [--dispatcher host:9102] [--name gpu-box-1] [--token secret]
+
+Several agents with DummyModel workers on one machine, to try it out:
+    BTLP2_DEBUGGING=1 python worker_agent.py --devices cpu,cpu --name agent-1
+    BTLP2_DEBUGGING=1 python worker_agent.py --devices cpu --name agent-2
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+from multiprocessing import Process, Pipe
+import socket
+import time
+
+import torch
+
+import config
+import logs
+import protocol
+import remote
+import worker
+
+
+class Agent:
+    def __init__(self, name: str, devices: list[str], token: str = None):
+        self.name = name
+        self.devices = devices
+        self.token = token
+
+        shared_weights = {}
+        if config.SHARED_WEIGHTS and not worker.DEBUGGING:
+            for float32 in {torch.device(d).type == "cpu" for d in devices}:
+                shared_weights[float32] = worker.model_api.load_shared_weights(float32)
+
+        multiprocessing.set_start_method("spawn", True)
+        self._pipes = []
+        self._procs = []
+        for i, device in enumerate(devices):
+            pipe, proc_pipe = Pipe()
+            log_conn = logs.connect()
+            proc = Process(
+                target=worker._worker_func,
+                args=(proc_pipe, f"{name} worker {i}", device, shared_weights.get(torch.device(device).type == "cpu"),
+                      time.time(), 1, log_conn),
+                name=f"{name} worker {i}"
+            )
+            proc.start()
+            log_conn.close()
+            self._pipes.append(pipe)
+            self._procs.append(proc)
+
+        # Free slots of every worker, the dispatcher is told about them when (re)connecting.
+        self._free = [0] * len(devices)
+        # Works received on the current connection. After a reconnect, the messages about the works
+        # of the previous one are dropped: the dispatcher requeued them already.
+        self._session_uids = set()
+        self._writer: asyncio.StreamWriter | None = None
+
+    def _on_worker_readable(self, index: int):
+        pipe = self._pipes[index]
+        while pipe.poll():
+            msg, uid, data = pipe.recv()
+            if msg == worker.MsgType.PENDING:
+                self._free[index] += 1
+            elif uid is not None and uid not in self._session_uids:
+                continue
+            elif msg in (worker.MsgType.RESULT, worker.MsgType.CANCELLED, worker.MsgType.FAILED):
+                self._session_uids.discard(uid)
+            if self._writer is not None:
+                self._writer.write(remote.encode_worker_message(index, msg, uid, data))
+
+    def _on_work(self, header: dict, payload: memoryview):
+        index, work = remote.decode_work(header, payload)
+        self._session_uids.add(work.uid)
+        self._free[index] -= 1
+        self._pipes[index].send(work)
+
+    async def _session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write(remote.pack({"type": "register", "name": self.name, "devices": self.devices, "token": self.token}))
+        for index, free in enumerate(self._free):
+            for _ in range(free):
+                writer.write(remote.encode_worker_message(index, worker.MsgType.PENDING, None, None))
+        self._session_uids.clear()
+        self._writer = writer
+
+        heartbeats = asyncio.create_task(remote.send_heartbeats(writer))
+        try:
+            while True:
+                header, payload = await asyncio.wait_for(remote.read_message(reader), config.REMOTE_HEARTBEAT_TIMEOUT)
+                if header.get("type") == "work":
+                    self._on_work(header, payload)
+                elif header.get("type") == "cancel" and header["uid"] in self._session_uids:
+                    self._pipes[header["worker"]].send(worker.Cancel(header["uid"]))
+        finally:
+            self._writer = None
+            heartbeats.cancel()
+            writer.close()
+
+    async def run(self, host: str, port: int):
+        loop = asyncio.get_running_loop()
+        for index, pipe in enumerate(self._pipes):
+            loop.add_reader(pipe.fileno(), self._on_worker_readable, index)
+
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+                logging.info(f"Connected to the dispatcher at {host}:{port}")
+                await self._session(reader, writer)
+            except asyncio.TimeoutError:
+                logging.warning("The dispatcher timed out.")
+            except (OSError, asyncio.IncompleteReadError) as e:
+                logging.warning(f"Lost the dispatcher: {e}")
+            except (protocol.ProtocolError, KeyError, IndexError, ValueError) as e:
+                logging.warning(f"Invalid message from the dispatcher: {e}")
+            await asyncio.sleep(config.REMOTE_RECONNECT_DELAY)
+
+    def close(self):
+        for proc in self._procs:
+            proc.terminate()
+            proc.join()
+
+
+def _address(value: str) -> tuple[str, int]:
+    host, port = value.rsplit(":", 1)
+    return host, int(port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dispatcher", type=_address, default=(config.REMOTE_WORKERS_HOST, config.REMOTE_WORKERS_PORT),
+                        help="host:port of the server's remote worker endpoint.")
+    parser.add_argument("--devices", default="cpu", help="Comma separated devices, one worker per device.")
+    parser.add_argument("--name", default=socket.gethostname())
+    parser.add_argument("--token", default=config.REMOTE_WORKERS_TOKEN)
+    args = parser.parse_args()
+
+    logs.start()
+    agent = Agent(args.name, args.devices.split(","), args.token)
+    try:
+        asyncio.run(agent.run(*args.dispatcher))
+    finally:
+        agent.close()
+
+
+if __name__ == '__main__':
+    main()